@@ -0,0 +1,130 @@
+"""
+Append-only log of what admins and directors did.
+
+Every mutating route calls record() before its commit, so an event exists
+exactly when its change does.  Events are never updated or deleted; the
+mapper refuses to.  Rows are keyed by an increasing id, which doubles as
+the paging cursor:
+
+    page(before=cursor)    newest first, for the dashboard feed and audit pages
+    page(entity=...)       one player's, tournament's, round's or pairing's history
+    since(after=cursor)    oldest first, for consumers that poll for new events
+
+Both use the primary key or the (entity_type, entity_id, id) index, so a
+page costs the same however long the log gets.
+"""
+import json
+from datetime import datetime
+from flask import has_request_context
+from flask_login import current_user
+from sqlalchemy import event, inspect
+from app import db
+from models import ActivityEvent
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+ACTION_LABELS = {
+    'player.created': 'Player Added',
+    'player.updated': 'Player Updated',
+    'player.deleted': 'Player Deleted',
+    'player.rated': 'Rating Changed',
+    'player.merged': 'Players Merged',
+    'tournament.created': 'Tournament Created',
+    'tournament.updated': 'Tournament Updated',
+    'tournament.deleted': 'Tournament Deleted',
+    'tournament.completed': 'Tournament Completed',
+    'round.created': 'Round Created',
+    'round.repaired': 'Round Re-paired',
+    'round.completed': 'Round Completed',
+    'result.entered': 'Result Entered',
+    'result.corrected': 'Result Corrected',
+    'season.archived': 'Season Archived',
+    'season.restored': 'Season Restored',
+    'rating_list.published': 'Rating List Published',
+    'game.attached': 'Game Record Attached',
+    'games.imported': 'Game Records Imported',
+    'registrations.received': 'Registrations Received',
+    'registrations.entered': 'Registrations Entered',
+    'registration.cancelled': 'Registration Cancelled',
+}
+
+def record(action, entity, summary=None, **details):
+    """Add an event to the current transaction
+
+    entity is a model instance, or an (entity_type, entity_id) pair for rows
+    that are being deleted.
+    """
+    if isinstance(entity, tuple):
+        entity_type, entity_id = entity
+    else:
+        if entity.id is None:
+            db.session.flush()
+        entity_type, entity_id = entity.__table__.name, entity.id
+    user_id = None
+    if has_request_context() and current_user.is_authenticated:
+        user_id = current_user.id
+    entry = ActivityEvent(
+        created_at=datetime.utcnow(),
+        user_id=user_id,
+        action=action,
+        entity_type=entity_type,
+        entity_id=entity_id,
+        summary=summary[:255] if summary else None,
+        details=json.dumps(details, default=str, separators=(',', ':')) if details else None,
+    )
+    db.session.add(entry)
+    return entry
+
+def changed_fields(obj):
+    """Names of the attributes of obj with unflushed changes"""
+    return sorted(attr.key for attr in inspect(obj).attrs if attr.history.has_changes())
+
+def _limit(limit):
+    return min(max(limit or DEFAULT_LIMIT, 1), MAX_LIMIT)
+
+def page(before=None, limit=DEFAULT_LIMIT, entity=None):
+    """Events newest first and the cursor for the next page (None on the last page)
+
+    entity restricts the page to one (entity_type, entity_id).
+    """
+    limit = _limit(limit)
+    query = ActivityEvent.query
+    if entity is not None:
+        query = query.filter(ActivityEvent.entity_type == entity[0], ActivityEvent.entity_id == entity[1])
+    if before is not None:
+        query = query.filter(ActivityEvent.id < before)
+    events = query.order_by(ActivityEvent.id.desc()).limit(limit + 1).all()
+    if len(events) > limit:
+        return events[:limit], events[limit - 1].id
+    return events, None
+
+def since(after=0, limit=DEFAULT_LIMIT):
+    """Events after the cursor, oldest first, and the cursor to continue from"""
+    events = ActivityEvent.query.filter(ActivityEvent.id > (after or 0)) \
+        .order_by(ActivityEvent.id).limit(_limit(limit)).all()
+    return events, events[-1].id if events else after
+
+def as_dict(entry):
+    return {
+        'id': entry.id,
+        'created_at': entry.created_at,
+        'user_id': entry.user_id,
+        'action': entry.action,
+        'entity_type': entry.entity_type,
+        'entity_id': entry.entity_id,
+        'summary': entry.summary,
+        'details': json.loads(entry.details) if entry.details else {},
+    }
+
+def _refuse_change(mapper, connection, target):
+    raise RuntimeError('Activity events are append-only')
+
+def init_app(app):
+    for name in ('before_update', 'before_delete'):
+        if not event.contains(ActivityEvent, name, _refuse_change):
+            event.listen(ActivityEvent, name, _refuse_change)
+
+    @app.template_filter('activity_label')
+    def activity_label(action):
+        return ACTION_LABELS.get(action, action)
@@ -0,0 +1,521 @@
+"""
+Read-only JSON API, version 1.
+
+Responses carry a strong ETag computed from the TableVersion counters of the
+tables behind the endpoint plus the request URL.  The counters are checked
+before anything else, so a client sending If-None-Match with a current ETag
+gets 304 Not Modified without the data being queried or serialized.
+
+Every list endpoint accepts ?fields=a,b,c to return only those fields.
+"""
+import hashlib
+import json
+from datetime import date
+from collections import defaultdict
+from functools import wraps
+from flask import Blueprint, Response, abort, request
+from flask_login import current_user
+from werkzeug.exceptions import HTTPException
+from app import db
+from models import GameRecord, Player, RatingList, Tournament, Round, TournamentPlayer, full_name
+from versioning import table_versions
+from archive import pairing_history, round_history
+import activity
+import head_to_head
+from rating_store import store as rating_store, view_title, AGE_BAND_LABELS
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+API_VERSION = 1
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+def dumps(payload):
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(',', ':'), default=lambda value: value.isoformat()).encode()
+
+def json_response(payload, status=200):
+    return Response(dumps(payload), status=status, mimetype='application/json')
+
+@api_bp.errorhandler(HTTPException)
+def handle_http_error(error):
+    return json_response({'error': error.name, 'message': error.description}, status=error.code)
+
+def versioned(*tables):
+    """Serve the view's payload as JSON with an ETag derived from the given tables"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            versions = table_versions(*tables)
+            key = f'{API_VERSION}|{request.path}|{request.query_string.decode()}|' + \
+                  ','.join(f'{table}={versions[table]}' for table in tables)
+            etag = hashlib.sha1(key.encode()).hexdigest()
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                response = json_response(view(**kwargs))
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
+
+def select_fields(rows, allowed):
+    fields = request.args.get('fields')
+    if not fields:
+        return rows
+    wanted = [field for field in fields.split(',') if field]
+    unknown = [field for field in wanted if field not in allowed]
+    if unknown:
+        abort(400, f"Unknown fields: {', '.join(unknown)}. Available: {', '.join(allowed)}")
+    return [{field: row[field] for field in wanted} for row in rows]
+
+def page_args():
+    limit = request.args.get('limit', DEFAULT_LIMIT, type=int)
+    offset = request.args.get('offset', 0, type=int)
+    if limit < 1 or offset < 0:
+        abort(400, 'limit must be positive and offset non-negative')
+    return min(limit, MAX_LIMIT), offset
+
+def page(items, limit, offset, total):
+    return {
+        'items': items,
+        'total': total,
+        'limit': limit,
+        'offset': offset,
+        'next_offset': offset + limit if offset + limit < total else None,
+    }
+
+# Players ------------------------------------------------------------------
+
+PLAYER_FIELDS = ('id', 'player_id', 'name', 'state', 'rating', 'rating_deviation', 'volatility', 'last_active', 'rank')
+PLAYER_COLUMNS = (Player.id, Player.player_id, Player.first_name, Player.middle_name, Player.last_name,
+                  Player.state, Player.rating, Player.rating_deviation, Player.volatility, Player.last_active)
+
+def player_dict(row, rank=None):
+    return {
+        'id': row.id,
+        'player_id': row.player_id,
+        'name': full_name(row.first_name, row.middle_name, row.last_name),
+        'state': row.state,
+        'rating': row.rating,
+        'rating_deviation': row.rating_deviation,
+        'volatility': row.volatility,
+        'last_active': row.last_active,
+        'rank': rank,
+    }
+
+@api_bp.route('/players')
+@versioned('player')
+def players():
+    limit, offset = page_args()
+    query = db.session.query(*PLAYER_COLUMNS)
+    state = request.args.get('state')
+    if state:
+        query = query.filter(Player.state == state)
+    total = query.count()
+    rows = query.order_by(Player.rating.desc(), Player.id).offset(offset).limit(limit).all()
+    items = [player_dict(row, rank=offset + i + 1) for i, row in enumerate(rows)]
+    return page(select_fields(items, PLAYER_FIELDS), limit, offset, total)
+
+@api_bp.route('/players/<int:player_id>')
+@versioned('player', 'tournament', 'tournament_player')
+def player(player_id):
+    row = db.session.query(*PLAYER_COLUMNS).filter(Player.id == player_id).first()
+    if row is None:
+        abort(404, 'No such player')
+    data = player_dict(row)
+    data['tournaments'] = [
+        {'id': t.id, 'name': t.name, 'end_date': t.end_date, 'status': t.status,
+         'initial_rating': t.initial_rating, 'final_rating': t.final_rating}
+        for t in db.session.query(Tournament.id, Tournament.name, Tournament.end_date, Tournament.status,
+                                  TournamentPlayer.initial_rating, TournamentPlayer.final_rating)
+        .join(TournamentPlayer, TournamentPlayer.tournament_id == Tournament.id)
+        .filter(TournamentPlayer.player_id == player_id)
+        .order_by(Tournament.start_date)
+    ]
+    return select_fields([data], PLAYER_FIELDS + ('tournaments',))[0]
+
+@api_bp.route('/players/<int:player_id>/rank')
+@versioned('player')
+def player_rank(player_id):
+    ratings = rating_store.snapshot()
+    entry = ratings.get(player_id)
+    if entry is None:
+        abort(404, 'No such player')
+    return {
+        'id': entry.id,
+        'rating': entry.rating,
+        'rank': ratings.rank(player_id),
+        'total': len(ratings),
+        'state': entry.state,
+        'state_rank': ratings.rank(player_id, state=entry.state),
+        'state_total': ratings.count(state=entry.state),
+        'age_band': entry.age_band,
+        'age_band_rank': ratings.rank(player_id, kind='age', value=entry.age_band) if entry.age_band else None,
+        'active_rank': ratings.rank(player_id, kind='active'),
+        'percentile': ratings.percentile(entry.rating),
+    }
+
+RANKING_FIELDS = ('rank', 'id', 'player_id', 'name', 'state', 'age_band', 'rating', 'rating_deviation')
+
+@api_bp.route('/rankings')
+@api_bp.route('/rankings/<kind>')
+@api_bp.route('/rankings/<kind>/<value>')
+@versioned('player')
+def rankings(kind=None, value=None):
+    """Overall, per-state (/state/<name>), per-age-band (/age/<band>) and active-only (/active) rankings"""
+    title = view_title(kind, value)
+    if title is None:
+        abort(404, f"Unknown ranking. Age bands: {', '.join(AGE_BAND_LABELS)}")
+    limit, offset = page_args()
+    index = rating_store.snapshot().view(kind, value)
+    items = [
+        {'rank': offset + i + 1, 'id': e.id, 'player_id': e.player_id, 'name': e.name, 'state': e.state,
+         'age_band': e.age_band, 'rating': e.rating, 'rating_deviation': e.rating_deviation}
+        for i, e in enumerate(index.page(offset, limit))
+    ]
+    return dict(page(select_fields(items, RANKING_FIELDS), limit, offset, len(index)), title=title)
+
+@api_bp.route('/players/<int:player_id>/opponents')
+@versioned('head_to_head', 'player')
+def player_opponents(player_id):
+    if db.session.get(Player, player_id) is None:
+        abort(404, 'No such player')
+    limit, offset = page_args()
+    records = head_to_head.opponents(player_id)
+    return page(records[offset:offset + limit], limit, offset, len(records))
+
+@api_bp.route('/head-to-head/<int:player_id>/<int:opponent_id>')
+@versioned('head_to_head')
+def head_to_head_record(player_id, opponent_id):
+    """One player's record against another, read from a single head_to_head row"""
+    record = head_to_head.between(player_id, opponent_id)
+    if record is None:
+        abort(404, 'These players have not played each other')
+    return record
+
+@api_bp.route('/ratings')
+@versioned('player')
+def ratings():
+    """The whole rating list as compact rows: [id, player_id, rating, rating_deviation, volatility]"""
+    rows = db.session.query(Player.id, Player.player_id, Player.rating, Player.rating_deviation, Player.volatility) \
+        .order_by(Player.rating.desc(), Player.id).all()
+    return {
+        'columns': ['id', 'player_id', 'rating', 'rating_deviation', 'volatility'],
+        'rows': [list(row) for row in rows],
+    }
+
+# Published rating lists ---------------------------------------------------
+
+def rating_list_dict(row):
+    return {
+        'id': row.id,
+        'published_on': row.published_on.isoformat(),
+        'title': row.title,
+        'player_count': row.player_count,
+    }
+
+def date_arg(value, name):
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        abort(400, f'{name} must be a YYYY-MM-DD date')
+
+def get_rating_list(published_on):
+    import rating_lists  # imported lazily, only the rating list endpoints use it
+    row = rating_lists.published(date_arg(published_on, 'The list date'))
+    if row is None:
+        abort(404, f'No rating list was published on {published_on}')
+    return row
+
+@api_bp.route('/rating-lists')
+@versioned('rating_list')
+def published_rating_lists():
+    rows = RatingList.query.order_by(RatingList.published_on.desc()).all()
+    return {'items': [rating_list_dict(row) for row in rows]}
+
+@api_bp.route('/rating-lists/<published_on>')
+@versioned('rating_list')
+def published_rating_list(published_on):
+    """A whole published list as compact rows: [id, rating, rating_deviation], by id"""
+    import rating_lists
+    row = get_rating_list(published_on)
+    decoded = rating_lists.load(row.id)
+    scale = rating_lists.SCALE
+    return dict(rating_list_dict(row),
+                columns=['id', 'rating', 'rating_deviation'],
+                rows=[[player_id, rating / scale, deviation / scale]
+                      for player_id, rating, deviation in zip(decoded.ids, decoded.ratings, decoded.deviations)])
+
+@api_bp.route('/rating-lists/<published_on>/changes')
+@versioned('rating_list')
+def published_rating_list_changes(published_on):
+    """Changes since ?since=<date>, by default since the previous list"""
+    import rating_lists
+    row = get_rating_list(published_on)
+    since = request.args.get('since')
+    if since:
+        previous = get_rating_list(since)
+    else:
+        previous = RatingList.query.filter(RatingList.published_on < row.published_on) \
+            .order_by(RatingList.published_on.desc()).first()
+        if previous is None:
+            abort(404, 'This is the first published rating list')
+    return {'from': rating_list_dict(previous), 'to': rating_list_dict(row),
+            'items': rating_lists.changes(previous, row)}
+
+@api_bp.route('/players/<int:player_id>/rating')
+@versioned('rating_list')
+def player_published_rating(player_id):
+    """A player's rating on the list in force on ?on=<date> (default today)"""
+    import rating_lists
+    day = date_arg(request.args['on'], 'on') if 'on' in request.args else date.today()
+    found = rating_lists.rating_on(player_id, day)
+    if found is None:
+        abort(404, f'Player {player_id} is not on the rating list in force on {day.isoformat()}')
+    row, rating, deviation = found
+    return {'player_id': player_id, 'on': day.isoformat(), 'list': rating_list_dict(row),
+            'rating': rating, 'rating_deviation': deviation}
+
+# Game records -------------------------------------------------------------
+
+GAME_FIELDS = ('id', 'black', 'white', 'black_player_id', 'white_player_id', 'event', 'played_on', 'board_size',
+               'komi', 'handicap', 'result', 'move_count', 'opening', 'tournament_id', 'match_id')
+
+@api_bp.route('/games')
+@versioned('game_record')
+def games():
+    """Search by ?player=, ?opening= (moves in any orientation), ?size=, ?min_moves=, ?max_moves=,
+    ?from= and ?to= dates, ?tournament=; newest first"""
+    import game_records  # imported lazily, it loads the SGF parser and archive readers
+    import sgf
+    limit, offset = page_args()
+    try:
+        query = game_records.search(
+            player_id=request.args.get('player', type=int),
+            opening=request.args.get('opening'),
+            board_size=request.args.get('size', sgf.DEFAULT_SIZE, type=int),
+            min_moves=request.args.get('min_moves', type=int),
+            max_moves=request.args.get('max_moves', type=int),
+            played_from=date_arg(request.args['from'], 'from') if 'from' in request.args else None,
+            played_to=date_arg(request.args['to'], 'to') if 'to' in request.args else None,
+            tournament_id=request.args.get('tournament', type=int))
+    except sgf.SgfError as exc:
+        abort(400, str(exc))
+    total = query.count()
+    items = [game_records.as_dict(record) for record in query.offset(offset).limit(limit)]
+    return page(select_fields(items, GAME_FIELDS), limit, offset, total)
+
+@api_bp.route('/games/<int:record_id>')
+@versioned('game_record')
+def game(record_id):
+    import game_records
+    record = db.session.get(GameRecord, record_id)
+    if record is None:
+        abort(404, f'No game record {record_id}')
+    return game_records.as_dict(record)
+
+# Tournaments --------------------------------------------------------------
+
+TOURNAMENT_FIELDS = ('id', 'tournament_id', 'name', 'start_date', 'end_date', 'state', 'status', 'pairing_system')
+
+def tournament_dict(t):
+    return {
+        'id': t.id,
+        'tournament_id': t.tournament_id,
+        'name': t.name,
+        'start_date': t.start_date,
+        'end_date': t.end_date,
+        'state': t.state,
+        'status': t.status,
+        'pairing_system': t.pairing_system,
+    }
+
+@api_bp.route('/tournaments')
+@versioned('tournament')
+def tournaments():
+    limit, offset = page_args()
+    query = db.session.query(Tournament.id, Tournament.tournament_id, Tournament.name, Tournament.start_date,
+                             Tournament.end_date, Tournament.state, Tournament.status, Tournament.pairing_system)
+    status = request.args.get('status')
+    if status:
+        query = query.filter(Tournament.status == status)
+    total = query.count()
+    rows = query.order_by(Tournament.start_date.desc(), Tournament.id.desc()).offset(offset).limit(limit).all()
+    return page(select_fields([tournament_dict(t) for t in rows], TOURNAMENT_FIELDS), limit, offset, total)
+
+def get_tournament(tournament_id):
+    tournament = db.session.get(Tournament, tournament_id)
+    if tournament is None:
+        abort(404, 'No such tournament')
+    return tournament
+
+@api_bp.route('/tournaments/<int:tournament_id>')
+@versioned('tournament', 'tournament_player', 'round')
+def tournament(tournament_id):
+    data = tournament_dict(get_tournament(tournament_id))
+    data['info'] = db.session.query(Tournament.info).filter(Tournament.id == tournament_id).scalar()
+    data['players'] = [
+        {'id': row.player_id, 'initial_rating': row.initial_rating, 'final_rating': row.final_rating}
+        for row in db.session.query(TournamentPlayer.player_id, TournamentPlayer.initial_rating,
+                                    TournamentPlayer.final_rating)
+        .filter(TournamentPlayer.tournament_id == tournament_id)
+    ]
+    data['rounds'] = [
+        {'id': r.id, 'number': r.number, 'datetime': r.datetime, 'status': r.status}
+        for r in db.session.query(round_history.c.id, round_history.c.number, round_history.c.datetime,
+                                  round_history.c.status)
+        .filter(round_history.c.tournament_id == tournament_id).order_by(round_history.c.number)
+    ]
+    return select_fields([data], TOURNAMENT_FIELDS + ('info', 'players', 'rounds'))[0]
+
+PAIRING_FIELDS = ('id', 'round_id', 'white_player_id', 'black_player_id', 'result', 'version')
+
+def pairings_by_round(round_ids):
+    grouped = defaultdict(list)
+    if round_ids:
+        for row in db.session.query(pairing_history.c.id, pairing_history.c.round_id, pairing_history.c.white_player_id,
+                                    pairing_history.c.black_player_id, pairing_history.c.result,
+                                    pairing_history.c.version) \
+                .filter(pairing_history.c.round_id.in_(round_ids)).order_by(pairing_history.c.id):
+            grouped[row.round_id].append(dict(zip(PAIRING_FIELDS, row)))
+    return grouped
+
+@api_bp.route('/tournaments/<int:tournament_id>/rounds')
+@versioned('tournament', 'round', 'round_pairing')
+def rounds(tournament_id):
+    get_tournament(tournament_id)
+    rows = db.session.query(round_history.c.id, round_history.c.number, round_history.c.datetime,
+                            round_history.c.status, round_history.c.version) \
+        .filter(round_history.c.tournament_id == tournament_id).order_by(round_history.c.number).all()
+    grouped = pairings_by_round([r.id for r in rows])
+    items = [
+        {'id': r.id, 'number': r.number, 'datetime': r.datetime, 'status': r.status, 'version': r.version,
+         'pairings': select_fields(grouped[r.id], PAIRING_FIELDS)}
+        for r in rows
+    ]
+    return {'items': items}
+
+@api_bp.route('/rounds/<int:round_id>/pairings')
+@versioned('round', 'round_pairing')
+def round_pairings(round_id):
+    if db.session.query(round_history.c.id).filter(round_history.c.id == round_id).first() is None:
+        abort(404, 'No such round')
+    return {'items': select_fields(pairings_by_round([round_id])[round_id], PAIRING_FIELDS)}
+
+STANDING_FIELDS = ('rank', 'player_id', 'name', 'rating', 'score', 'wins', 'losses', 'draws', 'games')
+
+def compute_standings(tournament_id):
+    entries = db.session.query(TournamentPlayer.player_id, Player.first_name, Player.middle_name,
+                               Player.last_name, Player.rating) \
+        .join(Player, Player.id == TournamentPlayer.player_id) \
+        .filter(TournamentPlayer.tournament_id == tournament_id).all()
+    table = {
+        e.player_id: {'player_id': e.player_id, 'name': full_name(e.first_name, e.middle_name, e.last_name),
+                      'rating': e.rating, 'score': 0.0, 'wins': 0, 'losses': 0, 'draws': 0, 'games': 0}
+        for e in entries
+    }
+    results = db.session.query(pairing_history.c.white_player_id, pairing_history.c.black_player_id,
+                               pairing_history.c.result) \
+        .join(round_history, round_history.c.id == pairing_history.c.round_id) \
+        .filter(round_history.c.tournament_id == tournament_id, pairing_history.c.result.isnot(None)).all()
+    for white, black, result in results:
+        if result == 'Jigo':
+            outcome = {white: 'draws', black: 'draws'}
+        elif result.startswith('W+'):
+            outcome = {white: 'wins', black: 'losses'}
+        else:
+            outcome = {white: 'losses', black: 'wins'}
+        for player_id, kind in outcome.items():
+            row = table.get(player_id)
+            if row is None:
+                continue
+            row[kind] += 1
+            row['games'] += 1
+            row['score'] += {'wins': 1.0, 'draws': 0.5, 'losses': 0.0}[kind]
+    standings = sorted(table.values(), key=lambda row: (-row['score'], -(row['rating'] or 0), row['player_id']))
+    for rank, row in enumerate(standings, start=1):
+        row['rank'] = rank
+    return standings
+
+@api_bp.route('/tournaments/<int:tournament_id>/standings')
+@versioned('tournament', 'tournament_player', 'round', 'round_pairing', 'player')
+def standings(tournament_id):
+    get_tournament(tournament_id)
+    return {'items': select_fields(compute_standings(tournament_id), STANDING_FIELDS)}
+
+# Predictions ----------------------------------------------------------------
+
+def simulation_args():
+    import prediction
+    runs = request.args.get('runs', prediction.DEFAULT_RUNS, type=int)
+    max_runs = prediction.max_runs(current_user)
+    if not 1 <= runs <= max_runs:
+        abort(400, f'runs must be between 1 and {max_runs}')
+    return {
+        'total_rounds': request.args.get('rounds', type=int),
+        'runs': runs,
+        'seed': request.args.get('seed', prediction.DEFAULT_SEED, type=int),
+        'places': max(request.args.get('places', 3, type=int), 1),
+        'extra_rounds': prediction.max_extra_rounds(current_user),
+    }
+
+@api_bp.route('/predictions')
+@versioned('player')
+def predictions():
+    """Win probabilities for ?pairs=<white id>:<black id>,..."""
+    import prediction
+    try:
+        pairs = [tuple(int(player_id) for player_id in pair.split(':'))
+                 for pair in request.args.get('pairs', '').split(',') if pair]
+    except ValueError:
+        abort(400, 'pairs must look like 12:34,56:78')
+    if not pairs or any(len(pair) != 2 for pair in pairs):
+        abort(400, 'pairs must look like 12:34,56:78')
+    if len(pairs) > MAX_LIMIT:
+        abort(400, f'At most {MAX_LIMIT} pairs per request')
+    return {'items': prediction.predict_pairs(pairs)}
+
+@api_bp.route('/rounds/<int:round_id>/forecast')
+@versioned('player', 'round', 'round_pairing')
+def round_forecast(round_id):
+    import prediction
+    if db.session.get(Round, round_id) is None:
+        abort(404, 'No such round')
+    return prediction.round_forecast(round_id)
+
+@api_bp.route('/tournaments/<int:tournament_id>/simulation')
+@versioned('player', 'tournament_player', 'round', 'round_pairing')
+def tournament_simulation(tournament_id):
+    """Monte-Carlo standings: ?rounds=<total rounds>&runs=<simulations>&places=<prize places>"""
+    import prediction
+    get_tournament(tournament_id)
+    return prediction.simulate_tournament(tournament_id, **simulation_args())
+
+def admin_only(view):
+    """Checked before versioned() so that a 304 is never served to anyone else"""
+    @wraps(view)
+    def wrapper(**kwargs):
+        if not (current_user.is_authenticated and current_user.is_admin):
+            abort(403, 'Admins only')
+        return view(**kwargs)
+    return wrapper
+
+@api_bp.route('/events')
+@admin_only
+@versioned('activity_event')
+def events():
+    """Activity log oldest first from ?after=<cursor>; poll with the returned cursor"""
+    after = request.args.get('after', 0, type=int)
+    limit = request.args.get('limit', activity.DEFAULT_LIMIT, type=int)
+    if after < 0 or limit < 1:
+        abort(400, 'after must be non-negative and limit positive')
+    items, cursor = activity.since(after, min(limit, activity.MAX_LIMIT))
+    return {'items': [activity.as_dict(item) for item in items], 'cursor': cursor}
@@ -1,47 +1,124 @@
 import os
 import logging
-from flask import Flask
+import click
+from flask import Flask, current_app
+from flask.cli import with_appcontext
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_wtf.csrf import CSRFProtect
 from sqlalchemy.orm import DeclarativeBase
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
-
 class Base(DeclarativeBase):
     pass
 
+# Extensions are created unbound and attached to an app in create_app()
 db = SQLAlchemy(model_class=Base)
-app = Flask(__name__)
-
-# Configuration
-app.secret_key = os.environ.get("SESSION_SECRET", "your-secret-key-here")  # Updated secret key handling
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///go_stats.db"
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_pre_ping": True,
-}
-app.config['WTF_CSRF_ENABLED'] = True  # Enable CSRF protection
-
-# Initialize extensions
-csrf = CSRFProtect(app)  # Initialize CSRF protection
-db.init_app(app)
+csrf = CSRFProtect()
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = 'auth.login'
 login_manager.login_message = 'Please log in to access this page.'
 
-# Import routes after app initialization
-from auth import auth_bp
-from routes import main_bp
+def create_app(config=None):
+    # Configure logging
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
+
+    app = Flask(__name__)
+
+    # Configuration
+    app.secret_key = os.environ.get("SESSION_SECRET", "your-secret-key-here")  # Updated secret key handling
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("SQLALCHEMY_DATABASE_URI", "sqlite:///go_stats.db")
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_pre_ping": True,
+    }
+    app.config['WTF_CSRF_ENABLED'] = True  # Enable CSRF protection
+    if config:
+        app.config.update(config)
+
+    # Initialize extensions
+    csrf.init_app(app)  # Initialize CSRF protection
+    db.init_app(app)
+    login_manager.init_app(app)
 
-# Register blueprints
-app.register_blueprint(auth_bp)
-app.register_blueprint(main_bp)
+    # Import routes here so importing this module stays cheap for scripts
+    from auth import auth_bp
+    from routes import main_bp
+    from api import api_bp
+    import activity
+    import archive
+    import assets
+    import backup
+    import compression
+    import database
+    import dedup
+    import fragment_cache
+    import prepairing
+    import printing
+    import rating_store
+    import registration
+    import system_stats
+    import versioning
 
-with app.app_context():
+    # Register blueprints
+    app.register_blueprint(auth_bp)
+    app.register_blueprint(main_bp)
+    app.register_blueprint(api_bp)
+    # Registered first so it runs after every other after_request hook
+    compression.init_app(app)
+    database.init_app(app)
+    archive.init_app(app)
+    backup.init_app(app)
+    # Opt-in subsystems are only imported when they are switched on
+    app.config.setdefault('INSTRUMENTATION', os.environ.get('INSTRUMENTATION', '0') == '1')
+    if app.config['INSTRUMENTATION']:
+        import instrumentation
+        instrumentation.init_app(app)
+    system_stats.init_app(app)
+    versioning.init_app(app)
+    rating_store.init_app(app)
+    assets.init_app(app)
+    fragment_cache.init_app(app)
+    activity.init_app(app)
+    app.config.setdefault('REPLICATION_ROLE', os.environ.get('REPLICATION_ROLE') or None)
+    if app.config['REPLICATION_ROLE']:
+        import replication
+        replication.init_app(app)
+    prepairing.init_app(app)
+    printing.init_app(app)
+    dedup.init_app(app)
+    registration.init_app(app)
+
+    app.cli.add_command(init_db_command)
+    return app
+
+def init_db(echo=click.echo):
+    """Create missing tables and columns and fill new derived tables; run in an app context."""
     # Import all models to ensure they're registered with SQLAlchemy
-    from models import User, Player, Tournament, Round, RoundPairing, TournamentPlayer, Match
-    # Create all tables
-    db.create_all()
\ No newline at end of file
+    import models
+    from database import add_missing_columns
+    db.create_all()
+    for column in add_missing_columns(db.engine, db.metadata):
+        echo(f'Added column {column}')
+    if current_app.config['REPLICATION_ROLE'] == 'primary':
+        from backup import sqlite_path
+        from replication import install_triggers
+        echo(f'Updated {install_triggers(sqlite_path(db.engine))} replication triggers')
+
+    # Derived tables start empty on a database that predates them
+    import dedup
+    import head_to_head
+    if models.HeadToHead.query.first() is None:
+        pairs = head_to_head.rebuild()
+        if pairs:
+            echo(f'Rebuilt head-to-head records for {pairs} pairs')
+    if models.PlayerKey.query.first() is None:
+        keys = dedup.rebuild_keys()
+        if keys:
+            echo(f'Rebuilt {keys} duplicate-search keys')
+
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    """Create missing tables and columns and fill new derived tables (flask --app main init-db)."""
+    init_db()
+    click.echo('Database schema is up to date.')
@@ -0,0 +1,424 @@
+"""
+Per-season archive of rounds, pairings and matches.
+
+Completed tournaments of past seasons (the calendar year a tournament ended)
+are moved out of the main database into one SQLite file per season,
+instance/archive/season-<year>.db, so the hot tables only hold the current
+season and the queries over them stay small:
+
+    python archive.py list
+    python archive.py archive 2023      # move the completed tournaments of 2023
+    python archive.py restore 2023      # move them back, e.g. to correct a result
+
+Every connection ATTACHes the season files as season_<year> and gets TEMP
+views that span the main tables and the archive:
+
+    round_history, round_pairing_history, match_history
+
+Code that shows history (player pages, archived tournament pages and
+crosstables, the API, head-to-head rebuilds) reads the views through the
+tables below; code that changes results keeps using the models, which only
+see the hot rows.  Archived tournaments are marked with archive_season, and
+archive rows are only visible for marked tournaments.  A move copies the
+rows first and then marks and deletes in one transaction of the main
+database, so a crash in between (WAL makes transactions atomic per file
+only) never shows a game twice.
+
+SQLite attaches at most 10 databases per connection, so at most 10 seasons
+can be archived.  A season is only archived once a later season has games,
+since SQLite would otherwise reuse the ids of the archived rows.  Moves hold
+the archive lock of backup.py, and backups copy the season files with the
+main database.  Season files are not replicated: copy instance/archive to
+followers after archiving.
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import threading
+from datetime import date
+from functools import wraps
+from sqlalchemy import Column, MetaData, Table, delete, event, extract, func, or_, select, update
+from app import db
+from models import Match, Player, Round, RoundPairing, Tournament
+
+logger = logging.getLogger(__name__)
+
+# Copied in this order and deleted in reverse
+ARCHIVED = (Round.__table__, RoundPairing.__table__, Match.__table__)
+ATTACH_LIMIT = 10
+SEASON_FILE = 'season-{}.db'
+INDEXES = {
+    'round': ('tournament_id',),
+    'round_pairing': ('round_id',),
+    'match': ('tournament_id', 'white_player_id', 'black_player_id'),
+}
+
+class ArchiveError(Exception):
+    pass
+
+def _history_table(table):
+    return Table(f'{table.name}_history', history_metadata,
+                 *(Column(c.name, c.type, primary_key=c.primary_key) for c in table.c))
+
+# The TEMP views every connection has; never created by create_all
+history_metadata = MetaData()
+round_history = _history_table(Round.__table__)
+pairing_history = _history_table(RoundPairing.__table__)
+match_history = _history_table(Match.__table__)
+
+def schema_name(season):
+    return f'season_{season}'
+
+def season_table(table, season):
+    """The archived copy of a model table, as attached to every connection"""
+    return Table(table.name, MetaData(), *(Column(c.name, c.type) for c in table.c), schema=schema_name(season))
+
+class SeasonDirectory:
+    """The archived seasons, listed again only when the directory changes"""
+
+    def __init__(self, path):
+        self.path = path
+        self._stamp = None
+        self._seasons = ()
+        self._lock = threading.Lock()
+
+    def file(self, season):
+        return os.path.join(self.path, SEASON_FILE.format(season))
+
+    def seasons(self):
+        try:
+            stamp = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return ()
+        with self._lock:
+            if stamp != self._stamp:
+                prefix, suffix = SEASON_FILE.split('{}')
+                self._seasons = tuple(sorted(
+                    int(name[len(prefix):-len(suffix)]) for name in os.listdir(self.path)
+                    if name.startswith(prefix) and name.endswith(suffix) and name[len(prefix):-len(suffix)].isdigit()
+                ))
+                self._stamp = stamp
+            return self._seasons
+
+def _columns(conn, schema, table):
+    return [row[1] for row in conn.execute(f'PRAGMA {schema}.table_info("{table}")')]
+
+def _view_sql(conn, table, seasons):
+    names = [c.name for c in table.c]
+    selects = ['SELECT {} FROM main."{}"'.format(', '.join(f'"{n}"' for n in names), table.name)]
+    for season in seasons:
+        schema = schema_name(season)
+        present = set(_columns(conn, schema, table.name))
+        if not present:
+            continue
+        columns = ', '.join(f'"{n}"' if n in present else f'NULL AS "{n}"' for n in names)
+        marked = f'(SELECT id FROM main.tournament WHERE archive_season = {season:d})'
+        if 'tournament_id' in present:
+            condition = f'tournament_id IN {marked}'
+        else:
+            condition = f'round_id IN (SELECT id FROM {schema}."round" WHERE tournament_id IN {marked})'
+        selects.append(f'SELECT {columns} FROM {schema}."{table.name}" WHERE {condition}')
+    return f'CREATE TEMP VIEW "{table.name}_history" AS ' + ' UNION ALL '.join(selects)
+
+def attach(conn, directory, seasons, attached=()):
+    """ATTACH the given seasons (DETACH the others) and recreate the history views"""
+    for table in ARCHIVED:
+        conn.execute(f'DROP VIEW IF EXISTS temp."{table.name}_history"')
+    for season in set(attached) - set(seasons):
+        conn.execute(f'DETACH DATABASE {schema_name(season)}')
+    for season in sorted(set(seasons) - set(attached)):
+        conn.execute(f'ATTACH DATABASE ? AS {schema_name(season)}', (directory.file(season),))
+    for table in ARCHIVED:
+        conn.execute(_view_sql(conn, table, seasons))
+
+def _listener(directory):
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        seasons = directory.seasons()
+        attached = connection_record.info.get('archive_seasons')
+        if attached == seasons:
+            return
+        try:
+            attach(dbapi_connection, directory, seasons, attached or ())
+        except sqlite3.OperationalError as exc:
+            # Before init-db has created the tables there is nothing to view yet
+            logger.debug('History views not created: %s', exc)
+            connection_record.info.pop('archive_seasons', None)
+            return
+        connection_record.info['archive_seasons'] = seasons
+    return checkout
+
+# Reading history -----------------------------------------------------------
+
+class Record:
+    """A read-only row of a history view, with the objects templates expect attached"""
+
+    def __init__(self, mapping):
+        self.__dict__.update(mapping)
+
+def _players(ids):
+    return {p.id: p for p in Player.query.filter(Player.id.in_(ids))} if ids else {}
+
+def recent_matches(player_id, limit=10):
+    """The player's latest games, archived ones included, newest first"""
+    rows = db.session.execute(
+        select(match_history)
+        .where(or_(match_history.c.black_player_id == player_id, match_history.c.white_player_id == player_id))
+        .order_by(match_history.c.date.desc()).limit(limit)
+    ).mappings().all()
+    matches = [Record(row) for row in rows]
+    players = _players({m.white_player_id for m in matches} | {m.black_player_id for m in matches})
+    tournament_ids = {m.tournament_id for m in matches}
+    tournaments = {t.id: t for t in Tournament.query.filter(Tournament.id.in_(tournament_ids))} \
+        if tournament_ids else {}
+    for match in matches:
+        match.white_player = players.get(match.white_player_id)
+        match.black_player = players.get(match.black_player_id)
+        match.tournament = tournaments.get(match.tournament_id)
+    return matches
+
+def rounds(tournament):
+    """The tournament's rounds with their pairings, from the archive if it was archived"""
+    if tournament.archive_season is None:
+        return tournament.rounds
+    found = [Record(row) for row in db.session.execute(
+        select(round_history).where(round_history.c.tournament_id == tournament.id).order_by(round_history.c.id)
+    ).mappings()]
+    by_id = {r.id: r for r in found}
+    for r in found:
+        r.tournament = tournament
+        r.pairings = []
+    pairings = [Record(row) for row in db.session.execute(
+        select(pairing_history).where(pairing_history.c.round_id.in_(by_id)).order_by(pairing_history.c.id)
+    ).mappings()] if by_id else []
+    players = _players({p.white_player_id for p in pairings} | {p.black_player_id for p in pairings})
+    for pairing in pairings:
+        pairing.round = by_id[pairing.round_id]
+        pairing.white_player = players.get(pairing.white_player_id)
+        pairing.black_player = players.get(pairing.black_player_id)
+        pairing.round.pairings.append(pairing)
+    return found
+
+def forget_player(player_id):
+    """Delete a player's archived matches, as delete_player does for the hot ones"""
+    for season in current_directory().seasons():
+        archived = season_table(Match.__table__, season)
+        db.session.execute(delete(archived).where(
+            or_(archived.c.black_player_id == player_id, archived.c.white_player_id == player_id)))
+
+def repoint_player(old_id, new_id):
+    """Move a player's archived pairings and matches to another player, as merging does for the hot ones"""
+    for season in current_directory().seasons():
+        for table in (RoundPairing.__table__, Match.__table__):
+            archived = season_table(table, season)
+            for column in ('white_player_id', 'black_player_id'):
+                db.session.execute(update(archived).where(archived.c[column] == old_id).values({column: new_id}))
+
+# Moving seasons ------------------------------------------------------------
+
+def current_directory():
+    from flask import current_app
+    return current_app.extensions['archive']
+
+def _database_path():
+    from backup import sqlite_path
+    path = sqlite_path(db.engine)
+    if path is None:
+        raise ArchiveError('Archiving is only supported for SQLite databases')
+    return path
+
+def _connect(path):
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute('PRAGMA busy_timeout=10000')
+    return conn
+
+def _create_tables(conn, schema):
+    """Create the archive tables, or add the columns the main tables gained since"""
+    for table in ARCHIVED:
+        main_columns = list(conn.execute(f'PRAGMA main.table_info("{table.name}")'))
+        present = set(_columns(conn, schema, table.name))
+        if not present:
+            definitions = ', '.join(f'"{name}" {type_ or ""}{" PRIMARY KEY" if pk else ""}'
+                                    for _, name, type_, _, _, pk in main_columns)
+            conn.execute(f'CREATE TABLE {schema}."{table.name}" ({definitions})')
+        else:
+            for _, name, type_, _, _, _ in main_columns:
+                if name not in present:
+                    conn.execute(f'ALTER TABLE {schema}."{table.name}" ADD COLUMN "{name}" {type_ or ""}')
+        for column in INDEXES[table.name]:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}."ix_{table.name}_{column}" '
+                         f'ON "{table.name}" ("{column}")')
+
+def _row_filter(table, ids, schema='main'):
+    marks = ', '.join('?' * len(ids))
+    if table.name == 'round_pairing':
+        return f'round_id IN (SELECT id FROM {schema}."round" WHERE tournament_id IN ({marks}))'
+    return f'tournament_id IN ({marks})'
+
+def season_of(tournament):
+    day = tournament.end_date or tournament.start_date
+    return day.year if day else None
+
+def seasons():
+    """[(season, tournaments, archived tournaments)] for every season with completed tournaments"""
+    year = extract('year', func.coalesce(Tournament.end_date, Tournament.start_date))
+    rows = db.session.query(year, func.count(Tournament.id), func.count(Tournament.archive_season)) \
+        .filter(Tournament.status == 'completed').group_by(year).order_by(year).all()
+    return [(int(season), total, archived) for season, total, archived in rows if season is not None]
+
+def _moving(move):
+    """Run a season move under the archive lock, so a backup never copies half of it"""
+    @wraps(move)
+    def wrapper(season):
+        from backup import archive_lock
+        handle = archive_lock(current_directory().path)
+        try:
+            return move(season)
+        finally:
+            handle.close()
+    return wrapper
+
+@_moving
+def archive_season(season):
+    """Move the completed, unarchived tournaments of a past season; returns the number moved"""
+    import activity
+    if season >= date.today().year:
+        raise ArchiveError('Only past seasons can be archived')
+    directory = current_directory()
+    tournaments = [t for t in Tournament.query.filter(Tournament.status == 'completed',
+                                                      Tournament.archive_season.is_(None))
+                   if season_of(t) == season]
+    if not tournaments:
+        return 0
+    if season not in directory.seasons() and len(directory.seasons()) >= ATTACH_LIMIT:
+        raise ArchiveError(f'SQLite attaches at most {ATTACH_LIMIT} seasons; restore one first')
+    ids = [t.id for t in tournaments]
+    schema = schema_name(season)
+    os.makedirs(directory.path, exist_ok=True)
+
+    # Copy first; the rows stay invisible in the archive until the tournaments are marked
+    conn = _connect(_database_path())
+    try:
+        # Without AUTOINCREMENT SQLite hands out the largest id again once it is deleted
+        for table in ARCHIVED:
+            newest = conn.execute(f'SELECT max(id) FROM main."{table.name}"').fetchone()[0]
+            if newest is not None and conn.execute(
+                    f'SELECT 1 FROM main."{table.name}" WHERE id = ? AND {_row_filter(table, ids)}',
+                    [newest, *ids]).fetchone():
+                raise ArchiveError(f'Season {season} holds the newest {table.name} row; archive it once '
+                                   f'the current season has games')
+        conn.execute(f'ATTACH DATABASE ? AS {schema}', (directory.file(season),))
+        _create_tables(conn, schema)
+        conn.execute('BEGIN')
+        for table in ARCHIVED:
+            names = ', '.join(f'"{c.name}"' for c in table.c)
+            conn.execute(f'INSERT OR REPLACE INTO {schema}."{table.name}" ({names}) '
+                         f'SELECT {names} FROM main."{table.name}" WHERE {_row_filter(table, ids)}', ids)
+        counts = {table.name: conn.execute(f'SELECT count(*) FROM main."{table.name}" WHERE {_row_filter(table, ids)}',
+                                           ids).fetchone()[0] for table in ARCHIVED}
+        copied = {table.name: conn.execute(
+            f'SELECT count(*) FROM {schema}."{table.name}" WHERE {_row_filter(table, ids, schema)}', ids).fetchone()[0]
+            for table in ARCHIVED}
+        if counts != copied:
+            conn.execute('ROLLBACK')
+            raise ArchiveError(f'Archive copy is incomplete: {copied} of {counts}')
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+
+    # Then mark and delete in one transaction of the main database
+    db.session.close()
+    db.session.execute(update(Tournament).where(Tournament.id.in_(ids)).values(archive_season=season)
+                       .execution_options(synchronize_session=False))
+    round_ids = select(Round.id).where(Round.tournament_id.in_(ids))
+    for statement in (delete(Match).where(Match.tournament_id.in_(ids)),
+                      delete(RoundPairing).where(RoundPairing.round_id.in_(round_ids)),
+                      delete(Round).where(Round.tournament_id.in_(ids))):
+        db.session.execute(statement.execution_options(synchronize_session=False))
+    activity.record('season.archived', ('season', season), f'Season {season}: {len(ids)} tournaments',
+                    tournaments=ids, **counts)
+    db.session.commit()
+    return len(ids)
+
+@_moving
+def restore_season(season):
+    """Move a season's tournaments back into the main database; returns the number moved"""
+    import activity
+    directory = current_directory()
+    ids = [row.id for row in db.session.query(Tournament.id).filter(Tournament.archive_season == season)]
+    if not ids:
+        return 0
+    if season not in directory.seasons():
+        raise ArchiveError(f'The archive file of season {season} is missing')
+
+    # Copy back, unmark and delete in one transaction of the main database
+    db.session.close()
+    round_table = season_table(Round.__table__, season)
+    archived_rounds = select(round_table.c.id).where(round_table.c.tournament_id.in_(ids))
+    for table in ARCHIVED:
+        archived = season_table(table, season)
+        condition = archived.c.tournament_id.in_(ids) if 'tournament_id' in archived.c else \
+            archived.c.round_id.in_(archived_rounds)
+        db.session.execute(table.insert().from_select([c.name for c in table.c],
+                                                      select(*archived.c).where(condition)))
+    db.session.execute(update(Tournament).where(Tournament.id.in_(ids)).values(archive_season=None)
+                       .execution_options(synchronize_session=False))
+    activity.record('season.restored', ('season', season), f'Season {season}: {len(ids)} tournaments',
+                    tournaments=ids)
+    db.session.commit()
+
+    # The archived copies are invisible now; remove them
+    conn = _connect(_database_path())
+    try:
+        schema = schema_name(season)
+        conn.execute(f'ATTACH DATABASE ? AS {schema}', (directory.file(season),))
+        conn.execute('BEGIN')
+        for table in reversed(ARCHIVED):
+            conn.execute(f'DELETE FROM {schema}."{table.name}" WHERE {_row_filter(table, ids, schema)}', ids)
+        conn.execute('COMMIT')
+        empty = conn.execute(f'SELECT count(*) FROM {schema}."round"').fetchone()[0] == 0
+    finally:
+        conn.close()
+    if empty:
+        os.remove(directory.file(season))
+    return len(ids)
+
+def init_app(app):
+    app.config.setdefault('ARCHIVE_DIR', os.environ.get('ARCHIVE_DIR', os.path.join(app.instance_path, 'archive')))
+    directory = SeasonDirectory(app.config['ARCHIVE_DIR'])
+    app.extensions['archive'] = directory
+    with app.app_context():
+        engine = db.engine
+    if engine.url.get_backend_name() == 'sqlite':
+        event.listen(engine, 'checkout', _listener(directory))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Move past seasons into per-season archive files.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list')
+    for name in ('archive', 'restore'):
+        command = commands.add_parser(name)
+        command.add_argument('season', type=int)
+    args = parser.parse_args(argv)
+
+    from app import create_app
+    app = create_app()
+    with app.app_context():
+        try:
+            if args.command == 'list':
+                for season, total, archived in seasons():
+                    print(f'{season}: {total} completed tournaments, {archived} archived')
+            elif args.command == 'archive':
+                print(f'Archived {archive_season(args.season)} tournaments of {args.season}')
+            else:
+                print(f'Restored {restore_season(args.season)} tournaments of {args.season}')
+        except ArchiveError as exc:
+            print(exc, file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+"""
+Caching for static files and uploads.
+
+Every url_for('static', ...) gets a ?v=<content hash> parameter, so a file's
+URL changes whenever its content does and browsers can cache it for a year
+without revalidating.  Uploads are never overwritten (save_photo gives each
+one a timestamped name), so they are cached the same way without a hash.
+Anything requested without its current fingerprint falls back to revalidation.
+
+    python assets.py build      # write .gz (and .br, if brotli is installed) next to static files
+
+When a precompressed variant is present and newer than the original it is
+served to clients that accept it.  Range requests always get the original
+file, which werkzeug serves partially (useful for large uploads).
+"""
+import argparse
+import gzip
+import hashlib
+import mimetypes
+import os
+import sys
+from flask import current_app, request, send_from_directory
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(ROOT, 'static')
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+HASH_LENGTH = 12
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.txt', '.html', '.map')
+MIN_COMPRESS_SIZE = 256
+# Preferred order when the client accepts several encodings
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+_fingerprints = {}
+
+def fingerprint(static_folder, filename):
+    """Short content hash of a static file, cached until its mtime or size changes"""
+    path = safe_join(static_folder, filename)
+    if path is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    cached = _fingerprints.get(path)
+    if cached and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return cached[1]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    value = digest.hexdigest()[:HASH_LENGTH]
+    _fingerprints[path] = ((stat.st_mtime_ns, stat.st_size), value)
+    return value
+
+def is_upload(filename):
+    return filename.startswith('uploads/')
+
+def _add_fingerprint(endpoint, values):
+    if endpoint != 'static' or 'v' in values or is_upload(values.get('filename', '')):
+        return
+    value = fingerprint(current_app.static_folder, values['filename'])
+    if value:
+        values['v'] = value
+
+def _precompressed(static_folder, filename):
+    """The best precompressed variant the client accepts, as (encoding, filename)"""
+    if not filename.endswith(COMPRESSIBLE_EXTENSIONS) or request.range is not None:
+        return None
+    original = safe_join(static_folder, filename)
+    if original is None or not os.path.isfile(original):
+        return None
+    mtime = os.path.getmtime(original)
+    for encoding, suffix in ENCODINGS:
+        if encoding not in request.accept_encodings:
+            continue
+        variant = original + suffix
+        if os.path.isfile(variant) and os.path.getmtime(variant) >= mtime:
+            return encoding, filename + suffix
+    return None
+
+def serve_static(filename):
+    static_folder = current_app.static_folder
+    # A stale or made-up ?v= must not pin the current content in caches for a year
+    version = request.args.get('v')
+    if is_upload(filename) or (version and version == fingerprint(static_folder, filename)):
+        max_age = IMMUTABLE_MAX_AGE
+    else:
+        max_age = None
+
+    variant = _precompressed(static_folder, filename)
+    if variant:
+        encoding, variant_name = variant
+        response = send_from_directory(static_folder, variant_name, max_age=max_age,
+                                       mimetype=mimetypes.guess_type(filename)[0])
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = send_from_directory(static_folder, filename, max_age=max_age)
+
+    if filename.endswith(COMPRESSIBLE_EXTENSIONS):
+        response.vary.add('Accept-Encoding')
+    if max_age:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response
+
+def build(static_folder=STATIC_DIR):
+    """Write compressed variants of compressible static files; returns the number written"""
+    written = 0
+    for dirpath, dirnames, filenames in os.walk(static_folder):
+        dirnames[:] = [d for d in dirnames if os.path.join(dirpath, d) != os.path.join(static_folder, 'uploads')]
+        for name in filenames:
+            if not name.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            path = os.path.join(dirpath, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            if len(data) < MIN_COMPRESS_SIZE:
+                continue
+            variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+            if brotli is not None:
+                variants.append(('.br', brotli.compress(data, quality=11)))
+            for suffix, compressed in variants:
+                if len(compressed) >= len(data):
+                    continue
+                with open(path + suffix, 'wb') as f:
+                    f.write(compressed)
+                written += 1
+                print(f'{os.path.relpath(path + suffix, static_folder)}: {len(data)} -> {len(compressed)} bytes')
+    return written
+
+def clean(static_folder=STATIC_DIR):
+    removed = 0
+    for dirpath, dirnames, filenames in os.walk(static_folder):
+        for name in filenames:
+            if name.endswith(('.gz', '.br')) and name[:-3].endswith(COMPRESSIBLE_EXTENSIONS):
+                os.remove(os.path.join(dirpath, name))
+                removed += 1
+    return removed
+
+def init_app(app):
+    app.url_defaults(_add_fingerprint)
+    app.view_functions['static'] = serve_static
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Precompress static assets.')
+    parser.add_argument('command', choices=['build', 'clean'])
+    args = parser.parse_args(argv)
+    if args.command == 'build':
+        count = build()
+        note = '' if brotli is not None else ' (install brotli for .br variants)'
+        print(f'Wrote {count} compressed files{note}')
+    else:
+        print(f'Removed {clean()} compressed files')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
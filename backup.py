@@ -0,0 +1,449 @@
+"""
+Online backups of the SQLite database, the archived seasons and the upload
+directory.
+
+The database is copied with the SQLite online backup API a few pages at a
+time, so writers only wait for a single step instead of the whole copy.  The
+copy is integrity-checked, gzip-compressed and stored next to a JSON
+manifest.  The season files of archive.py are copied the same way while the
+backup holds the archive lock, so no season moves between copying the main
+database and its seasons; they rarely change, so their compressed copies are
+stored content-addressed under seasons/ and shared between backups.  Uploads
+are stored content-addressed under uploads/objects, so each backup only
+copies files that changed since the previous one and old backups share
+unchanged files.
+
+    python backup.py create
+    python backup.py list
+    python backup.py verify <name>
+    python backup.py restore <name> [--skip-uploads]
+
+Set BACKUP_INTERVAL_HOURS to let the app take backups on a schedule and
+BACKUP_KEEP to choose how many are retained (default 14).
+"""
+import argparse
+import fcntl
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Pages copied per backup step; the source is only locked while a step runs
+PAGES_PER_STEP = 256
+STEP_PAUSE = 0.005
+SEASON_FILE_PREFIX = 'season-'
+
+class BackupError(Exception):
+    pass
+
+def sqlite_path(engine):
+    if engine.url.get_backend_name() != 'sqlite' or engine.url.database in (None, '', ':memory:'):
+        return None
+    return engine.url.database
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def check_integrity(path):
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        result = conn.execute('PRAGMA integrity_check').fetchone()[0]
+        if result != 'ok':
+            raise BackupError(f'Integrity check failed for {path}: {result}')
+        tables = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+        return {table: conn.execute(f'SELECT count(*) FROM "{table}"').fetchone()[0] for table in tables}
+    finally:
+        conn.close()
+
+def copy_database(source_path, target_path, pages=PAGES_PER_STEP, pause=STEP_PAUSE):
+    """Copy a live database with the online backup API in steps of `pages` pages"""
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(target_path)
+    try:
+        # Pausing between steps lets writers in other connections take the lock
+        source.backup(target, pages=pages, progress=lambda status, remaining, total: time.sleep(pause))
+    finally:
+        target.close()
+        source.close()
+
+def archive_lock(archive_path, shared=False):
+    """Lock on the season files: exclusive while archive.py moves a season, shared while backing up"""
+    os.makedirs(archive_path, exist_ok=True)
+    handle = open(os.path.join(archive_path, '.lock'), 'w')
+    fcntl.flock(handle, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+    return handle
+
+def _fsync_replace(tmp_path, path):
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def _write_json(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    _fsync_replace(tmp_path, path)
+
+class BackupStore:
+    def __init__(self, root, database_path, uploads_path, archive_path=None):
+        self.root = root
+        self.database_path = database_path
+        self.uploads_path = uploads_path
+        self.archive_path = archive_path
+        self.objects_path = os.path.join(root, 'uploads', 'objects')
+        self.index_path = os.path.join(root, 'uploads', 'index.json')
+        self.seasons_path = os.path.join(root, 'seasons')
+
+    # Locking --------------------------------------------------------------
+
+    def lock(self, blocking=True):
+        """Exclusive lock so only one process writes to the store at a time"""
+        os.makedirs(self.root, exist_ok=True)
+        handle = open(os.path.join(self.root, '.lock'), 'w')
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            handle.close()
+            return None
+        return handle
+
+    # Listing --------------------------------------------------------------
+
+    def names(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name[:-5] for name in os.listdir(self.root)
+                      if name.startswith('backup-') and name.endswith('.json'))
+
+    def manifest(self, name):
+        path = os.path.join(self.root, name + '.json')
+        if not os.path.exists(path):
+            raise BackupError(f'No backup named {name}')
+        with open(path) as f:
+            return json.load(f)
+
+    def latest_time(self):
+        names = self.names()
+        if not names:
+            return None
+        return datetime.strptime(names[-1], 'backup-%Y%m%dT%H%M%SZ')
+
+    # Uploads --------------------------------------------------------------
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_path, digest[:2], digest)
+
+    def sync_uploads(self):
+        """Copy new or changed uploads into the object store, return {relative path: sha256}"""
+        previous = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                previous = json.load(f)
+
+        index = {}
+        copied = 0
+        for root, _, files in os.walk(self.uploads_path):
+            for filename in files:
+                path = os.path.join(root, filename)
+                relative = os.path.relpath(path, self.uploads_path)
+                stat = os.stat(path)
+                known = previous.get(relative)
+                if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+                    index[relative] = known
+                    continue
+                digest = file_sha256(path)
+                target = self._object_path(digest)
+                if not os.path.exists(target):
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    shutil.copy2(path, target + '.tmp')
+                    _fsync_replace(target + '.tmp', target)
+                    copied += 1
+                index[relative] = {'sha256': digest, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        _write_json(self.index_path, index)
+        return {relative: entry['sha256'] for relative, entry in index.items()}, copied
+
+    # Seasons --------------------------------------------------------------
+
+    def _season_path(self, digest):
+        return os.path.join(self.seasons_path, digest + '.db.gz')
+
+    def season_files(self):
+        if not self.archive_path or not os.path.isdir(self.archive_path):
+            return []
+        return sorted(name for name in os.listdir(self.archive_path)
+                      if name.startswith(SEASON_FILE_PREFIX) and name.endswith('.db'))
+
+    def copy_seasons(self, workdir):
+        """Copy every season file into the store; the caller holds the archive lock"""
+        seasons = {}
+        for filename in self.season_files():
+            copy_path = os.path.join(workdir, filename)
+            copy_database(os.path.join(self.archive_path, filename), copy_path)
+            digest = file_sha256(copy_path)
+            target = self._season_path(digest)
+            if not os.path.exists(target):
+                os.makedirs(self.seasons_path, exist_ok=True)
+                with open(copy_path, 'rb') as src, gzip.open(target + '.tmp', 'wb', compresslevel=6) as dst:
+                    shutil.copyfileobj(src, dst, 1 << 20)
+                _fsync_replace(target + '.tmp', target)
+            seasons[filename] = {
+                'sha256': digest,
+                'size': os.path.getsize(copy_path),
+                'tables': check_integrity(copy_path),
+            }
+        return seasons
+
+    # Create / prune -------------------------------------------------------
+
+    def create(self, keep=None):
+        name = datetime.utcnow().strftime('backup-%Y%m%dT%H%M%SZ')
+        if os.path.exists(os.path.join(self.root, name + '.json')):
+            raise BackupError(f'Backup {name} already exists')
+        os.makedirs(self.root, exist_ok=True)
+        started = time.monotonic()
+
+        with tempfile.TemporaryDirectory(dir=self.root) as workdir:
+            copy_path = os.path.join(workdir, 'copy.db')
+            lock = archive_lock(self.archive_path, shared=True) if self.archive_path else None
+            try:
+                copy_database(self.database_path, copy_path)
+                seasons = self.copy_seasons(workdir)
+            finally:
+                if lock:
+                    lock.close()
+            tables = check_integrity(copy_path)
+            database_sha256 = file_sha256(copy_path)
+            database_size = os.path.getsize(copy_path)
+
+            archive = os.path.join(self.root, name + '.db.gz')
+            with open(copy_path, 'rb') as src, gzip.open(archive + '.tmp', 'wb', compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            _fsync_replace(archive + '.tmp', archive)
+
+        uploads, copied = self.sync_uploads() if self.uploads_path else ({}, 0)
+        manifest = {
+            'name': name,
+            'created': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+            'database': {
+                'file': name + '.db.gz',
+                'sha256': database_sha256,
+                'size': database_size,
+                'compressed_size': os.path.getsize(os.path.join(self.root, name + '.db.gz')),
+                'tables': tables,
+            },
+            'seasons': seasons,
+            'uploads': uploads,
+            'uploads_copied': copied,
+            'seconds': round(time.monotonic() - started, 3),
+        }
+        # The manifest is written last; a backup without one is incomplete
+        _write_json(os.path.join(self.root, name + '.json'), manifest)
+        if keep:
+            self.prune(keep)
+        return manifest
+
+    def prune(self, keep):
+        names = self.names()
+        for name in names[:-keep] if keep < len(names) else []:
+            for suffix in ('.json', '.db.gz'):
+                try:
+                    os.remove(os.path.join(self.root, name + suffix))
+                except FileNotFoundError:
+                    pass
+
+        # Drop upload objects and season copies no remaining backup refers to
+        referenced = set()
+        seasons = set()
+        for name in self.names():
+            manifest = self.manifest(name)
+            referenced.update(manifest['uploads'].values())
+            seasons.update(entry['sha256'] for entry in manifest.get('seasons', {}).values())
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                referenced.update(entry['sha256'] for entry in json.load(f).values())
+        for root, _, files in os.walk(self.objects_path):
+            for filename in files:
+                if filename not in referenced:
+                    os.remove(os.path.join(root, filename))
+        if os.path.isdir(self.seasons_path):
+            for filename in os.listdir(self.seasons_path):
+                if filename.endswith('.db.gz') and filename[:-len('.db.gz')] not in seasons:
+                    os.remove(os.path.join(self.seasons_path, filename))
+
+    # Verify / restore -----------------------------------------------------
+
+    def _extract(self, name, workdir):
+        manifest = self.manifest(name)
+        path = os.path.join(workdir, 'restore.db')
+        with gzip.open(os.path.join(self.root, manifest['database']['file']), 'rb') as src, open(path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        if file_sha256(path) != manifest['database']['sha256']:
+            raise BackupError(f'Checksum mismatch in {name}')
+        tables = check_integrity(path)
+        if tables != manifest['database']['tables']:
+            raise BackupError(f'Row counts in {name} do not match its manifest')
+        for relative, digest in manifest['uploads'].items():
+            if not os.path.exists(self._object_path(digest)):
+                raise BackupError(f'Upload {relative} of {name} is missing from the object store')
+        seasons = {}
+        for filename, entry in manifest.get('seasons', {}).items():
+            season_path = os.path.join(workdir, filename)
+            try:
+                with gzip.open(self._season_path(entry['sha256']), 'rb') as src, open(season_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1 << 20)
+            except FileNotFoundError:
+                raise BackupError(f'Season file {filename} of {name} is missing from the store')
+            if file_sha256(season_path) != entry['sha256']:
+                raise BackupError(f'Checksum mismatch in {filename} of {name}')
+            if check_integrity(season_path) != entry['tables']:
+                raise BackupError(f'Row counts in {filename} of {name} do not match its manifest')
+            seasons[filename] = season_path
+        return manifest, path, seasons
+
+    def verify(self, name):
+        with tempfile.TemporaryDirectory(dir=self.root) as workdir:
+            manifest, _, _ = self._extract(name, workdir)
+        return manifest
+
+    def restore(self, name, uploads=True):
+        with tempfile.TemporaryDirectory(dir=self.root) as workdir:
+            manifest, path, seasons = self._extract(name, workdir)
+            if seasons and not self.archive_path:
+                raise BackupError(f'{name} has archived seasons but there is no archive directory to restore them to')
+            lock = archive_lock(self.archive_path) if self.archive_path else None
+            try:
+                # Writing through the backup API keeps the live file consistent for open connections
+                copy_database(path, self.database_path, pages=-1)
+                for filename, season_path in seasons.items():
+                    copy_database(season_path, os.path.join(self.archive_path, filename), pages=-1)
+            finally:
+                if lock:
+                    lock.close()
+        tables = check_integrity(self.database_path)
+        if tables != manifest['database']['tables']:
+            raise BackupError('Restored database does not match the backup manifest')
+        for filename, entry in manifest.get('seasons', {}).items():
+            if check_integrity(os.path.join(self.archive_path, filename)) != entry['tables']:
+                raise BackupError(f'Restored {filename} does not match the backup manifest')
+
+        restored = 0
+        if uploads and self.uploads_path:
+            for relative, digest in manifest['uploads'].items():
+                target = os.path.join(self.uploads_path, relative)
+                if os.path.exists(target) and file_sha256(target) == digest:
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copy2(self._object_path(digest), target)
+                restored += 1
+        return manifest, restored
+
+def store_for(app):
+    from app import db
+    with app.app_context():
+        database_path = sqlite_path(db.engine)
+    if database_path is None:
+        raise BackupError('Backups are only supported for SQLite databases')
+    return BackupStore(app.config['BACKUP_DIR'], database_path,
+                       os.path.join(app.root_path, 'static', 'uploads'), app.config.get('ARCHIVE_DIR'))
+
+class BackupScheduler(threading.Thread):
+    """Takes a backup every BACKUP_INTERVAL_HOURS; safe to start in every worker process"""
+
+    def __init__(self, app):
+        super().__init__(name='backup-scheduler', daemon=True)
+        self.app = app
+        self.interval = app.config['BACKUP_INTERVAL_HOURS'] * 3600
+
+    def run(self):
+        while True:
+            try:
+                self.tick()
+            except Exception:
+                logger.exception('Scheduled backup failed')
+            time.sleep(min(self.interval, 300))
+
+    def tick(self):
+        store = store_for(self.app)
+        handle = store.lock(blocking=False)
+        if handle is None:
+            return  # another process is taking a backup
+        try:
+            latest = store.latest_time()
+            if latest and (datetime.utcnow() - latest).total_seconds() < self.interval:
+                return
+            manifest = store.create(keep=self.app.config['BACKUP_KEEP'])
+            logger.info('Backup %s written in %.1fs', manifest['name'], manifest['seconds'])
+        finally:
+            handle.close()
+
+def init_app(app):
+    app.config.setdefault('BACKUP_DIR', os.environ.get('BACKUP_DIR', os.path.join(app.instance_path, 'backups')))
+    app.config.setdefault('BACKUP_KEEP', int(os.environ.get('BACKUP_KEEP', 14)))
+    app.config.setdefault('BACKUP_INTERVAL_HOURS', float(os.environ.get('BACKUP_INTERVAL_HOURS', 0)))
+    if app.config['BACKUP_INTERVAL_HOURS'] > 0:
+        BackupScheduler(app).start()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Create, verify and restore backups.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('create')
+    commands.add_parser('list')
+    verify_parser = commands.add_parser('verify')
+    verify_parser.add_argument('name')
+    restore_parser = commands.add_parser('restore')
+    restore_parser.add_argument('name')
+    restore_parser.add_argument('--skip-uploads', action='store_true')
+    args = parser.parse_args(argv)
+
+    from app import create_app
+    app = create_app()
+    store = store_for(app)
+    try:
+        if args.command == 'create':
+            handle = store.lock()
+            try:
+                manifest = store.create(keep=app.config['BACKUP_KEEP'])
+            finally:
+                handle.close()
+            print(f"Created {manifest['name']} ({manifest['database']['compressed_size']} bytes, "
+                  f"{manifest['uploads_copied']} new uploads) in {manifest['seconds']}s")
+        elif args.command == 'list':
+            for name in store.names():
+                manifest = store.manifest(name)
+                print(f"{name}  {manifest['database']['compressed_size']:>12} bytes  "
+                      f"{len(manifest.get('seasons', {}))} seasons  {len(manifest['uploads'])} uploads")
+        elif args.command == 'verify':
+            store.verify(args.name)
+            print(f'{args.name} is intact')
+        elif args.command == 'restore':
+            handle = store.lock()
+            try:
+                manifest, restored = store.restore(args.name, uploads=not args.skip_uploads)
+            finally:
+                handle.close()
+            print(f"Restored {manifest['name']} and verified "
+                  f"{sum(manifest['database']['tables'].values())} rows; {restored} uploads restored")
+    except BackupError as e:
+        print(f'Error: {e}', file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
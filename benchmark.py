@@ -0,0 +1,249 @@
+"""
+Benchmark suite for the hot paths of the application.
+
+Builds a throwaway SQLite database filled by synthetic_data.generate(), times
+each case and writes a JSON report.  When a baseline file exists the run is
+compared against it and the process exits non-zero on a regression.  The
+cold start cases import the app and a CLI script in a fresh interpreter; the
+app's cold start also has to stay under --cold-start-budget.
+
+    python benchmark.py --scale 1k                  # run and compare against the baseline
+    python benchmark.py --scale 10k --save          # run and store the result as the new baseline
+    python benchmark.py --scale 1k --only players   # run a subset of the cases
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# Relative slowdown of the p50 latency that counts as a regression
+DEFAULT_TOLERANCE = 0.25
+# Budget for a fresh interpreter importing the WSGI app (python -c 'import main')
+COLD_START_BUDGET_MS = 1800
+# Scripts and the app used for the cold start cases
+COLD_START_MODULES = {'cold_start_app': 'main', 'cold_start_cli': 'create_admin'}
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    k = (len(ordered) - 1) * pct / 100
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+def summarize(samples, queries):
+    return {
+        'iterations': len(samples),
+        'mean_ms': round(sum(samples) / len(samples), 3) if samples else 0.0,
+        'p50_ms': round(percentile(samples, 50), 3),
+        'p90_ms': round(percentile(samples, 90), 3),
+        'p99_ms': round(percentile(samples, 99), 3),
+        'max_ms': round(max(samples), 3) if samples else 0.0,
+        'queries_per_iteration': round(sum(queries) / len(queries), 2) if queries else 0.0,
+    }
+
+class QueryCounter:
+    """Counts statements sent to the database through SQLAlchemy"""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+class Runner:
+    def __init__(self, counter, iterations):
+        self.counter = counter
+        self.iterations = iterations
+        self.results = {}
+
+    def time(self, name, func, iterations=None, setup=None):
+        samples = []
+        queries = []
+        for i in range(iterations or self.iterations):
+            arg = setup(i) if setup else None
+            before = self.counter.count
+            start = time.perf_counter()
+            func(arg) if setup else func()
+            samples.append((time.perf_counter() - start) * 1000)
+            queries.append(self.counter.count - before)
+        self.results[name] = summarize(samples, queries)
+        print(f"  {name:<24} p50 {self.results[name]['p50_ms']:>9.3f} ms  "
+              f"p99 {self.results[name]['p99_ms']:>9.3f} ms  "
+              f"{self.results[name]['queries_per_iteration']:>7} queries")
+
+def run_cases(app, summary, iterations, only):
+    from app import db
+    from glicko import Glicko2
+    from models import Player, TournamentPlayer
+    from pairing import swiss_pairing, macmahon_pairing, round_robin_pairing
+
+    rng = random.Random(summary['seed'])
+    with app.app_context():
+        counter = QueryCounter(db.engine)
+    runner = Runner(counter, iterations)
+    selected = lambda name: not only or name in only
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(summary['admin_id'])
+        session['_fresh'] = True
+
+    if selected('glicko_rate'):
+        glicko2 = Glicko2()
+        outcomes = [(rng.gauss(1500, 300), rng.uniform(50, 350), rng.choice([0.0, 0.5, 1.0])) for _ in range(5)]
+        runner.time('glicko_rate', lambda: glicko2.rate(1500, 200, 0.06, outcomes), iterations=iterations * 100)
+
+    with app.app_context():
+        field = Player.query.join(TournamentPlayer).filter(
+            TournamentPlayer.tournament_id == summary['completed_tournaments'][0]
+        ).all()
+        if selected('swiss_pairing'):
+            runner.time('swiss_pairing', lambda: swiss_pairing(field))
+        if selected('macmahon_pairing'):
+            runner.time('macmahon_pairing', lambda: macmahon_pairing(field))
+        if selected('round_robin_pairing'):
+            runner.time('round_robin_pairing', lambda: round_robin_pairing(field))
+
+    def get(url):
+        response = client.get(url)
+        assert response.status_code == 200, f'{url} returned {response.status_code}'
+
+    if selected('player_stats'):
+        runner.time('player_stats', get,
+                    setup=lambda i: f"/player/{rng.randint(1, summary['players'])}")
+    if selected('tournament_details'):
+        runner.time('tournament_details', get,
+                    setup=lambda i: f"/tournament/{rng.choice(summary['completed_tournaments'])}")
+    if selected('players'):
+        runner.time('players', lambda: get('/players'), iterations=max(3, iterations // 10))
+
+    if selected('complete_tournament'):
+        # Completing a tournament is destructive, so every iteration uses a different one
+        ongoing = list(summary['ongoing_tournaments'])
+
+        def complete(tournament_id):
+            response = client.post(f'/tournament/{tournament_id}/complete')
+            assert response.status_code == 302, f'complete_tournament returned {response.status_code}'
+
+        runner.time('complete_tournament', complete,
+                    iterations=min(iterations, len(ongoing)),
+                    setup=lambda i: ongoing[i])
+
+    # Cold start of a worker or CLI script, measured in a fresh interpreter each time
+    env = dict(os.environ, SQLALCHEMY_DATABASE_URI=app.config['SQLALCHEMY_DATABASE_URI'])
+    for name, module in COLD_START_MODULES.items():
+        if selected(name):
+            runner.time(name, lambda: subprocess.run([sys.executable, '-c', f'import {module}'],
+                                                     cwd=ROOT, env=env, check=True),
+                        iterations=max(5, iterations // 10))
+
+    return runner.results
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    print(f"\n{'case':<24} {'baseline p50':>13} {'current p50':>13} {'ratio':>7} {'queries':>15}")
+    for name, current in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if previous is None:
+            print(f'{name:<24} {"(new)":>13} {current["p50_ms"]:>13.3f}')
+            continue
+        ratio = current['p50_ms'] / previous['p50_ms'] if previous['p50_ms'] else 1.0
+        queries = f"{previous['queries_per_iteration']} -> {current['queries_per_iteration']}"
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  SLOWER'
+            regressions.append(name)
+        if current['queries_per_iteration'] > previous['queries_per_iteration']:
+            flag += '  MORE QUERIES'
+            if name not in regressions:
+                regressions.append(name)
+        print(f"{name:<24} {previous['p50_ms']:>13.3f} {current['p50_ms']:>13.3f} {ratio:>7.2f} {queries:>15}{flag}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths against synthetic data.')
+    parser.add_argument('--scale', default='1k', choices=['1k', '10k', '100k'])
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--only', nargs='*', help='Names of the cases to run')
+    parser.add_argument('--baseline', help='Baseline JSON file (default: benchmark_baseline_<scale>.json)')
+    parser.add_argument('--output', help='Also write this run to the given JSON file')
+    parser.add_argument('--save', action='store_true', help='Store this run as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--cold-start-budget', type=float, default=COLD_START_BUDGET_MS,
+                        help='Maximum p50 in ms for importing the app in a fresh interpreter')
+    args = parser.parse_args(argv)
+
+    baseline_path = args.baseline or f'benchmark_baseline_{args.scale}.json'
+    workdir = tempfile.mkdtemp(prefix='igd-bench-')
+
+    from app import create_app, db
+    import synthetic_data
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        'WTF_CSRF_ENABLED': False,
+    })
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print(f'Generating {args.scale} dataset in {workdir} ...')
+    start = time.perf_counter()
+    with app.app_context():
+        db.create_all()
+        summary = synthetic_data.generate(args.scale, seed=args.seed)
+    print(f"  {summary['players']} players, {summary['tournaments']} tournaments, "
+          f"{summary['matches']} matches in {time.perf_counter() - start:.1f}s")
+
+    print('Running benchmarks ...')
+    results = run_cases(app, summary, args.iterations, args.only)
+    report = {
+        'meta': {
+            'scale': args.scale,
+            'seed': args.seed,
+            'iterations': args.iterations,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'created': datetime.utcnow().isoformat(timespec='seconds'),
+        },
+        'dataset': {k: v for k, v in summary.items() if not isinstance(v, list)},
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    regressions = []
+    cold_start = results.get('cold_start_app')
+    if cold_start and cold_start['p50_ms'] > args.cold_start_budget:
+        print(f"\nCold start p50 {cold_start['p50_ms']:.0f} ms is over the {args.cold_start_budget:.0f} ms budget")
+        regressions.append('cold_start_app')
+
+    if args.save or not os.path.exists(baseline_path):
+        with open(baseline_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'\nBaseline written to {baseline_path}')
+    else:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        regressions += [name for name in compare(results, baseline, args.tolerance) if name not in regressions]
+        if not regressions:
+            print('\nNo regressions against the baseline.')
+    if regressions:
+        print(f"\nRegressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,51 @@
+"""
+Gzip compression of dynamic responses.
+
+HTML and JSON pages such as the player list compress to a fraction of their
+size.  Responses are compressed when the client accepts gzip, the body is at
+least COMPRESS_MIN_SIZE bytes and its mimetype is in COMPRESS_MIMETYPES.
+Files sent from disk are left alone: static assets are precompressed at build
+time (see assets.py) and uploads are mostly images.
+"""
+import gzip
+import os
+from flask import current_app, request
+
+DEFAULT_MIMETYPES = frozenset([
+    'text/html', 'text/css', 'text/plain', 'text/csv', 'text/xml', 'text/javascript',
+    'application/json', 'application/javascript', 'application/xml', 'image/svg+xml',
+])
+
+def _should_compress(response, config):
+    if response.direct_passthrough or response.is_streamed:
+        return False
+    if response.status_code < 200 or response.status_code >= 300 or response.status_code == 206:
+        return False
+    if 'Content-Encoding' in response.headers:
+        return False
+    if response.cache_control.no_transform:
+        return False
+    return response.content_length is not None and response.content_length >= config['COMPRESS_MIN_SIZE']
+
+def _compress_response(response):
+    config = current_app.config
+    if response.mimetype not in config['COMPRESS_MIMETYPES']:
+        return response
+    response.vary.add('Accept-Encoding')
+    if 'gzip' not in request.accept_encodings or not _should_compress(response, config):
+        return response
+    response.set_data(gzip.compress(response.get_data(), compresslevel=config['COMPRESS_LEVEL']))
+    response.headers['Content-Encoding'] = 'gzip'
+    # The compressed body is a different byte sequence, so a strong validator no longer applies
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+def init_app(app):
+    app.config.setdefault('COMPRESS_MIN_SIZE', int(os.environ.get('COMPRESS_MIN_SIZE', 1024)))
+    app.config.setdefault('COMPRESS_LEVEL', int(os.environ.get('COMPRESS_LEVEL', 6)))
+    app.config.setdefault('COMPRESS_MIMETYPES', DEFAULT_MIMETYPES)
+    if app.config['COMPRESS_MIN_SIZE'] < 0:
+        return
+    app.after_request(_compress_response)
@@ -1,8 +1,9 @@
 from werkzeug.security import generate_password_hash
-from app import db, app
+from app import create_app, db
 from models import User
 
 def create_admin_user(username='admin', password='666666'):
+    app = create_app()
     with app.app_context():
         user = User.query.filter_by(username=username).first()
         if user is None:
@@ -0,0 +1,108 @@
+"""
+SQLite settings for running under several worker processes.
+
+Every new SQLite connection is switched to WAL mode so readers never wait for
+the writer, and gets a busy timeout instead of failing immediately on a
+locked database.  WAL still allows only one writer, and two transactions that
+both read before writing can deadlock with "database is locked" regardless of
+the timeout.  With SERIALIZE_WRITES enabled, requests that can write (any
+method other than GET/HEAD/OPTIONS) therefore take a process-wide lock and an
+inter-process file lock for their duration, while reads run in parallel.
+Endpoints that only queue their writes for a background writer (public
+registration, see registration.py) skip the lock; the writer takes it once
+per batch instead.
+"""
+import fcntl
+import os
+import sqlite3
+import threading
+from flask import g, request
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine import Engine
+
+SAFE_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+BUSY_TIMEOUT_MS = 10_000
+# Write-method endpoints that never write to the database in the request
+QUEUED_WRITE_ENDPOINTS = frozenset(['main.register'])
+
+def _configure_sqlite(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    cursor.close()
+
+def add_missing_columns(engine, metadata):
+    """ALTER existing tables to add model columns they lack; returns the added 'table.column' names"""
+    inspector = inspect(engine)
+    added = []
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column.type.compile(engine.dialect)}'
+                if column.server_default is not None:
+                    default = column.server_default.arg
+                    if hasattr(default, 'text'):
+                        ddl += f' DEFAULT {default.text}'
+                    else:
+                        ddl += " DEFAULT '{}'".format(str(default).replace("'", "''"))
+                    if not column.nullable:
+                        ddl += ' NOT NULL'
+                conn.execute(text(ddl))
+                added.append(f'{table.name}.{column.name}')
+            # Indexes on the new columns; create_all only makes them for new tables
+            for index in table.indexes:
+                if any(f'{table.name}.{column.name}' in added for column in index.columns):
+                    index.create(conn, checkfirst=True)
+    return added
+
+class WriteSerializer:
+    """Lets one write request at a time run, across threads and worker processes"""
+
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self._thread_lock = threading.Lock()
+        self._file = None
+
+    def acquire(self):
+        self._thread_lock.acquire()
+        try:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+                self._file = open(self.lock_path, 'a')
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        except BaseException:
+            self._thread_lock.release()
+            raise
+
+    def release(self):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+def init_app(app):
+    app.config.setdefault('SERIALIZE_WRITES', os.environ.get('SERIALIZE_WRITES', '0') == '1')
+    if not event.contains(Engine, 'connect', _configure_sqlite):
+        event.listen(Engine, 'connect', _configure_sqlite)
+
+    if not app.config['SERIALIZE_WRITES']:
+        return
+    serializer = WriteSerializer(os.path.join(app.instance_path, 'write.lock'))
+    app.extensions['write_serializer'] = serializer
+
+    @app.before_request
+    def _serialize_writes():
+        if request.method not in SAFE_METHODS and request.endpoint not in QUEUED_WRITE_ENDPOINTS:
+            serializer.acquire()
+            g.holds_write_lock = True
+
+    @app.teardown_request
+    def _release_write_lock(exc):
+        if g.pop('holds_write_lock', False):
+            serializer.release()
@@ -0,0 +1,376 @@
+"""
+Duplicate players and merging them.
+
+Comparing every player with every other one is quadratic, so each player
+gets a few blocking keys in PlayerKey and only players sharing a key are
+compared:
+
+    name:<soundex>-<soundex>    Soundex of first and last name, in either order
+    phone:<digits>              the last 10 digits of the phone number
+    email:<address>             lowercased, without a +tag
+    state:<state>:<soundex>     state and the Soundex of the last name
+
+The keys are rewritten in the flush that changes a player, so the index is
+always current; rows loaded in bulk (synthetic_data.py) skip the ORM and
+are indexed with rebuild_keys(), which init-db also runs when the index is
+empty, e.g. on a registry that predates it.  A key shared by more than MAX_BLOCK
+players (a common surname in a big state) says too little and is skipped.
+Candidate pairs are scored on name similarity, phone, email, birth date and
+state; pairs that have played each other or entered the same tournament
+are never duplicates.
+
+merge() moves everything of one player to the other in one transaction:
+tournament entries, pairings and matches (archived seasons included), game
+records and head-to-head rows.  The kept player's rating is then replayed
+from their completed rounds in order, one Glicko-2 period per round with
+each opponent's rating before that round as logged by results.py:
+
+    python dedup.py candidates
+    python dedup.py merge KEEP_ID REMOVE_ID
+    python dedup.py rebuild-keys
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import unicodedata
+from collections import namedtuple
+from difflib import SequenceMatcher
+from sqlalchemy import and_, delete, event, func, insert, inspect, or_, select
+from sqlalchemy.orm import Session, aliased
+from app import db
+from glicko import Glicko2
+from models import (ActivityEvent, GameRecord, HeadToHead, Match, Player, PlayerKey, Registration, RoundPairing,
+                    TournamentPlayer)
+from archive import pairing_history, round_history
+import activity
+import archive
+import head_to_head
+import results
+
+MAX_BLOCK = 200
+THRESHOLD = 0.6
+# The columns the keys are built from
+KEY_FIELDS = ('first_name', 'last_name', 'state', 'email', 'phone')
+# Filled in on the kept player when they are empty there
+MERGED_FIELDS = ('middle_name', 'state', 'birth_date', 'email', 'phone', 'player_photo', 'id_card_photo')
+# Player's column defaults, the rating of someone who has never played
+START_RATING = (1500, 350, 0.06)
+
+SOUNDEX_CODES = {letter: str(code) for code, letters in
+                 enumerate(('AEIOUY', 'BFPV', 'CGJKQSXZ', 'DT', 'L', 'MN', 'R')) for letter in letters}
+
+Candidate = namedtuple('Candidate', 'score first second reasons')
+
+class MergeError(Exception):
+    pass
+
+def _fold(text):
+    """Lowercase letters and spaces only, accents dropped"""
+    text = unicodedata.normalize('NFKD', text or '')
+    return ' '.join(''.join(c for c in text.lower() if c.isalpha() or c.isspace()).split())
+
+def soundex(text):
+    letters = [c for c in _fold(text).upper() if 'A' <= c <= 'Z']
+    if not letters:
+        return ''
+    code = [letters[0]]
+    last = SOUNDEX_CODES.get(letters[0])
+    for letter in letters[1:]:
+        digit = SOUNDEX_CODES.get(letter)
+        if digit and digit != '0' and digit != last:
+            code.append(digit)
+        if letter not in 'HW':
+            last = digit
+    return ''.join(code)[:4].ljust(4, '0')
+
+def normal_phone(phone):
+    digits = re.sub(r'\D', '', phone or '')
+    return digits[-10:] if len(digits) >= 7 else None
+
+def normal_email(email):
+    local, _, domain = (email or '').strip().lower().partition('@')
+    local = local.split('+')[0]
+    return f'{local}@{domain}' if local and domain else None
+
+def blocking_keys(player):
+    keys = set()
+    first, last = soundex(player.first_name), soundex(player.last_name)
+    if first and last:
+        keys.add('name:' + '-'.join(sorted((first, last))))
+    phone, email = normal_phone(player.phone), normal_email(player.email)
+    if phone:
+        keys.add('phone:' + phone)
+    if email:
+        keys.add('email:' + email)
+    if player.state and last:
+        keys.add(f'state:{_fold(player.state)}:{last}')
+    return {key[:80] for key in keys}
+
+def _write_keys(connection, players):
+    connection.execute(delete(PlayerKey.__table__).where(PlayerKey.player_id.in_([p.id for p in players])))
+    rows = [{'key': key, 'player_id': p.id} for p in players for key in blocking_keys(p)]
+    if rows:
+        connection.execute(insert(PlayerKey.__table__), rows)
+
+def _after_flush(session, flush_context):
+    changed = [obj for obj in session.new if isinstance(obj, Player)]
+    changed += [obj for obj in session.dirty if isinstance(obj, Player) and
+                any(inspect(obj).attrs[field].history.has_changes() for field in KEY_FIELDS)]
+    deleted = [obj.id for obj in session.deleted if isinstance(obj, Player)]
+    if changed:
+        _write_keys(session.connection(), changed)
+    if deleted:
+        session.connection().execute(delete(PlayerKey.__table__).where(PlayerKey.player_id.in_(deleted)))
+
+def rebuild_keys():
+    """Rewrite every player's keys; returns the number of keys"""
+    db.session.execute(delete(PlayerKey))
+    rows = [{'key': key, 'player_id': p.id}
+            for p in db.session.query(Player.id, *(getattr(Player, field) for field in KEY_FIELDS))
+            for key in blocking_keys(p)]
+    if rows:
+        db.session.execute(insert(PlayerKey), rows)
+    db.session.commit()
+    return len(rows)
+
+# Candidates ----------------------------------------------------------------
+
+def _name_ratio(first, second):
+    a = _fold(f'{first.first_name or ""} {first.last_name or ""}')
+    b = _fold(f'{second.first_name or ""} {second.last_name or ""}')
+    swapped = _fold(f'{second.last_name or ""} {second.first_name or ""}')
+    if not a or not b:
+        return 0.0
+    return max(SequenceMatcher(None, a, b).ratio(), SequenceMatcher(None, a, swapped).ratio())
+
+def score(first, second):
+    """(score between 0 and 1, reasons) for two players being the same person"""
+    reasons = []
+    ratio = _name_ratio(first, second)
+    total = 0.5 * ratio
+    if ratio == 1:
+        reasons.append('same name')
+    elif ratio >= 0.8:
+        reasons.append('similar name')
+    if normal_phone(first.phone) and normal_phone(first.phone) == normal_phone(second.phone):
+        total += 0.25
+        reasons.append('same phone')
+    if normal_email(first.email) and normal_email(first.email) == normal_email(second.email):
+        total += 0.25
+        reasons.append('same email')
+    if first.birth_date and second.birth_date:
+        if first.birth_date == second.birth_date:
+            total += 0.15
+            reasons.append('same birth date')
+        else:
+            total -= 0.3
+    if first.state and _fold(first.state) == _fold(second.state):
+        total += 0.05
+        reasons.append('same state')
+    return round(max(min(total, 1.0), 0.0), 2), reasons
+
+def candidate_pairs():
+    """(lower id, higher id) of players sharing a blocking key, skipping oversized blocks"""
+    blocks = select(PlayerKey.key).group_by(PlayerKey.key).having(func.count().between(2, MAX_BLOCK))
+    a, b = aliased(PlayerKey), aliased(PlayerKey)
+    return db.session.query(a.player_id, b.player_id) \
+        .join(b, and_(b.key == a.key, b.player_id > a.player_id)) \
+        .filter(a.key.in_(blocks)).distinct().all()
+
+def candidates(threshold=THRESHOLD, limit=None):
+    """Likely duplicates as Candidates, most likely first"""
+    pairs = candidate_pairs()
+    ids = {player_id for pair in pairs for player_id in pair}
+    if not ids:
+        return []
+    players = {p.id: p for p in Player.query.filter(Player.id.in_(ids))}
+    entered = {}
+    for player_id, tournament_id in db.session.query(TournamentPlayer.player_id, TournamentPlayer.tournament_id) \
+            .filter(TournamentPlayer.player_id.in_(ids)):
+        entered.setdefault(player_id, set()).add(tournament_id)
+    met = set(db.session.query(HeadToHead.low_player_id, HeadToHead.high_player_id)
+              .filter(HeadToHead.low_player_id.in_(ids), HeadToHead.high_player_id.in_(ids)))
+    found = []
+    for low, high in pairs:
+        if (low, high) in met or entered.get(low, set()) & entered.get(high, set()):
+            continue
+        value, reasons = score(players[low], players[high])
+        if value >= threshold:
+            found.append(Candidate(value, players[low], players[high], reasons))
+    found.sort(key=lambda c: (-c.score, c.first.id, c.second.id))
+    return found[:limit] if limit is not None else found
+
+# Merging -------------------------------------------------------------------
+
+def _rated_events(player_ids):
+    """The 'player.rated' details of players, oldest first, as (player id, details) pairs"""
+    rows = db.session.query(ActivityEvent.entity_id, ActivityEvent.details).filter(
+        ActivityEvent.entity_type == 'player', ActivityEvent.entity_id.in_(list(player_ids)),
+        ActivityEvent.action == 'player.rated').order_by(ActivityEvent.id)
+    return [(player_id, json.loads(details)) for player_id, details in rows if details]
+
+def _start(player_id, seed_ids, events):
+    """Rating, deviation and volatility before the player's first rated round"""
+    for event_player_id, details in events:
+        if event_player_id in seed_ids and details.get('old_rating') is not None:
+            return details['old_rating'], details.get('old_deviation', START_RATING[1]), START_RATING[2]
+    initial = db.session.query(TournamentPlayer.initial_rating).filter(
+        TournamentPlayer.player_id == player_id, TournamentPlayer.initial_rating.isnot(None)) \
+        .order_by(TournamentPlayer.id).first()
+    if initial is not None:
+        return initial[0], START_RATING[1], START_RATING[2]
+    return START_RATING
+
+def replay(player_id, seed_ids=()):
+    """(rating, deviation, volatility, rounds rated) from the player's completed rounds, oldest first
+
+    seed_ids are the players whose earliest logged rating is the starting point.
+    """
+    rows = db.session.execute(
+        select(round_history.c.id, round_history.c.tournament_id, round_history.c.number,
+               pairing_history.c.white_player_id, pairing_history.c.black_player_id, pairing_history.c.result)
+        .join_from(pairing_history, round_history, round_history.c.id == pairing_history.c.round_id)
+        .where(round_history.c.status == 'completed', pairing_history.c.result.isnot(None),
+               or_(pairing_history.c.white_player_id == player_id, pairing_history.c.black_player_id == player_id))
+        .order_by(round_history.c.id)).all()
+    opponent_ids = {row.black_player_id if row.white_player_id == player_id else row.white_player_id
+                    for row in rows}
+    seed_ids = set(seed_ids) or {player_id}
+    events = _rated_events(opponent_ids | seed_ids)
+    before = {}
+    for event_player_id, details in events:
+        if details.get('old_rating') is not None:
+            before.setdefault((event_player_id, details.get('tournament_id'), details.get('round')), details)
+    current = {row.id: (row.rating, row.rating_deviation)
+               for row in db.session.query(Player.id, Player.rating, Player.rating_deviation)
+               .filter(Player.id.in_(opponent_ids))} if opponent_ids else {}
+
+    rating, deviation, volatility = _start(player_id, seed_ids, events)
+    glicko2 = Glicko2()
+    periods = 0
+    position = 0
+    while position < len(rows):
+        round_id = rows[position].id
+        outcomes = []
+        while position < len(rows) and rows[position].id == round_id:
+            row = rows[position]
+            position += 1
+            white_score, black_score = results.game_scores(row.result)
+            if row.white_player_id == player_id:
+                opponent_id, player_score = row.black_player_id, white_score
+            else:
+                opponent_id, player_score = row.white_player_id, black_score
+            if opponent_id == player_id:
+                continue
+            logged = before.get((opponent_id, row.tournament_id, row.number))
+            if logged is not None:
+                fallback = current.get(opponent_id, START_RATING)[1]
+                outcomes.append((logged['old_rating'], logged.get('old_deviation', fallback), player_score))
+            elif opponent_id in current:
+                outcomes.append(current[opponent_id] + (player_score,))
+        if outcomes:
+            rating, deviation, volatility = glicko2.rate(rating, deviation, volatility, outcomes)
+            periods += 1
+    return rating, deviation, volatility, periods
+
+def merge(keep, remove):
+    """Move everything of player remove to player keep, replay keep's rating and delete remove
+
+    One transaction, committed here; returns a dict of what moved.
+    """
+    if keep.id == remove.id:
+        raise MergeError('A player cannot be merged with themselves')
+    shared = db.session.query(TournamentPlayer.tournament_id).filter(TournamentPlayer.player_id == keep.id) \
+        .intersect(db.session.query(TournamentPlayer.tournament_id).filter(TournamentPlayer.player_id == remove.id)) \
+        .first()
+    if shared is not None:
+        raise MergeError('Both players are entered in the same tournament, so they are different people')
+
+    moved = {'entries': TournamentPlayer.query.filter_by(player_id=remove.id)
+             .update({'player_id': keep.id}, synchronize_session=False)}
+    for name, model in (('pairings', RoundPairing), ('matches', Match)):
+        moved[name] = 0
+        for column in (model.white_player_id, model.black_player_id):
+            moved[name] += model.query.filter(column == remove.id) \
+                .update({column: keep.id}, synchronize_session=False)
+    for column in (GameRecord.black_player_id, GameRecord.white_player_id):
+        GameRecord.query.filter(column == remove.id).update({column: keep.id}, synchronize_session=False)
+    Registration.query.filter_by(player_id=remove.id).update({'player_id': keep.id}, synchronize_session=False)
+    archive.repoint_player(remove.id, keep.id)
+    head_to_head.forget_player(remove.id)
+    head_to_head.rebuild_player(keep.id)
+
+    taken = []
+    for field in MERGED_FIELDS:
+        if not getattr(keep, field) and getattr(remove, field):
+            setattr(keep, field, getattr(remove, field))
+            taken.append(field)
+    if remove.last_active and (keep.last_active is None or remove.last_active > keep.last_active):
+        keep.last_active = remove.last_active
+
+    old_rating = keep.rating
+    rating, deviation, volatility, periods = replay(keep.id, seed_ids=(keep.id, remove.id))
+    if periods:
+        keep.rating, keep.rating_deviation, keep.volatility = rating, deviation, volatility
+    activity.record('player.merged', keep, f'{remove.name} ({remove.player_id}) merged into {keep.name}',
+                    merged_id=remove.id, merged_player_id=remove.player_id, old_rating=old_rating,
+                    new_rating=keep.rating, rating_periods=periods, fields=taken, **moved)
+    leftover = [getattr(remove, field) for field in ('player_photo', 'id_card_photo')
+                if getattr(remove, field) and field not in taken]
+    # The entries were moved in bulk; do not let the delete touch a stale collection
+    db.session.expire(remove, ['tournaments'])
+    db.session.delete(remove)
+    db.session.commit()
+
+    from flask import current_app
+    for path in leftover:
+        try:
+            os.remove(os.path.join(current_app.root_path, 'static', path))
+        except OSError:
+            pass
+    return dict(moved, rating_periods=periods, old_rating=old_rating, new_rating=keep.rating)
+
+def init_app(app):
+    if not event.contains(Session, 'after_flush', _after_flush):
+        event.listen(Session, 'after_flush', _after_flush)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Find and merge duplicate players.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('candidates')
+    command.add_argument('--threshold', type=float, default=THRESHOLD)
+    command.add_argument('--limit', type=int, default=100)
+    command = commands.add_parser('merge')
+    command.add_argument('keep', type=int, help='id of the player to keep')
+    command.add_argument('remove', type=int, help='id of the duplicate to merge into it')
+    commands.add_parser('rebuild-keys')
+    args = parser.parse_args(argv)
+
+    from app import create_app
+    app = create_app()
+    with app.app_context():
+        if args.command == 'candidates':
+            for candidate in candidates(args.threshold, args.limit):
+                print(f'{candidate.score:.2f}  {candidate.first.id:6} {candidate.first.name:30}  '
+                      f'{candidate.second.id:6} {candidate.second.name:30}  {", ".join(candidate.reasons)}')
+        elif args.command == 'merge':
+            keep, remove = db.session.get(Player, args.keep), db.session.get(Player, args.remove)
+            if keep is None or remove is None:
+                print('No such player', file=sys.stderr)
+                return 1
+            name = remove.name
+            try:
+                moved = merge(keep, remove)
+            except MergeError as exc:
+                print(exc, file=sys.stderr)
+                return 1
+            print(f"Merged {name} into {keep.name}: {moved['entries']} entries, {moved['matches']} matches, "
+                  f"rating {moved['old_rating']:.0f} to {moved['new_rating']:.0f}")
+        else:
+            print(f'Wrote {rebuild_keys()} blocking keys')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
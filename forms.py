@@ -1,8 +1,8 @@
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileAllowed
-from wtforms import StringField, PasswordField, BooleanField, SubmitField, DateTimeField
-from wtforms import TextAreaField, SelectField, SelectMultipleField
-from wtforms.validators import Length
+from wtforms import StringField, PasswordField, BooleanField, SubmitField, DateTimeField, DateField
+from wtforms import TextAreaField, SelectField, SelectMultipleField, IntegerField
+from wtforms.validators import Length, NumberRange
 from wtforms.validators import DataRequired, Email, EqualTo, ValidationError, Optional
 from models import User, INDIAN_STATES
 
@@ -17,6 +17,7 @@ class PlayerForm(FlaskForm):
     middle_name = StringField('Middle Name', validators=[Optional(), Length(max=50)])
     last_name = StringField('Last Name', validators=[Optional(), Length(max=50)])
     state = SelectField('State', choices=[(state, state) for state in INDIAN_STATES], validators=[Optional()])
+    birth_date = DateField('Date of Birth', validators=[Optional()])
     email = StringField('Email', validators=[Optional(), Email(), Length(max=120)])
     phone = StringField('Phone', validators=[Optional(), Length(max=20)])
     player_photo = FileField('Player Photo', validators=[
@@ -55,6 +56,8 @@ class TournamentForm(FlaskForm):
                                 default='swiss',
                                 validators=[Optional()])
     players = SelectMultipleField('Select Players', coerce=int, validators=[Optional()])
+    registration_open = BooleanField('Open for public registration')
+    capacity = IntegerField('Capacity (leave empty for no limit)', validators=[Optional(), NumberRange(min=1)])
     submit = SubmitField('Submit')
 
     def __init__(self, *args, **kwargs):
@@ -64,4 +67,13 @@ class TournamentForm(FlaskForm):
 
     def validate_end_date(self, field):
         if field.data and self.start_date.data and field.data <= self.start_date.data:
-            raise ValidationError('End date must be after start date')
\ No newline at end of file
+            raise ValidationError('End date must be after start date')
+
+class RegistrationForm(FlaskForm):
+    first_name = StringField('First Name', validators=[DataRequired(), Length(max=50)])
+    last_name = StringField('Last Name', validators=[DataRequired(), Length(max=50)])
+    email = StringField('Email', validators=[DataRequired(), Email(), Length(max=120)])
+    phone = StringField('Phone', validators=[Optional(), Length(max=20)])
+    state = SelectField('State', choices=[(state, state) for state in INDIAN_STATES], validators=[Optional()])
+    birth_date = DateField('Date of Birth', validators=[Optional()])
+    submit = SubmitField('Register')
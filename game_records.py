@@ -0,0 +1,263 @@
+"""
+SGF game records.
+
+Each game is one GameRecord row: the SGF text compressed with zlib, plus
+the metadata read by sgf.py (players, date, komi, handicap, result, move
+count and opening) in indexed columns, so searches by player, opening or
+length never decompress a game.  Records are keyed by the SHA-256 of their
+text, so a game uploaded twice or present in two archives is stored once.
+
+A director attaches a game to a pairing from the tournament page.  Whole
+archives are imported from the command line; .sgf files (one game or a
+collection), directories and .zip/.tar(.gz) archives are read as streams
+and committed in batches:
+
+    python game_records.py import season-2024.zip games/ extra.sgf
+
+Imported games are linked to players whose name matches PB/PW exactly
+("First Last" or "Last First"), and to the match those two players played
+on the game's date if there is exactly one.
+"""
+import argparse
+import hashlib
+import logging
+import os
+import sys
+import tarfile
+import zipfile
+import zlib
+from collections import defaultdict
+from sqlalchemy import func, or_, select
+from sqlalchemy.orm import defer
+from app import db
+from models import GameRecord, Match, Player
+from archive import match_history
+import activity
+import sgf
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+MAX_UPLOAD_BYTES = 1 << 20
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+# Sorts after every character of an opening key, for prefix ranges
+KEY_END = '~'
+
+def digest(raw):
+    return hashlib.sha256(raw).hexdigest()
+
+def new_record(raw, game, **links):
+    """An unsaved GameRecord for a parsed game"""
+    return GameRecord(
+        digest=digest(raw),
+        data=zlib.compress(raw, 9),
+        size=len(raw),
+        black_name=game.black,
+        white_name=game.white,
+        event=game.event,
+        played_on=game.played_on,
+        board_size=game.board_size,
+        komi=game.komi,
+        handicap=game.handicap,
+        result=game.result,
+        move_count=game.move_count,
+        opening=game.opening,
+        **links)
+
+def sgf_text(record):
+    """The record's SGF bytes"""
+    return zlib.decompress(record.data)
+
+def attach(data, pairing):
+    """Store an uploaded SGF and make it the game record of a pairing; the caller commits"""
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise sgf.SgfError(f'SGF files are limited to {MAX_UPLOAD_BYTES // 1024} KB')
+    raw, game = sgf.parse(data)
+    record = GameRecord.query.filter_by(digest=digest(raw)).first()
+    if record is None:
+        record = new_record(raw, game)
+        db.session.add(record)
+    GameRecord.query.filter(GameRecord.pairing_id == pairing.id, GameRecord.id != record.id) \
+        .update({'pairing_id': None, 'match_id': None}, synchronize_session=False)
+    match = Match.query.filter_by(pairing_id=pairing.id).first()
+    record.pairing_id = pairing.id
+    record.match_id = match.id if match else None
+    record.tournament_id = pairing.round.tournament_id
+    record.black_player_id = pairing.black_player_id
+    record.white_player_id = pairing.white_player_id
+    activity.record('game.attached', record,
+                    f'Game record: {pairing.white_player.name} vs {pairing.black_player.name}',
+                    pairing_id=pairing.id, moves=record.move_count)
+    return record
+
+def for_tournament(tournament_id):
+    """{pairing id: game record id} for a tournament's pairings that have one"""
+    rows = db.session.query(GameRecord.pairing_id, GameRecord.id) \
+        .filter(GameRecord.tournament_id == tournament_id, GameRecord.pairing_id.isnot(None)).all()
+    return dict(rows)
+
+def search(player_id=None, opening=None, board_size=sgf.DEFAULT_SIZE, min_moves=None, max_moves=None,
+           played_from=None, played_to=None, tournament_id=None):
+    """Query of matching records, newest first; every filter is on an indexed column"""
+    query = GameRecord.query.options(defer(GameRecord.data)).filter(GameRecord.board_size == board_size)
+    if player_id is not None:
+        query = query.filter(or_(GameRecord.black_player_id == player_id, GameRecord.white_player_id == player_id))
+    if opening:
+        key = sgf.opening_key(opening, board_size)
+        query = query.filter(GameRecord.opening >= key, GameRecord.opening < key + KEY_END)
+    if min_moves is not None:
+        query = query.filter(GameRecord.move_count >= min_moves)
+    if max_moves is not None:
+        query = query.filter(GameRecord.move_count <= max_moves)
+    if played_from is not None:
+        query = query.filter(GameRecord.played_on >= played_from)
+    if played_to is not None:
+        query = query.filter(GameRecord.played_on <= played_to)
+    if tournament_id is not None:
+        query = query.filter(GameRecord.tournament_id == tournament_id)
+    return query.order_by(GameRecord.played_on.desc(), GameRecord.id.desc())
+
+def as_dict(record):
+    return {
+        'id': record.id,
+        'black': record.black_name,
+        'white': record.white_name,
+        'black_player_id': record.black_player_id,
+        'white_player_id': record.white_player_id,
+        'event': record.event,
+        'played_on': record.played_on.isoformat() if record.played_on else None,
+        'board_size': record.board_size,
+        'komi': record.komi,
+        'handicap': record.handicap,
+        'result': record.result,
+        'move_count': record.move_count,
+        'opening': record.opening,
+        'tournament_id': record.tournament_id,
+        'match_id': record.match_id,
+    }
+
+def detach_tournament(tournament_id):
+    """Keep a deleted tournament's games as unattached records"""
+    GameRecord.query.filter_by(tournament_id=tournament_id) \
+        .update({'tournament_id': None, 'pairing_id': None, 'match_id': None}, synchronize_session=False)
+
+def forget_player(player_id):
+    for column in (GameRecord.black_player_id, GameRecord.white_player_id):
+        GameRecord.query.filter(column == player_id).update({column: None}, synchronize_session=False)
+
+# Bulk import ----------------------------------------------------------------
+
+def _name_key(name):
+    return ' '.join((name or '').lower().split())
+
+def name_index():
+    """{normalized name: player id} for names that belong to exactly one player"""
+    found = defaultdict(set)
+    for id, first, middle, last in db.session.query(Player.id, Player.first_name, Player.middle_name,
+                                                    Player.last_name):
+        for name in ((first, middle, last), (last, first, middle), (first, last), (last, first)):
+            key = _name_key(' '.join(part for part in name if part))
+            if key:
+                found[key].add(id)
+    return {key: ids.pop() for key, ids in found.items() if len(ids) == 1}
+
+def match_index():
+    """{(black id, white id, date): (match id, tournament id, pairing id)} for unambiguous games"""
+    found = defaultdict(list)
+    rows = db.session.execute(select(match_history.c.id, match_history.c.tournament_id, match_history.c.pairing_id,
+                                     match_history.c.black_player_id, match_history.c.white_player_id,
+                                     func.date(match_history.c.date)))
+    for id, tournament_id, pairing_id, black_id, white_id, played_on in rows:
+        found[(black_id, white_id, played_on)].append((id, tournament_id, pairing_id))
+    return {key: games[0] for key, games in found.items() if len(games) == 1}
+
+def sources(paths):
+    """Yield (name, binary stream) for every SGF file under the given paths"""
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.lower().endswith('.sgf'):
+                        with open(os.path.join(dirpath, filename), 'rb') as stream:
+                            yield os.path.join(dirpath, filename), stream
+        elif zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as archive:
+                for member in archive.infolist():
+                    if not member.is_dir() and member.filename.lower().endswith('.sgf'):
+                        with archive.open(member) as stream:
+                            yield f'{path}:{member.filename}', stream
+        elif tarfile.is_tarfile(path):
+            with tarfile.open(path, 'r:*') as archive:
+                for member in archive:
+                    if member.isfile() and member.name.lower().endswith('.sgf'):
+                        yield f'{path}:{member.name}', archive.extractfile(member)
+        else:
+            with open(path, 'rb') as stream:
+                yield path, stream
+
+def import_paths(paths):
+    """Import every game under paths; returns (imported, duplicates, failed files)"""
+    names = name_index()
+    matches = match_index()
+    counts = {'imported': 0, 'duplicates': 0, 'failed': 0}
+    batch = {}
+
+    def flush():
+        existing = {row[0] for row in db.session.query(GameRecord.digest)
+                    .filter(GameRecord.digest.in_(list(batch)))}
+        records = [record for key, record in batch.items() if key not in existing]
+        db.session.add_all(records)
+        db.session.commit()
+        counts['imported'] += len(records)
+        counts['duplicates'] += len(batch) - len(records)
+        batch.clear()
+
+    for name, stream in sources(paths):
+        try:
+            for raw, game in sgf.games(stream):
+                key = digest(raw)
+                if key in batch:
+                    counts['duplicates'] += 1
+                    continue
+                black_id, white_id = names.get(_name_key(game.black)), names.get(_name_key(game.white))
+                links = {'black_player_id': black_id, 'white_player_id': white_id}
+                found = matches.get((black_id, white_id, game.played_on and game.played_on.isoformat()))
+                if black_id and white_id and found:
+                    links.update(match_id=found[0], tournament_id=found[1], pairing_id=found[2])
+                batch[key] = new_record(raw, game, **links)
+                if len(batch) >= BATCH_SIZE:
+                    flush()
+        except (sgf.SgfError, OSError, zlib.error, tarfile.TarError, zipfile.BadZipFile) as exc:
+            logger.warning('Skipped the rest of %s: %s', name, exc)
+            counts['failed'] += 1
+    if batch:
+        flush()
+    activity.record('games.imported', ('game_record', None),
+                    f"Imported {counts['imported']} game records", **counts)
+    db.session.commit()
+    return counts['imported'], counts['duplicates'], counts['failed']
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Import SGF game records.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('import')
+    command.add_argument('paths', nargs='+', help='.sgf files, directories, .zip or .tar archives')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    from app import create_app
+    app = create_app()
+    with app.app_context():
+        missing = [path for path in args.paths if not os.path.exists(path)]
+        if missing:
+            print(f"Not found: {', '.join(missing)}", file=sys.stderr)
+            return 1
+        imported, duplicates, failed = import_paths(args.paths)
+        print(f'Imported {imported} games, skipped {duplicates} already stored'
+              + (f', {failed} files could not be read' if failed else ''))
+    return 0 if not failed else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
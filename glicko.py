@@ -1,5 +1,8 @@
 from math import sqrt, pi, log, exp
 
+# Ratings and deviations are divided by this to move to the Glicko-2 scale
+SCALE = 173.7178
+
 class Glicko2:
     def __init__(self, tau=0.5):
         self.tau = tau
@@ -11,6 +14,14 @@ class Glicko2:
     def _E(self, r, r_j, g_j):
         return 1 / (1 + exp(-g_j * (r - r_j)))
 
+    def expected_score(self, rating, rd, opponent_rating, opponent_rd):
+        """Probability that the first player beats the second
+
+        Both deviations count, so the two players' probabilities add up to 1.
+        """
+        phi = sqrt(rd**2 + opponent_rd**2) / SCALE
+        return self._E((rating - 1500) / SCALE, (opponent_rating - 1500) / SCALE, self._g(phi))
+
     def _volatility_illinois(self, v, delta, phi, sigma, tau):
         a = log(sigma**2)
         def f(x):
@@ -27,7 +38,7 @@ class Glicko2:
             B = log(delta**2 - phi**2 - v)
         else:
             k = 1
-            while f(a - k * tau) < 0:
+            while f(a - k * tau) > 0:
                 k += 1
             B = a - k * tau
         
@@ -36,7 +47,7 @@ class Glicko2:
         while abs(B - A) > eps:
             C = A + (A - B) * fA / (fB - fA)
             fC = f(C)
-            if fC * fB < 0:
+            if fC * fB <= 0:
                 A = B
                 fA = fB
             else:
@@ -0,0 +1,192 @@
+"""
+Head-to-head records between pairs of players.
+
+There is one HeadToHead row per pair of players who have met, keyed by
+(lower player id, higher player id) and counted from the lower id's side:
+wins, losses and draws with white and with black, plus the date of the last
+game.  Looking up two players is a primary key read, and a player's
+opponents come from the key prefix plus the index on high_player_id, so
+neither scans Match.
+
+record_game() is called in the same transaction that stores a result.
+rebuild() recomputes every row from Match, e.g. after a bulk import, and
+rebuild_player() one player's rows, e.g. after a merge.  init-db rebuilds
+when the table is empty, so an existing match history is picked up:
+
+    python head_to_head.py rebuild
+"""
+import argparse
+import sys
+from datetime import datetime
+from sqlalchemy import delete, func, insert, or_, and_
+from app import db
+from models import HeadToHead, Player, full_name
+from archive import match_history
+
+COUNT_COLUMNS = ('low_white_wins', 'low_white_losses', 'low_white_draws',
+                 'low_black_wins', 'low_black_losses', 'low_black_draws')
+
+def winner(result):
+    """'white', 'black' or 'draw' for a stored result string, None if unknown"""
+    if not result:
+        return None
+    if result == 'Jigo':
+        return 'draw'
+    if result.startswith('W+'):
+        return 'white'
+    if result.startswith('B+'):
+        return 'black'
+    return None
+
+def _count_column(low_is_white, game_winner):
+    colour = 'white' if low_is_white else 'black'
+    if game_winner == 'draw':
+        kind = 'draws'
+    elif (game_winner == 'white') == low_is_white:
+        kind = 'wins'
+    else:
+        kind = 'losses'
+    return f'low_{colour}_{kind}'
+
+def record_game(white_id, black_id, result, played_at, undo=False):
+    """Add a game to (or with undo=True, take it out of) the pair's row"""
+    game_winner = winner(result)
+    if game_winner is None or white_id == black_id:
+        return None
+    low, high = sorted((white_id, black_id))
+    row = db.session.get(HeadToHead, (low, high))
+    if row is None:
+        if undo:
+            return None
+        row = HeadToHead(low_player_id=low, high_player_id=high, **dict.fromkeys(COUNT_COLUMNS, 0))
+        db.session.add(row)
+    column = _count_column(white_id == low, game_winner)
+    setattr(row, column, getattr(row, column) + (-1 if undo else 1))
+    if not undo and played_at and (row.last_played is None or played_at > row.last_played):
+        row.last_played = played_at
+    return row
+
+def forget_games(games):
+    """Take deleted games out of their pairs; games are (white_id, black_id, result) tuples
+
+    Call after the Match rows are deleted, so last_played can be recomputed from what is left.
+    """
+    rows = {}
+    for white_id, black_id, result in games:
+        row = record_game(white_id, black_id, result, None, undo=True)
+        if row is not None:
+            rows[(row.low_player_id, row.high_player_id)] = row
+    for (low, high), row in rows.items():
+        if row.games <= 0:
+            db.session.delete(row)
+            continue
+        row.last_played = db.session.query(func.max(match_history.c.date)).filter(or_(
+            and_(match_history.c.white_player_id == low, match_history.c.black_player_id == high),
+            and_(match_history.c.white_player_id == high, match_history.c.black_player_id == low),
+        )).scalar()
+
+def forget_player(player_id):
+    db.session.execute(delete(HeadToHead).where(
+        or_(HeadToHead.low_player_id == player_id, HeadToHead.high_player_id == player_id)))
+
+def record_for(row, player_id):
+    """A pair's record from player_id's side"""
+    if row.low_player_id == player_id:
+        opponent_id = row.high_player_id
+        white = (row.low_white_wins, row.low_white_losses, row.low_white_draws)
+        black = (row.low_black_wins, row.low_black_losses, row.low_black_draws)
+    else:
+        opponent_id = row.low_player_id
+        # When the higher id had white the lower id had black, and the other way round
+        white = (row.low_black_losses, row.low_black_wins, row.low_black_draws)
+        black = (row.low_white_losses, row.low_white_wins, row.low_white_draws)
+    return {
+        'player_id': player_id,
+        'opponent_id': opponent_id,
+        'games': sum(white) + sum(black),
+        'wins': white[0] + black[0],
+        'losses': white[1] + black[1],
+        'draws': white[2] + black[2],
+        'as_white': dict(zip(('wins', 'losses', 'draws'), white)),
+        'as_black': dict(zip(('wins', 'losses', 'draws'), black)),
+        'last_played': row.last_played,
+    }
+
+def between(player_id, opponent_id):
+    """The record of player_id against opponent_id, or None if they have not played"""
+    row = db.session.get(HeadToHead, tuple(sorted((player_id, opponent_id))))
+    return record_for(row, player_id) if row is not None else None
+
+def opponents(player_id, limit=None):
+    """Everyone player_id has played, most games first, with opponent names"""
+    rows = HeadToHead.query.filter(HeadToHead.low_player_id == player_id).all() + \
+        HeadToHead.query.filter(HeadToHead.high_player_id == player_id).all()
+    records = [record_for(row, player_id) for row in rows]
+    records.sort(key=lambda r: r['last_played'] or datetime.min, reverse=True)
+    records.sort(key=lambda r: r['games'], reverse=True)
+    if limit is not None:
+        records = records[:limit]
+    ids = [r['opponent_id'] for r in records]
+    names = {}
+    if ids:
+        names = {
+            p.id: full_name(p.first_name, p.middle_name, p.last_name)
+            for p in db.session.query(Player.id, Player.first_name, Player.middle_name, Player.last_name)
+            .filter(Player.id.in_(ids))
+        }
+    for record in records:
+        record['opponent_name'] = names.get(record['opponent_id'], '')
+    return records
+
+def _tally(games):
+    """{(low, high): row dict} for (white_id, black_id, result, date) tuples"""
+    pairs = {}
+    for white_id, black_id, result, played_at in games:
+        game_winner = winner(result)
+        if game_winner is None or white_id == black_id:
+            continue
+        low, high = sorted((white_id, black_id))
+        row = pairs.get((low, high))
+        if row is None:
+            row = pairs[(low, high)] = dict(low_player_id=low, high_player_id=high, last_played=None,
+                                            **dict.fromkeys(COUNT_COLUMNS, 0))
+        row[_count_column(white_id == low, game_winner)] += 1
+        if played_at and (row['last_played'] is None or played_at > row['last_played']):
+            row['last_played'] = played_at
+    return pairs
+
+def _games():
+    return db.session.query(match_history.c.white_player_id, match_history.c.black_player_id,
+                            match_history.c.result, match_history.c.date)
+
+def rebuild():
+    """Recompute every row from Match, archived seasons included; returns the number of pairs"""
+    pairs = _tally(_games().order_by(match_history.c.id).yield_per(5000))
+    db.session.execute(delete(HeadToHead))
+    if pairs:
+        db.session.execute(insert(HeadToHead), list(pairs.values()))
+    db.session.commit()
+    return len(pairs)
+
+def rebuild_player(player_id):
+    """Recompute one player's rows, e.g. after games were moved to them; the caller commits"""
+    forget_player(player_id)
+    pairs = _tally(_games().filter(or_(match_history.c.white_player_id == player_id,
+                                       match_history.c.black_player_id == player_id)))
+    if pairs:
+        db.session.execute(insert(HeadToHead), list(pairs.values()))
+    return len(pairs)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Maintain the head-to-head table.')
+    parser.add_argument('command', choices=['rebuild'])
+    parser.parse_args(argv)
+
+    from app import create_app
+    app = create_app()
+    with app.app_context():
+        print(f'Rebuilt head-to-head records for {rebuild()} pairs')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
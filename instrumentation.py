@@ -0,0 +1,353 @@
+"""
+Opt-in request and SQL instrumentation.
+
+Enable with INSTRUMENTATION=1.  Every request is timed and the SQL statements
+it issues are counted and timed through SQLAlchemy cursor events.  Requests
+that repeat the same statement many times are logged as likely N+1 queries.
+Admins can profile a single request with the "X-Profile: 1" header or the
+"_profile=1" query argument; a sampling profiler then records the stacks of
+the request thread.
+
+Aggregates are kept per process.  They are exposed as JSON on
+/admin/instrumentation and in the Prometheus text format on /metrics.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from itertools import count
+from flask import Blueprint, Response, abort, current_app, g, has_request_context, jsonify, request
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+instrumentation_bp = Blueprint('instrumentation', __name__)
+
+# Upper bounds (seconds) of the request duration histogram
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Distinct statements kept in the statement table before new ones are dropped
+MAX_TRACKED_STATEMENTS = 500
+
+class EndpointStats:
+    __slots__ = ('requests', 'seconds', 'sql_statements', 'sql_seconds', 'n_plus_one', 'buckets', 'statuses')
+
+    def __init__(self):
+        self.requests = 0
+        self.seconds = 0.0
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.n_plus_one = 0
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.statuses = Counter()
+
+class Registry:
+    """Process-wide aggregates shared by all request threads"""
+
+    def __init__(self, recent_size=200, profile_size=20):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.endpoints = {}
+        self.statements = {}
+        self.recent = deque(maxlen=recent_size)
+        self.profiles = deque(maxlen=profile_size)
+        self._profile_ids = count(1)
+
+    def record_request(self, endpoint, method, status, seconds, sql, n_plus_one):
+        key = (endpoint, method)
+        with self._lock:
+            stats = self.endpoints.get(key)
+            if stats is None:
+                stats = self.endpoints[key] = EndpointStats()
+            stats.requests += 1
+            stats.seconds += seconds
+            stats.sql_statements += sql.statements
+            stats.sql_seconds += sql.seconds
+            stats.statuses[status] += 1
+            if n_plus_one:
+                stats.n_plus_one += 1
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    stats.buckets[i] += 1
+                    break
+
+            for statement, (calls, statement_seconds) in sql.by_statement.items():
+                entry = self.statements.get(statement)
+                if entry is None:
+                    if len(self.statements) >= MAX_TRACKED_STATEMENTS:
+                        continue
+                    entry = self.statements[statement] = [0, 0.0]
+                entry[0] += calls
+                entry[1] += statement_seconds
+
+            self.recent.append({
+                'time': time.time(),
+                'method': method,
+                'path': request.path,
+                'endpoint': endpoint,
+                'status': status,
+                'duration_ms': round(seconds * 1000, 3),
+                'sql_statements': sql.statements,
+                'sql_ms': round(sql.seconds * 1000, 3),
+            })
+
+    def add_profile(self, profile):
+        with self._lock:
+            profile['id'] = next(self._profile_ids)
+            self.profiles.append(profile)
+            return profile['id']
+
+    def get_profile(self, profile_id):
+        with self._lock:
+            for profile in self.profiles:
+                if profile['id'] == profile_id:
+                    return profile
+        return None
+
+    def snapshot(self):
+        with self._lock:
+            endpoints = []
+            for (endpoint, method), stats in sorted(self.endpoints.items(), key=lambda item: -item[1].seconds):
+                endpoints.append({
+                    'endpoint': endpoint,
+                    'method': method,
+                    'requests': stats.requests,
+                    'mean_ms': round(stats.seconds / stats.requests * 1000, 3),
+                    'sql_per_request': round(stats.sql_statements / stats.requests, 2),
+                    'sql_ms_per_request': round(stats.sql_seconds / stats.requests * 1000, 3),
+                    'n_plus_one_requests': stats.n_plus_one,
+                    'statuses': dict(stats.statuses),
+                })
+            statements = [
+                {'statement': statement, 'calls': calls, 'total_ms': round(seconds * 1000, 3)}
+                for statement, (calls, seconds) in sorted(self.statements.items(), key=lambda item: -item[1][1])[:50]
+            ]
+            return {
+                'uptime_seconds': round(time.time() - self.started, 1),
+                'pid': os.getpid(),
+                'endpoints': endpoints,
+                'slowest_statements': statements,
+                'recent_requests': list(self.recent)[::-1],
+                'profiles': [
+                    {k: v for k, v in profile.items() if k not in ('collapsed', 'functions')}
+                    for profile in self.profiles
+                ],
+            }
+
+    def prometheus(self):
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        with self._lock:
+            items = sorted(self.endpoints.items())
+            metric('igd_requests_total', 'counter', 'HTTP requests handled by this process.')
+            for (endpoint, method), stats in items:
+                for status, total in sorted(stats.statuses.items()):
+                    lines.append(f'igd_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {total}')
+
+            metric('igd_request_duration_seconds', 'histogram', 'Request latency.')
+            for (endpoint, method), stats in items:
+                labels = f'endpoint="{endpoint}",method="{method}"'
+                cumulative = 0
+                for bound, bucket in zip(DURATION_BUCKETS, stats.buckets):
+                    cumulative += bucket
+                    lines.append(f'igd_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'igd_request_duration_seconds_bucket{{{labels},le="+Inf"}} {stats.requests}')
+                lines.append(f'igd_request_duration_seconds_sum{{{labels}}} {stats.seconds:.6f}')
+                lines.append(f'igd_request_duration_seconds_count{{{labels}}} {stats.requests}')
+
+            metric('igd_sql_statements_total', 'counter', 'SQL statements issued while handling requests.')
+            for (endpoint, method), stats in items:
+                lines.append(f'igd_sql_statements_total{{endpoint="{endpoint}",method="{method}"}} {stats.sql_statements}')
+
+            metric('igd_sql_duration_seconds_total', 'counter', 'Time spent executing SQL while handling requests.')
+            for (endpoint, method), stats in items:
+                lines.append(f'igd_sql_duration_seconds_total{{endpoint="{endpoint}",method="{method}"}} {stats.sql_seconds:.6f}')
+
+            metric('igd_n_plus_one_requests_total', 'counter', 'Requests that repeated one statement past the N+1 threshold.')
+            for (endpoint, method), stats in items:
+                lines.append(f'igd_n_plus_one_requests_total{{endpoint="{endpoint}",method="{method}"}} {stats.n_plus_one}')
+
+            metric('igd_process_start_time_seconds', 'gauge', 'Start time of this process since the epoch.')
+            lines.append(f'igd_process_start_time_seconds {self.started:.3f}')
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+class SqlStats:
+    """SQL activity of a single request"""
+    __slots__ = ('statements', 'seconds', 'by_statement')
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+        self.by_statement = {}
+
+    def add(self, statement, seconds):
+        self.statements += 1
+        self.seconds += seconds
+        entry = self.by_statement.get(statement)
+        if entry is None:
+            self.by_statement[statement] = [1, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+
+class SamplingProfiler:
+    """Samples the stack of one thread at a fixed interval from a helper thread"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def report(self):
+        own = Counter()
+        total = Counter()
+        for stack, samples in self.stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += samples
+            for frame in set(frames):
+                total[frame] += samples
+        return {
+            'samples': sum(self.stacks.values()),
+            'interval_ms': self.interval * 1000,
+            'functions': [
+                {'function': name, 'self': own[name], 'total': samples}
+                for name, samples in total.most_common(40)
+            ],
+            'collapsed': '\n'.join(f'{stack} {samples}' for stack, samples in self.stacks.most_common()),
+        }
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'instrumentation' in g:
+        conn.info.setdefault('instrumentation_start', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'instrumentation' in g:
+        starts = conn.info.get('instrumentation_start')
+        if starts:
+            g.instrumentation['sql'].add(statement, time.perf_counter() - starts.pop())
+
+def _profiling_requested():
+    if request.headers.get('X-Profile') != '1' and request.args.get('_profile') != '1':
+        return False
+    return current_user.is_authenticated and current_user.is_admin
+
+def _start_request():
+    g.instrumentation = {'start': time.perf_counter(), 'sql': SqlStats(), 'profiler': None}
+    if _profiling_requested():
+        profiler = SamplingProfiler(threading.get_ident(), current_app.config['PROFILE_INTERVAL'])
+        profiler.start()
+        g.instrumentation['profiler'] = profiler
+
+def _finish_request(response):
+    state = g.pop('instrumentation', None)
+    if state is None:
+        return response
+    seconds = time.perf_counter() - state['start']
+    sql = state['sql']
+    endpoint = request.endpoint or 'unmatched'
+
+    threshold = current_app.config['N_PLUS_ONE_THRESHOLD']
+    repeated = [(calls, statement) for statement, (calls, _) in sql.by_statement.items() if calls >= threshold]
+    if repeated:
+        calls, statement = max(repeated)
+        logger.warning('Possible N+1 query in %s %s: statement executed %d times: %s',
+                       request.method, request.path, calls, ' '.join(statement.split())[:200])
+
+    registry.record_request(endpoint, request.method, response.status_code, seconds, sql, bool(repeated))
+
+    profiler = state['profiler']
+    if profiler is not None:
+        profiler.stop()
+        profile = profiler.report()
+        profile.update({
+            'time': time.time(),
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'duration_ms': round(seconds * 1000, 3),
+            'sql_statements': sql.statements,
+        })
+        response.headers['X-Profile-Id'] = str(registry.add_profile(profile))
+
+    if seconds >= current_app.config['SLOW_REQUEST_SECONDS']:
+        logger.warning('Slow request %s %s took %.1f ms with %d SQL statements (%.1f ms)',
+                       request.method, request.path, seconds * 1000, sql.statements, sql.seconds * 1000)
+    return response
+
+def _teardown_request(exc):
+    # after_request is skipped when a view raises; make sure the sampler stops
+    state = g.pop('instrumentation', None)
+    if state is not None and state['profiler'] is not None:
+        state['profiler'].stop()
+
+def _require_admin():
+    if not (current_user.is_authenticated and current_user.is_admin):
+        abort(403)
+
+@instrumentation_bp.route('/admin/instrumentation')
+def overview():
+    _require_admin()
+    return jsonify(registry.snapshot())
+
+@instrumentation_bp.route('/admin/instrumentation/profiles/<int:profile_id>')
+def profile(profile_id):
+    _require_admin()
+    found = registry.get_profile(profile_id)
+    if found is None:
+        abort(404)
+    if request.args.get('format') == 'collapsed':
+        # Input for flamegraph.pl / speedscope
+        return Response(found['collapsed'] + '\n', mimetype='text/plain')
+    return jsonify(found)
+
+@instrumentation_bp.route('/metrics')
+def metrics():
+    token = current_app.config.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(401)
+    return Response(registry.prometheus(), mimetype='text/plain; version=0.0.4')
+
+def init_app(app):
+    app.config.setdefault('INSTRUMENTATION', os.environ.get('INSTRUMENTATION', '0') == '1')
+    app.config.setdefault('N_PLUS_ONE_THRESHOLD', int(os.environ.get('N_PLUS_ONE_THRESHOLD', 10)))
+    app.config.setdefault('SLOW_REQUEST_SECONDS', float(os.environ.get('SLOW_REQUEST_SECONDS', 1.0)))
+    app.config.setdefault('PROFILE_INTERVAL', float(os.environ.get('PROFILE_INTERVAL', 0.001)))
+    app.config.setdefault('METRICS_TOKEN', os.environ.get('METRICS_TOKEN'))
+    if not app.config['INSTRUMENTATION']:
+        return
+
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_teardown_request)
+    app.register_blueprint(instrumentation_bp)
@@ -0,0 +1,144 @@
+"""
+Load test for the public read paths.
+
+Against a running server:
+
+    python loadtest.py --url http://127.0.0.1:5000 --concurrency 1 4 16
+
+Or let the script start serve.py with different worker counts on a scratch
+port and show how throughput scales:
+
+    python loadtest.py --spawn-workers 1 2 4 --concurrency 16
+
+Each client thread keeps one HTTP connection open and requests the paths
+round-robin for --duration seconds.
+"""
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+from benchmark import percentile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PATHS = ['/players', '/tournament/1']
+
+def client_loop(host, port, paths, deadline, latencies, errors):
+    conn = http.client.HTTPConnection(host, port, timeout=30)
+    i = 0
+    while time.perf_counter() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+                continue
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(type(e).__name__)
+            time.sleep(0.01)
+            conn.close()
+            conn = http.client.HTTPConnection(host, port, timeout=30)
+            continue
+        latencies.append((time.perf_counter() - start) * 1000)
+    conn.close()
+
+def run_level(url, paths, concurrency, duration):
+    parts = urlsplit(url)
+    latencies = []
+    errors = []
+    deadline = time.perf_counter() + duration
+    threads = [
+        threading.Thread(target=client_loop, args=(parts.hostname, parts.port or 80, paths, deadline, latencies, errors))
+        for _ in range(concurrency)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50),
+        'p99_ms': percentile(latencies, 99),
+    }
+
+def print_result(label, result):
+    print(f"{label:<12} c={result['concurrency']:<4} {result['rps']:>9.1f} req/s  "
+          f"p50 {result['p50_ms']:>8.1f} ms  p99 {result['p99_ms']:>8.1f} ms  "
+          f"{result['requests']} ok, {result['errors']} errors")
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_until_up(url, timeout=30):
+    parts = urlsplit(url)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=2)
+            conn.request('GET', '/')
+            conn.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'Server at {url} did not start')
+
+def spawn_server(workers, threads):
+    port = free_port()
+    pidfile = os.path.join(tempfile.mkdtemp(prefix='igd-loadtest-'), 'gunicorn.pid')
+    env = dict(os.environ, ACCESS_LOG='', LOG_LEVEL='warning')
+    process = subprocess.Popen(
+        [sys.executable, 'serve.py', '--bind', f'127.0.0.1:{port}', '--workers', str(workers),
+         '--threads', str(threads), '--pidfile', pidfile],
+        cwd=ROOT, env=env,
+    )
+    url = f'http://127.0.0.1:{port}'
+    wait_until_up(url)
+    return process, url
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure throughput of the public read paths.')
+    parser.add_argument('--url', help='Base URL of a running server')
+    parser.add_argument('--paths', nargs='+', default=DEFAULT_PATHS)
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4, 16])
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--spawn-workers', nargs='+', type=int,
+                        help='Start serve.py with each of these worker counts and test it')
+    parser.add_argument('--threads', type=int, default=4, help='Threads per spawned worker')
+    args = parser.parse_args(argv)
+
+    if not args.url and not args.spawn_workers:
+        parser.error('give --url or --spawn-workers')
+
+    if args.url:
+        for concurrency in args.concurrency:
+            print_result('server', run_level(args.url, args.paths, concurrency, args.duration))
+        return 0
+
+    for workers in args.spawn_workers:
+        process, url = spawn_server(workers, args.threads)
+        try:
+            for concurrency in args.concurrency:
+                print_result(f'{workers} workers', run_level(url, args.paths, concurrency, args.duration))
+        finally:
+            process.terminate()
+            process.wait()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,9 @@
-from app import app
+from app import create_app, init_db
+
+app = create_app()
 
 if __name__ == "__main__":
+    # The dev server brings the schema up to date like serve.py does
+    with app.app_context():
+        init_db()
     app.run(host="0.0.0.0", port=5000, debug=True)
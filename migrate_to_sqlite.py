@@ -1,7 +1,7 @@
 
 import os
 import logging
-from app import app, db
+from app import create_app, db
 from models import User, Player, Tournament, Round, RoundPairing, TournamentPlayer, Match
 import psycopg2
 import psycopg2.extras
@@ -24,6 +24,7 @@ def migrate_data():
         conn = psycopg2.connect(postgres_url)
         cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
         
+        app = create_app()
         with app.app_context():
             # Create SQLite tables
             logger.info("Creating SQLite tables...")
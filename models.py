@@ -13,6 +13,11 @@ def generate_tournament_id():
     chars = string.ascii_uppercase + string.digits
     return ''.join(random.choices(chars, k=5))
 
+def full_name(first_name, middle_name, last_name):
+    if middle_name:
+        return f"{first_name or ''} {middle_name} {last_name or ''}"
+    return f"{first_name or ''} {last_name or ''}"
+
 INDIAN_STATES = [
     'Andhra Pradesh', 'Arunachal Pradesh', 'Assam', 'Bihar', 'Chhattisgarh',
     'Goa', 'Gujarat', 'Haryana', 'Himachal Pradesh', 'Jharkhand', 'Karnataka',
@@ -41,6 +46,7 @@ class Player(db.Model):
     middle_name = db.Column(db.String(50))
     last_name = db.Column(db.String(50))  # Made nullable
     state = db.Column(db.String(50))  # Made nullable
+    birth_date = db.Column(db.Date)  # Optional, used for age-band rankings
     email = db.Column(db.String(120))
     phone = db.Column(db.String(20))
     id_card_photo = db.Column(db.String(255))
@@ -53,9 +59,7 @@ class Player(db.Model):
 
     @property
     def name(self):
-        if self.middle_name:
-            return f"{self.first_name or ''} {self.middle_name} {self.last_name or ''}"
-        return f"{self.first_name or ''} {self.last_name or ''}"
+        return full_name(self.first_name, self.middle_name, self.last_name)
 
     @property
     def current_score(self):
@@ -72,6 +76,13 @@ class Tournament(db.Model):
     cover_photo = db.Column(db.String(255))
     status = db.Column(db.String(20), default='upcoming')
     pairing_system = db.Column(db.String(20), default='swiss')
+    # Season file holding its rounds, pairings and matches once archived (see archive.py)
+    archive_season = db.Column(db.Integer, index=True)
+    # Public sign-ups (see registration.py); capacity None means no limit
+    registration_open = db.Column(db.Boolean, nullable=False, default=False, server_default='0')
+    capacity = db.Column(db.Integer)
+    # When registration last stopped being open; sign-ups received before it still count
+    registration_closed_at = db.Column(db.DateTime)
     players = db.relationship('TournamentPlayer', backref='tournament', lazy=True, cascade='all, delete-orphan')
     rounds = db.relationship('Round', backref='tournament', lazy=True, cascade='all, delete-orphan')
 
@@ -81,6 +92,8 @@ class Round(db.Model):
     number = db.Column(db.Integer)  # Made nullable
     datetime = db.Column(db.DateTime)  # Made nullable
     status = db.Column(db.String(20), default='pending')
+    # Bumped by every result entry and by completion; see results.py
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
     pairings = db.relationship('RoundPairing', backref='round', lazy=True, cascade='all, delete-orphan')
 
     __table_args__ = (
@@ -93,6 +106,7 @@ class RoundPairing(db.Model):
     white_player_id = db.Column(db.Integer, db.ForeignKey('player.id', ondelete='CASCADE'), nullable=False)
     black_player_id = db.Column(db.Integer, db.ForeignKey('player.id', ondelete='CASCADE'), nullable=False)
     result = db.Column(db.String(10))
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
     white_player = db.relationship('Player', foreign_keys=[white_player_id])
     black_player = db.relationship('Player', foreign_keys=[black_player_id])
 
@@ -109,6 +123,8 @@ class Match(db.Model):
     tournament_id = db.Column(db.Integer, db.ForeignKey('tournament.id', ondelete='CASCADE'), nullable=False)
     round_number = db.Column(db.Integer)  # Made nullable
     round_start_time = db.Column(db.DateTime)
+    # The pairing this game was entered for; None for imported games
+    pairing_id = db.Column(db.Integer, db.ForeignKey('round_pairing.id', ondelete='SET NULL'), index=True)
     black_player_id = db.Column(db.Integer, db.ForeignKey('player.id', ondelete='CASCADE'), nullable=False)
     white_player_id = db.Column(db.Integer, db.ForeignKey('player.id', ondelete='CASCADE'), nullable=False)
     result = db.Column(db.String(10))
@@ -116,4 +132,141 @@ class Match(db.Model):
 
     black_player = db.relationship('Player', foreign_keys=[black_player_id])
     white_player = db.relationship('Player', foreign_keys=[white_player_id])
-    tournament = db.relationship('Tournament', backref='matches')
\ No newline at end of file
+    tournament = db.relationship('Tournament', backref='matches')
+
+class HeadToHead(db.Model):
+    """Results between two players, stored once per pair from the lower id's side (see head_to_head.py)"""
+    low_player_id = db.Column(db.Integer, db.ForeignKey('player.id', ondelete='CASCADE'), primary_key=True)
+    high_player_id = db.Column(db.Integer, db.ForeignKey('player.id', ondelete='CASCADE'), primary_key=True,
+                               index=True)
+    low_white_wins = db.Column(db.Integer, nullable=False, default=0)
+    low_white_losses = db.Column(db.Integer, nullable=False, default=0)
+    low_white_draws = db.Column(db.Integer, nullable=False, default=0)
+    low_black_wins = db.Column(db.Integer, nullable=False, default=0)
+    low_black_losses = db.Column(db.Integer, nullable=False, default=0)
+    low_black_draws = db.Column(db.Integer, nullable=False, default=0)
+    last_played = db.Column(db.DateTime)
+
+    @property
+    def games(self):
+        return (self.low_white_wins + self.low_white_losses + self.low_white_draws +
+                self.low_black_wins + self.low_black_losses + self.low_black_draws)
+
+class TableVersion(db.Model):
+    # Bumped in the same transaction as any change to the named table (see versioning.py)
+    table_name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class ActivityEvent(db.Model):
+    # Append-only log of admin and director actions (see activity.py); the id is the paging cursor
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'))
+    action = db.Column(db.String(40), nullable=False)
+    entity_type = db.Column(db.String(30), nullable=False)
+    entity_id = db.Column(db.Integer)
+    summary = db.Column(db.String(255))
+    details = db.Column(db.Text)
+
+    user = db.relationship('User')
+
+    __table_args__ = (
+        db.Index('ix_activity_event_entity', 'entity_type', 'entity_id', 'id'),
+    )
+
+class ChangeLog(db.Model):
+    # Filled by triggers on a replication primary and copied by followers (see replication.py)
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(64), nullable=False)
+    op = db.Column(db.String(10), nullable=False)
+    row_key = db.Column(db.Text, nullable=False)
+    row_data = db.Column(db.Text)
+
+    # AUTOINCREMENT so pruned ids are never handed out again
+    __table_args__ = {'sqlite_autoincrement': True}
+
+class RatingList(db.Model):
+    # Official rating list frozen at published_on; data is a columnar blob (see rating_lists.py)
+    id = db.Column(db.Integer, primary_key=True)
+    published_on = db.Column(db.Date, unique=True, nullable=False)
+    title = db.Column(db.String(100))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    player_count = db.Column(db.Integer, nullable=False, default=0)
+    # List the data is delta-encoded against; None for a keyframe
+    base_id = db.Column(db.Integer, db.ForeignKey('rating_list.id'))
+    depth = db.Column(db.Integer, nullable=False, default=0)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    # AUTOINCREMENT so a decoded list cached under an id is never another list
+    __table_args__ = {'sqlite_autoincrement': True}
+
+class GameRecord(db.Model):
+    # An SGF game, stored once per distinct file content (see game_records.py)
+    id = db.Column(db.Integer, primary_key=True)
+    digest = db.Column(db.String(64), unique=True, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)  # zlib-compressed SGF
+    size = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # Plain ids: archived rounds and matches leave the main tables (see archive.py)
+    tournament_id = db.Column(db.Integer, index=True)
+    pairing_id = db.Column(db.Integer, index=True)
+    match_id = db.Column(db.Integer, index=True)
+    black_player_id = db.Column(db.Integer, db.ForeignKey('player.id', ondelete='SET NULL'), index=True)
+    white_player_id = db.Column(db.Integer, db.ForeignKey('player.id', ondelete='SET NULL'), index=True)
+    black_name = db.Column(db.String(100))
+    white_name = db.Column(db.String(100))
+    event = db.Column(db.String(100))
+    played_on = db.Column(db.Date, index=True)
+    board_size = db.Column(db.Integer, nullable=False, default=19)
+    komi = db.Column(db.Float)
+    handicap = db.Column(db.Integer, nullable=False, default=0)
+    result = db.Column(db.String(20))
+    move_count = db.Column(db.Integer, nullable=False, default=0, index=True)
+    # First moves in canonical orientation, searched by prefix (see sgf.py)
+    opening = db.Column(db.String(32), index=True)
+
+    black_player = db.relationship('Player', foreign_keys=[black_player_id])
+    white_player = db.relationship('Player', foreign_keys=[white_player_id])
+
+class PlayerKey(db.Model):
+    # Blocking keys for duplicate detection, kept in step with Player (see dedup.py)
+    key = db.Column(db.String(80), primary_key=True)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id', ondelete='CASCADE'), primary_key=True,
+                          index=True)
+
+class Registration(db.Model):
+    # A public sign-up, written by registration.py's batch writer
+    id = db.Column(db.Integer, primary_key=True)
+    # The reference the registrant is given before the row exists
+    token = db.Column(db.String(16), unique=True, nullable=False)
+    tournament_id = db.Column(db.Integer, db.ForeignKey('tournament.id', ondelete='CASCADE'), nullable=False)
+    received_at = db.Column(db.DateTime, nullable=False)
+    # confirmed, waitlisted, entered, cancelled, duplicate or closed
+    status = db.Column(db.String(20), nullable=False)
+    first_name = db.Column(db.String(50), nullable=False)
+    last_name = db.Column(db.String(50), nullable=False)
+    email = db.Column(db.String(120), nullable=False)
+    phone = db.Column(db.String(20))
+    state = db.Column(db.String(50))
+    birth_date = db.Column(db.Date)
+    # Set when a director enters the registrant into the tournament
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id', ondelete='SET NULL'))
+
+    tournament = db.relationship('Tournament')
+    player = db.relationship('Player')
+
+    __table_args__ = (
+        db.Index('ix_registration_tournament_status', 'tournament_id', 'status', 'received_at'),
+    )
+
+    @property
+    def name(self):
+        return full_name(self.first_name, None, self.last_name)
+
+class ProvisionalPairing(db.Model):
+    # The next round's pairs, computed in the background by whichever worker saw the result (see prepairing.py)
+    tournament_id = db.Column(db.Integer, db.ForeignKey('tournament.id', ondelete='CASCADE'), primary_key=True)
+    # Digest of what the pairs were computed from
+    key = db.Column(db.String(64), nullable=False)
+    pairs = db.Column(db.Text, nullable=False)  # JSON [[white id, black id or null], ...]
+    computed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
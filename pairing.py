@@ -0,0 +1,90 @@
+"""
+Pairing systems.
+
+Each function takes the players to pair (objects with .rating and
+.current_score) and returns (white, black) tuples; black is None for a bye.
+"""
+import random
+
+def swiss_pairing(players):
+    """
+    Implementation of Swiss pairing system
+    """
+    # Sort players by rating
+    sorted_players = sorted(players, key=lambda x: x.rating, reverse=True)
+    pairs = []
+
+    # Simple pairing: match players with closest ratings
+    for i in range(0, len(sorted_players), 2):
+        if i + 1 < len(sorted_players):
+            # Randomly assign colors
+            if random.random() > 0.5:
+                pairs.append((sorted_players[i], sorted_players[i+1]))
+            else:
+                pairs.append((sorted_players[i+1], sorted_players[i]))
+
+    # If odd number of players, last player gets a bye
+    if len(sorted_players) % 2 == 1:
+        pairs.append((sorted_players[-1], None))
+
+    return pairs
+
+def macmahon_pairing(players):
+    """
+    Implementation of MacMahon pairing system
+    """
+    # Group players by score/rating
+    player_groups = {}
+    for player in players:
+        score = player.current_score
+        if score not in player_groups:
+            player_groups[score] = []
+        player_groups[score].append(player)
+
+    pairs = []
+    unpaired = []
+
+    # Pair within same score groups first
+    for score in sorted(player_groups.keys(), reverse=True):
+        group = player_groups[score]
+        group_pairs = swiss_pairing(group)
+        pairs.extend([p for p in group_pairs if p[1] is not None])
+        if any(p[1] is None for p in group_pairs):
+            unpaired.extend([p[0] for p in group_pairs if p[1] is None])
+
+    # Pair remaining players across groups
+    if unpaired:
+        cross_pairs = swiss_pairing(unpaired)
+        pairs.extend(cross_pairs)
+
+    return pairs
+
+def round_robin_pairing(players):
+    """
+    Implementation of Round Robin pairing system.
+    Creates a schedule where each player plays against every other player once.
+    """
+    if len(players) % 2 != 0:
+        # Add a "bye" player for odd number of players
+        players = players + [None]
+
+    n = len(players)
+    pairings = []
+    for round in range(n - 1):
+        # Generate pairings for this round
+        round_pairings = []
+        for i in range(n // 2):
+            player1 = players[i]
+            player2 = players[n - 1 - i]
+            if player1 and player2:  # Only create pairing if neither player is the "bye"
+                # Alternate colors based on position
+                if i % 2 == 0:
+                    round_pairings.append((player1, player2))
+                else:
+                    round_pairings.append((player2, player1))
+
+        # Rotate players for next round (keep first player fixed)
+        players = [players[0]] + [players[-1]] + players[1:-1]
+        pairings.extend(round_pairings)
+
+    return pairings
@@ -0,0 +1,266 @@
+"""
+Pairing quality harness.
+
+Simulates many tournaments under each pairing system and reports how fair
+they were:
+
+    python pairing_sim.py simulate [--systems swiss macmahon round_robin random]
+                                   [--events 2000] [--players 32] [--rounds 5] [--workers N]
+    python pairing_sim.py recorded        # the same measures for tournaments in the database
+
+Each simulated event draws a field with hidden true strengths and noisy
+starting ratings, then for every round calls the pairing function exactly as
+create_round does, plays every returned game with the Glicko-2 expected score
+of the true strengths, and updates ratings with Glicko2.rate as
+complete_round does.  Byes score a win.  Players carry their real score in
+current_score, as the entrants create_round pairs do (see prepairing.py).
+
+Reported per system, averaged over events:
+  rematches       games between a pair that had already played
+  extra_games     games beyond one per player per round
+  colour          mean and worst |whites - blacks| per player
+  rating gap      rating difference of paired players (p50/p90/max)
+  spearman        rank correlation of final standings with true strength
+  strongest_won   share of events won by the strongest player
+
+Events are split into batches that run in a process pool.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from glicko import Glicko2
+from pairing import swiss_pairing, macmahon_pairing, round_robin_pairing
+
+def random_pairing(players):
+    """Baseline: shuffle and pair neighbours"""
+    shuffled = list(players)
+    random.shuffle(shuffled)
+    pairs = [(shuffled[i], shuffled[i + 1]) for i in range(0, len(shuffled) - 1, 2)]
+    if len(shuffled) % 2:
+        pairs.append((shuffled[-1], None))
+    return pairs
+
+SYSTEMS = {
+    'swiss': swiss_pairing,
+    'macmahon': macmahon_pairing,
+    'round_robin': round_robin_pairing,
+    'random': random_pairing,
+}
+
+class SimPlayer:
+    __slots__ = ('id', 'strength', 'rating', 'rating_deviation', 'volatility', 'current_score', 'whites', 'blacks')
+
+    def __init__(self, id, strength, rating, rating_deviation):
+        self.id = id
+        self.strength = strength
+        self.rating = rating
+        self.rating_deviation = rating_deviation
+        self.volatility = 0.06
+        self.current_score = 0.0
+        self.whites = 0
+        self.blacks = 0
+
+def spearman(xs, ys):
+    """Spearman rank correlation of two equally long sequences without ties"""
+    n = len(xs)
+    if n < 2:
+        return None
+    rank_x = {i: r for r, i in enumerate(sorted(range(n), key=lambda i: xs[i]))}
+    rank_y = {i: r for r, i in enumerate(sorted(range(n), key=lambda i: ys[i]))}
+    d2 = sum((rank_x[i] - rank_y[i]) ** 2 for i in range(n))
+    return 1 - 6 * d2 / (n * (n * n - 1))
+
+def pairing_metrics(rounds, players):
+    """Measures over a list of rounds
+
+    Each round is a list of (white, black, white rating, black rating) as the
+    pairing saw them; black is None for a bye.
+    """
+    pair_counts = Counter()
+    gaps = []
+    extra_games = 0
+    for pairs in rounds:
+        games = Counter()
+        for white, black, white_rating, black_rating in pairs:
+            if black is None:
+                continue
+            pair_counts[frozenset((white.id, black.id))] += 1
+            games[white.id] += 1
+            games[black.id] += 1
+            gaps.append(abs(white_rating - black_rating))
+        extra_games += sum(count - 1 for count in games.values() if count > 1)
+    imbalance = [abs(p.whites - p.blacks) for p in players]
+    return {
+        'rematches': sum(count - 1 for count in pair_counts.values() if count > 1),
+        'extra_games': extra_games,
+        'colour_mean': statistics.fmean(imbalance) if imbalance else 0.0,
+        'colour_max': max(imbalance, default=0),
+        'gaps': gaps,
+    }
+
+def simulate_event(system, n_players, n_rounds, seed):
+    rng = random.Random(seed)
+    # The pairing functions draw colours from the global generator
+    random.seed(seed)
+    glicko2 = Glicko2()
+    players = []
+    for i in range(n_players):
+        strength = rng.gauss(1500, 300)
+        rating_deviation = rng.uniform(60, 350)
+        players.append(SimPlayer(i, strength, strength + rng.gauss(0, rating_deviation), rating_deviation))
+
+    pair_function = SYSTEMS[system]
+    rounds = []
+    for _ in range(n_rounds):
+        pairs = pair_function(players)
+        rounds.append([(white, black, white.rating, black.rating if black else None) for white, black in pairs])
+        results = []
+        for white, black in pairs:
+            if black is None:
+                white.current_score += 1
+                continue
+            white.whites += 1
+            black.blacks += 1
+            white_score = 1.0 if rng.random() < glicko2.expected_score(white.strength, 0, black.strength, 0) else 0.0
+            white.current_score += white_score
+            black.current_score += 1.0 - white_score
+            results.append((white, black, white_score))
+        # Ratings change once the round is complete, from the pre-round values
+        updates = []
+        for white, black, white_score in results:
+            updates.append((white, glicko2.rate(white.rating, white.rating_deviation, white.volatility,
+                                                [(black.rating, black.rating_deviation, white_score)])))
+            updates.append((black, glicko2.rate(black.rating, black.rating_deviation, black.volatility,
+                                                [(white.rating, white.rating_deviation, 1.0 - white_score)])))
+        for player, (rating, rating_deviation, volatility) in updates:
+            player.rating, player.rating_deviation, player.volatility = rating, rating_deviation, volatility
+
+    standings = sorted(players, key=lambda p: (-p.current_score, -p.rating))
+    metrics = pairing_metrics(rounds, players)
+    metrics.update({
+        'spearman': spearman([-i for i in range(len(standings))], [p.strength for p in standings]),
+        'strongest_won': standings[0] is max(players, key=lambda p: p.strength),
+    })
+    return metrics
+
+def run_batch(system, n_players, n_rounds, seeds):
+    return [simulate_event(system, n_players, n_rounds, seed) for seed in seeds]
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+def summarize(events):
+    gaps = [gap for event in events for gap in event['gaps']]
+    correlations = [event['spearman'] for event in events if event.get('spearman') is not None]
+    summary = {
+        'events': len(events),
+        'rematches': statistics.fmean(e['rematches'] for e in events),
+        'extra_games': statistics.fmean(e['extra_games'] for e in events),
+        'colour_mean': statistics.fmean(e['colour_mean'] for e in events),
+        'colour_max': max(e['colour_max'] for e in events),
+        'gap_p50': percentile(gaps, 50),
+        'gap_p90': percentile(gaps, 90),
+        'gap_max': max(gaps, default=None),
+    }
+    if correlations:
+        summary['spearman'] = statistics.fmean(correlations)
+    if events and 'strongest_won' in events[0]:
+        summary['strongest_won'] = statistics.fmean(1.0 if e['strongest_won'] else 0.0 for e in events)
+    return summary
+
+def simulate(systems, events, n_players, n_rounds, workers=None, seed=1, batch_size=50):
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for system in systems:
+            seeds = [seed * 1_000_003 + i for i in range(events)]
+            futures[system] = [pool.submit(run_batch, system, n_players, n_rounds, seeds[i:i + batch_size])
+                               for i in range(0, events, batch_size)]
+        for system, batch_futures in futures.items():
+            results[system] = summarize([event for future in batch_futures for event in future.result()])
+    return results
+
+def recorded_tournaments():
+    """The same measures for the pairings stored in the database, manual ones included"""
+    from app import create_app, db
+    from archive import pairing_history, round_history
+    from models import Tournament, TournamentPlayer
+
+    app = create_app()
+    summaries = []
+    with app.app_context():
+        for tournament in db.session.query(Tournament.id, Tournament.name, Tournament.pairing_system).order_by(Tournament.id):
+            ratings = dict(db.session.query(TournamentPlayer.player_id, TournamentPlayer.initial_rating)
+                           .filter(TournamentPlayer.tournament_id == tournament.id))
+            players = {pid: SimPlayer(pid, 0.0, rating or 1500.0, 0.0) for pid, rating in ratings.items()}
+            rounds = {}
+            for round_number, white_id, black_id in db.session.query(
+                    round_history.c.number, pairing_history.c.white_player_id, pairing_history.c.black_player_id) \
+                    .join(round_history, round_history.c.id == pairing_history.c.round_id) \
+                    .filter(round_history.c.tournament_id == tournament.id):
+                for pid in (white_id, black_id):
+                    players.setdefault(pid, SimPlayer(pid, 0.0, 1500.0, 0.0))
+                white, black = players[white_id], players[black_id]
+                white.whites += 1
+                black.blacks += 1
+                rounds.setdefault(round_number, []).append((white, black, white.rating, black.rating))
+            if not rounds:
+                continue
+            metrics = pairing_metrics(list(rounds.values()), list(players.values()))
+            summary = summarize([metrics])
+            summary.update(id=tournament.id, name=tournament.name, system=tournament.pairing_system)
+            summaries.append(summary)
+    return summaries
+
+def print_table(rows, label_key, label_title):
+    columns = ['rematches', 'extra_games', 'colour_mean', 'colour_max', 'gap_p50', 'gap_p90', 'spearman',
+               'strongest_won']
+    columns = [c for c in columns if any(c in row for row in rows)]
+    print(f"{label_title:<24}" + ''.join(f'{c:>14}' for c in columns))
+    for row in rows:
+        cells = []
+        for column in columns:
+            value = row.get(column)
+            cells.append(f'{"-":>14}' if value is None else f'{value:>14.3f}' if isinstance(value, float) else f'{value:>14}')
+        print(f'{str(row[label_key])[:24]:<24}' + ''.join(cells))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure the fairness of the pairing systems.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    sim = commands.add_parser('simulate')
+    sim.add_argument('--systems', nargs='+', choices=sorted(SYSTEMS), default=['swiss', 'macmahon', 'round_robin', 'random'])
+    sim.add_argument('--events', type=int, default=2000)
+    sim.add_argument('--players', type=int, default=32)
+    sim.add_argument('--rounds', type=int, default=5)
+    sim.add_argument('--workers', type=int, default=os.cpu_count())
+    sim.add_argument('--seed', type=int, default=1)
+    sim.add_argument('--json', action='store_true')
+    recorded = commands.add_parser('recorded')
+    recorded.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.command == 'simulate':
+        results = simulate(args.systems, args.events, args.players, args.rounds, args.workers, args.seed)
+        rows = [dict(summary, system=system) for system, summary in results.items()]
+        label = f'{args.events} x {args.players}p/{args.rounds}r'
+        key = 'system'
+    else:
+        rows = recorded_tournaments()
+        label = 'tournament'
+        key = 'name'
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print_table(rows, key, label)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,216 @@
+"""
+Win probabilities, round forecasts and tournament simulations.
+
+Probabilities are Glicko-2 expected scores with both players' deviations
+taken into account (see Glicko2.expected_score), computed with NumPy for
+whole arrays of pairings at once.  Draws (jigo) are rare enough in Go that
+they are not modelled: every simulated game is a win or a loss.
+
+simulate_tournament() plays the unfinished games of the current rounds and
+any further rounds thousands of times in parallel arrays, one row per run.
+Further rounds are paired Swiss-style by score and then rating within each
+run, ignoring rematches and colours, which is close enough for standings
+and prize odds.  Results are cached per process until a player, entry,
+round or pairing changes.  NumPy is imported when this module is, so import
+it lazily from views.
+"""
+import threading
+from collections import OrderedDict
+import numpy as np
+from app import db
+from glicko import SCALE
+from models import Player, Round, RoundPairing, TournamentPlayer, full_name
+from head_to_head import winner
+from versioning import table_versions
+
+DEFAULT_RUNS = 1000
+# The endpoints are public; only admins may ask for the expensive simulations
+PUBLIC_MAX_RUNS = 1000
+MAX_RUNS = 50000
+# Rounds simulated beyond those created so far; the cost grows with each one
+PUBLIC_MAX_EXTRA_ROUNDS = 3
+MAX_EXTRA_ROUNDS = 20
+# Simulations kept per process
+CACHE_SIZE = 32
+# Tables whose changes can alter a simulation
+SIMULATION_TABLES = ('player', 'tournament_player', 'round', 'round_pairing')
+# Fixed by default so repeated requests return the same numbers
+DEFAULT_SEED = 2024
+
+def _g(phi):
+    return 1.0 / np.sqrt(1.0 + 3.0 * phi**2 / np.pi**2)
+
+def win_probabilities(ratings, rds, opponent_ratings, opponent_rds):
+    """Probability that each player beats the matching opponent, for arrays of any shape"""
+    ratings, rds = np.asarray(ratings, dtype=float), np.asarray(rds, dtype=float)
+    opponent_ratings, opponent_rds = np.asarray(opponent_ratings, dtype=float), np.asarray(opponent_rds, dtype=float)
+    phi = np.sqrt(rds**2 + opponent_rds**2) / SCALE
+    return 1.0 / (1.0 + np.exp(-_g(phi) * (ratings - opponent_ratings) / SCALE))
+
+def probability_matrix(ratings, rds):
+    """P[i, j]: probability that player i beats player j"""
+    ratings, rds = np.asarray(ratings, dtype=float), np.asarray(rds, dtype=float)
+    return win_probabilities(ratings[:, None], rds[:, None], ratings[None, :], rds[None, :])
+
+def _player_ratings(player_ids):
+    rows = db.session.query(Player.id, Player.first_name, Player.middle_name, Player.last_name,
+                            Player.rating, Player.rating_deviation).filter(Player.id.in_(player_ids)).all()
+    return {r.id: (full_name(r.first_name, r.middle_name, r.last_name), r.rating or 1500.0,
+                   r.rating_deviation or 350.0) for r in rows}
+
+def predict_pairs(pairs):
+    """Forecast arbitrary (white id, black id) pairs"""
+    players = _player_ratings({player_id for pair in pairs for player_id in pair})
+    pairs = [pair for pair in pairs if pair[0] in players and pair[1] in players]
+    if not pairs:
+        return []
+    white = np.array([players[w][1:] for w, _ in pairs])
+    black = np.array([players[b][1:] for _, b in pairs])
+    p_white = win_probabilities(white[:, 0], white[:, 1], black[:, 0], black[:, 1])
+    return [
+        {'white_player_id': w, 'white_name': players[w][0], 'white_rating': players[w][1],
+         'black_player_id': b, 'black_name': players[b][0], 'black_rating': players[b][1],
+         'white_win_probability': float(p), 'black_win_probability': float(1.0 - p)}
+        for (w, b), p in zip(pairs, p_white)
+    ]
+
+def round_forecast(round_id):
+    """Win probabilities for every pairing of a round, with results where already known"""
+    pairings = db.session.query(RoundPairing.id, RoundPairing.white_player_id, RoundPairing.black_player_id,
+                                RoundPairing.result) \
+        .filter(RoundPairing.round_id == round_id).order_by(RoundPairing.id).all()
+    forecasts = predict_pairs([(p.white_player_id, p.black_player_id) for p in pairings])
+    by_pair = {(f['white_player_id'], f['black_player_id']): f for f in forecasts}
+    items = []
+    for pairing in pairings:
+        forecast = by_pair.get((pairing.white_player_id, pairing.black_player_id))
+        if forecast is not None:
+            items.append(dict(forecast, pairing_id=pairing.id, result=pairing.result))
+    return {
+        'round_id': round_id,
+        'pairings': items,
+        # Upset: the player given under half a chance won
+        'upsets': sum(1 for i in items if (winner(i['result']) == 'white' and i['white_win_probability'] < 0.5) or
+                      (winner(i['result']) == 'black' and i['black_win_probability'] < 0.5)),
+    }
+
+def max_runs(user):
+    return MAX_RUNS if user.is_authenticated and user.is_admin else PUBLIC_MAX_RUNS
+
+def max_extra_rounds(user):
+    return MAX_EXTRA_ROUNDS if user.is_authenticated and user.is_admin else PUBLIC_MAX_EXTRA_ROUNDS
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def simulate_tournament(tournament_id, total_rounds=None, runs=DEFAULT_RUNS, seed=DEFAULT_SEED, places=3,
+                        extra_rounds=MAX_EXTRA_ROUNDS):
+    """Distribution of final standings over many simulated finishes of the tournament
+
+    total_rounds is the number of rounds the tournament will have; by default
+    only the rounds created so far are played out, and at most extra_rounds
+    more are.  The result is shared, so callers must not change it.
+    """
+    extra_rounds = min(extra_rounds, MAX_EXTRA_ROUNDS)
+    versions = table_versions(*SIMULATION_TABLES)
+    key = (tournament_id, total_rounds, runs, seed, places, extra_rounds,
+           tuple(versions[table] for table in SIMULATION_TABLES))
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    result = _simulate(tournament_id, total_rounds, runs, seed, places, extra_rounds)
+    with _cache_lock:
+        _cache[key] = result
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
+
+def _simulate(tournament_id, total_rounds, runs, seed, places, extra_rounds):
+    entries = db.session.query(TournamentPlayer.player_id).filter(TournamentPlayer.tournament_id == tournament_id)
+    player_ids = sorted({row.player_id for row in entries})
+    players = _player_ratings(player_ids)
+    player_ids = [pid for pid in player_ids if pid in players]
+    n = len(player_ids)
+    rounds = db.session.query(Round.id, Round.number).filter(Round.tournament_id == tournament_id).all()
+    total_rounds = min(max(total_rounds or 0, len(rounds)), len(rounds) + extra_rounds)
+    result = {'tournament_id': tournament_id, 'runs': runs, 'pending_games': 0,
+              'rounds_simulated': total_rounds - len(rounds), 'places': places, 'players': []}
+    if n == 0:
+        return result
+
+    index = {pid: i for i, pid in enumerate(player_ids)}
+    ratings = np.array([players[pid][1] for pid in player_ids])
+    rds = np.array([players[pid][2] for pid in player_ids])
+    p_matrix = probability_matrix(ratings, rds)
+    # 0 for the highest rated; breaks score ties when ranking and pairing
+    rating_rank = np.empty(n, dtype=np.int64)
+    rating_rank[np.argsort(-ratings, kind='stable')] = np.arange(n)
+
+    scores = np.zeros(n)
+    pending_white, pending_black = [], []
+    pairings = db.session.query(RoundPairing.white_player_id, RoundPairing.black_player_id, RoundPairing.result) \
+        .join(Round, Round.id == RoundPairing.round_id).filter(Round.tournament_id == tournament_id).all()
+    for white_id, black_id, game_result in pairings:
+        if white_id not in index or black_id not in index:
+            continue
+        w, b = index[white_id], index[black_id]
+        outcome = winner(game_result)
+        if outcome == 'white':
+            scores[w] += 1
+        elif outcome == 'black':
+            scores[b] += 1
+        elif outcome == 'draw':
+            scores[w] += 0.5
+            scores[b] += 0.5
+        else:
+            pending_white.append(w)
+            pending_black.append(b)
+
+    rng = np.random.default_rng(seed)
+    rows = np.arange(runs)[:, None]
+    totals = np.tile(scores, (runs, 1))
+
+    if pending_white:
+        w, b = np.array(pending_white), np.array(pending_black)
+        white_wins = rng.random((runs, len(w))) < p_matrix[w, b]
+        np.add.at(totals, (rows, w[None, :]), white_wins)
+        np.add.at(totals, (rows, b[None, :]), ~white_wins)
+        result['pending_games'] = len(w)
+
+    def standings_order(totals):
+        # Highest score first, then highest rating; scores are multiples of 0.5
+        return np.argsort(rating_rank[None, :] - totals * 2 * (n + 1), axis=1, kind='stable')
+
+    pairs = n // 2
+    for _ in range(result['rounds_simulated']):
+        order = standings_order(totals)
+        top, bottom = order[:, 0:2 * pairs:2], order[:, 1:2 * pairs:2]
+        top_wins = rng.random((runs, pairs)) < p_matrix[top, bottom]
+        totals[rows, top] += top_wins
+        totals[rows, bottom] += ~top_wins
+        if n % 2:
+            # The odd player out gets a bye worth a win
+            totals[rows[:, 0], order[:, -1]] += 1
+
+    order = standings_order(totals)
+    position = np.empty_like(order)
+    position[rows, order] = np.arange(n)[None, :]
+    distribution = np.bincount((np.arange(n)[None, :] * n + position).ravel(), minlength=n * n).reshape(n, n) / runs
+
+    mean_scores = totals.mean(axis=0)
+    expected_rank = distribution @ np.arange(1, n + 1)
+    for i in np.argsort(expected_rank, kind='stable'):
+        pid = player_ids[i]
+        result['players'].append({
+            'player_id': pid,
+            'name': players[pid][0],
+            'rating': float(ratings[i]),
+            'current_score': float(scores[i]),
+            'expected_score': float(mean_scores[i]),
+            'expected_rank': float(expected_rank[i]),
+            'first_place_probability': float(distribution[i, 0]),
+            'prize_probability': float(distribution[i, :places].sum()),
+            'place_probabilities': [float(p) for p in distribution[i, :places]],
+        })
+    return result
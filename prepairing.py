@@ -0,0 +1,167 @@
+"""
+Provisional next-round pairings, computed in the background.
+
+Every result entered for a tournament schedules it here.  A worker thread
+(one per process, started on first use) waits PREPAIRING_DELAY seconds so
+that a burst of results is paired once, then pairs the entrants exactly as
+create_round would and keeps the pairs together with the key of what they
+were computed from: the number of rounds and the entrants with what the
+tournament's pairing system looks at (ratings, and for MacMahon the score
+so far).
+
+The pairs are stored in ProvisionalPairing with a digest of the key, so
+whichever worker process serves create_round can use them.  create_round
+rebuilds the key, which is two small queries, and publishes the provisional
+pairs when it still matches, deleting the row in the transaction that
+creates the round.  A late result that moves a player to another score
+group, a changed entrant list or a new round all change the key, and the
+round is paired on the spot as before.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+from flask import current_app
+from sqlalchemy.dialects.sqlite import insert
+from app import db
+from models import Player, ProvisionalPairing, Round, Tournament, TournamentPlayer
+from pairing import swiss_pairing, macmahon_pairing, round_robin_pairing
+import results
+
+logger = logging.getLogger(__name__)
+
+# What each pairing system looks at; only these go into the key
+KEY_FIELDS = {
+    'round_robin': ('id',),
+    'macmahon': ('id', 'rating', 'current_score'),
+    'swiss': ('id', 'rating'),
+}
+
+# The pairing functions only need .rating and .current_score
+Entrant = namedtuple('Entrant', 'id rating current_score')
+
+def entrants(tournament_id):
+    """The tournament's players in entry order, with their score in this tournament"""
+    points = results.scores(tournament_id)
+    rows = db.session.query(Player.id, Player.rating).join(TournamentPlayer, TournamentPlayer.player_id == Player.id) \
+        .filter(TournamentPlayer.tournament_id == tournament_id).order_by(TournamentPlayer.id).all()
+    return [Entrant(row.id, row.rating, points.get(row.id, 0.0)) for row in rows]
+
+def pairing_key(system, round_count, players):
+    """Digest of what the system pairs on, the same in every process"""
+    fields = KEY_FIELDS.get(system, KEY_FIELDS['swiss'])
+    key = system, round_count, tuple(tuple(getattr(p, field) for field in fields) for p in players)
+    return hashlib.sha256(repr(key).encode()).hexdigest()
+
+def pair(system, players):
+    """(white id, black id) pairs, black id None for a bye"""
+    if system == 'round_robin':
+        pairs = round_robin_pairing(players)
+    elif system == 'macmahon':
+        pairs = macmahon_pairing(players)
+    else:  # default to Swiss
+        pairs = swiss_pairing(players)
+    return [(white.id, black.id if black is not None else None) for white, black in pairs]
+
+def _inputs(tournament_id):
+    system = db.session.query(Tournament.pairing_system).filter(Tournament.id == tournament_id).scalar()
+    round_count = Round.query.filter_by(tournament_id=tournament_id).count()
+    players = entrants(tournament_id)
+    return system, pairing_key(system, round_count, players), players
+
+class Prepairer(threading.Thread):
+    """Computes the provisional pairs of the tournaments this process has seen results for"""
+
+    def __init__(self, app):
+        super().__init__(name='prepairing', daemon=True)
+        self.app = app
+        self.delay = app.config['PREPAIRING_DELAY']
+        self._due = {}      # tournament id -> time to pair it
+        self._condition = threading.Condition()
+
+    def schedule(self, tournament_id):
+        with self._condition:
+            if not self.is_alive():
+                self.start()
+            self._due[tournament_id] = time.monotonic() + self.delay
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._due:
+                    self._condition.wait()
+                tournament_id, due = min(self._due.items(), key=lambda item: item[1])
+                wait = due - time.monotonic()
+                if wait > 0:
+                    # A later result pushes the time back; look again when woken
+                    self._condition.wait(wait)
+                    continue
+                del self._due[tournament_id]
+            try:
+                self.compute(tournament_id)
+            except Exception:
+                logger.exception('Provisional pairing of tournament %s failed', tournament_id)
+
+    def compute(self, tournament_id):
+        with self.app.app_context():
+            system, key, players = _inputs(tournament_id)
+            if system is None:
+                return
+            stored = db.session.query(ProvisionalPairing.key) \
+                .filter(ProvisionalPairing.tournament_id == tournament_id).scalar()
+            if stored == key:
+                return
+            pairs = pair(system, players)
+            serializer = self.app.extensions.get('write_serializer')
+            if serializer is not None:
+                serializer.acquire()
+            try:
+                values = {'key': key, 'pairs': json.dumps(pairs), 'computed_at': datetime.utcnow()}
+                db.session.execute(insert(ProvisionalPairing).values(tournament_id=tournament_id, **values)
+                                   .on_conflict_do_update(index_elements=[ProvisionalPairing.tournament_id],
+                                                          set_=values))
+                db.session.commit()
+            finally:
+                if serializer is not None:
+                    serializer.release()
+        logger.info('Provisional pairing of tournament %s ready: %d pairs', tournament_id, len(pairs))
+
+def schedule(tournament_id):
+    """Recompute the tournament's provisional pairing soon; call after committing a result"""
+    prepairer = current_app.extensions.get('prepairing')
+    if prepairer is not None:
+        prepairer.schedule(tournament_id)
+
+def take(tournament_id, key):
+    """The stored pairs if they were computed from key; deleted with the caller's commit, so used once"""
+    stored = db.session.get(ProvisionalPairing, tournament_id)
+    if stored is None:
+        return None
+    db.session.delete(stored)
+    if stored.key != key:
+        return None
+    return [(white_id, black_id) for white_id, black_id in json.loads(stored.pairs)]
+
+def discard(tournament_id):
+    """Delete a tournament's stored pairs, e.g. when the tournament is deleted; the caller commits"""
+    ProvisionalPairing.query.filter_by(tournament_id=tournament_id).delete()
+
+def next_pairs(tournament):
+    """(pairs, entrants, precomputed) for the tournament's next round; the caller commits"""
+    system, key, players = _inputs(tournament.id)
+    pairs = take(tournament.id, key)
+    if pairs is not None:
+        return pairs, players, True
+    return pair(system, players), players, False
+
+def init_app(app):
+    app.config.setdefault('PREPAIRING', os.environ.get('PREPAIRING', '1') == '1')
+    app.config.setdefault('PREPAIRING_DELAY', float(os.environ.get('PREPAIRING_DELAY', 1.0)))
+    if app.config['PREPAIRING']:
+        # Started by the first schedule(), so CLI commands never run the thread
+        app.extensions['prepairing'] = Prepairer(app)
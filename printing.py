@@ -0,0 +1,162 @@
+"""
+Printable documents for each round.
+
+For every round there are four print-ready HTML documents, each laid out for
+A4 with print CSS so a browser prints them (or saves them as PDF) as is:
+
+    pairings    pairing sheet by table, and the players by name with their table
+    tables      a card per table with its number and the two players
+    slips       a result slip per table for the players to fill in and sign
+    wallchart   the crosstable through the round, landscape
+
+Rendering them for a big round is too slow to do while a director waits at
+the printer, so a worker thread (one per process, started on first use)
+renders a round's documents PRINT_DELAY seconds after it is created,
+re-paired or given a result, and writes them to PRINT_DIR as
+round-<id>-v<version>-<document>.html.  The round's version changes with
+every such edit (see results.py), so a file is current exactly when its
+version is the round's: serving a document is one small query and a file
+read, in any worker process.  A request for a version not rendered yet
+renders it on the spot and stores it like the worker would.
+"""
+import glob
+import logging
+import os
+import tempfile
+import threading
+import time
+from flask import current_app, render_template
+from app import db
+from models import Round, RoundPairing, TournamentPlayer
+import results
+
+logger = logging.getLogger(__name__)
+
+DOCUMENTS = {
+    'pairings': 'Pairing sheet',
+    'tables': 'Table cards',
+    'slips': 'Result slips',
+    'wallchart': 'Wall chart',
+}
+FILE_NAME = 'round-{}-v{}-{}.html'
+
+def _directory():
+    return current_app.config['PRINT_DIR']
+
+def path(round_id, version, document):
+    return os.path.join(_directory(), FILE_NAME.format(round_id, version, document))
+
+def boards(round):
+    """(table number, pairing) for a round's games, and the entrants with a bye"""
+    pairings = RoundPairing.query.filter_by(round_id=round.id).order_by(RoundPairing.id).all()
+    tables = list(enumerate(pairings, start=1))
+    paired = {p.white_player_id for p in pairings} | {p.black_player_id for p in pairings}
+    byes = [tp.player for tp in TournamentPlayer.query.filter_by(tournament_id=round.tournament_id)
+            .order_by(TournamentPlayer.id) if tp.player_id not in paired]
+    return tables, byes
+
+def render(round):
+    """{document: html} for a round"""
+    tournament = round.tournament
+    tables, byes = boards(round)
+    by_name = sorted([(p.white_player, 'White', table) for table, p in tables] +
+                     [(p.black_player, 'Black', table) for table, p in tables],
+                     key=lambda entry: ((entry[0].last_name or '').lower(), (entry[0].first_name or '').lower()))
+    round_numbers, rows = results.crosstable(tournament, through=round.number)
+    context = dict(round=round, tournament=tournament, tables=tables, byes=byes, by_name=by_name,
+                   round_numbers=round_numbers, rows=rows, titles=DOCUMENTS)
+    return {document: render_template(f'print/{document}.html', **context) for document in DOCUMENTS}
+
+def store(round):
+    """Render a round's documents at its current version and drop older versions"""
+    version = round.version
+    os.makedirs(_directory(), exist_ok=True)
+    documents = render(round)
+    for document, html in documents.items():
+        target = path(round.id, version, document)
+        # The worker thread and a request may store the same round at once; each writes its own file
+        handle, temporary = tempfile.mkstemp(dir=_directory(), suffix='.tmp')
+        with os.fdopen(handle, 'w', encoding='utf-8') as out:
+            out.write(html)
+        os.replace(temporary, target)
+    discard(round.id, keep=version)
+    return version
+
+def discard(round_id, keep=None):
+    """Delete a round's rendered documents older than version keep, or all of them"""
+    prefix = f'round-{round_id}-v'
+    for old in glob.glob(os.path.join(_directory(), FILE_NAME.format(round_id, '*', '*'))):
+        version = os.path.basename(old)[len(prefix):].split('-')[0]
+        # Another process may have rendered a newer version meanwhile; leave it
+        if keep is None or (version.isdigit() and int(version) < keep):
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+def document(round, name):
+    """(file path, rendered now) of a round's document at its current version"""
+    target = path(round.id, round.version, name)
+    if os.path.exists(target):
+        return target, False
+    store(round)
+    return target, True
+
+class Printer(threading.Thread):
+    """Renders the documents of the rounds this process has changed"""
+
+    def __init__(self, app):
+        super().__init__(name='printing', daemon=True)
+        self.app = app
+        self.delay = app.config['PRINT_DELAY']
+        self._due = {}      # round id -> time to render it
+        self._condition = threading.Condition()
+
+    def schedule(self, round_id):
+        with self._condition:
+            if not self.is_alive():
+                self.start()
+            self._due[round_id] = time.monotonic() + self.delay
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._due:
+                    self._condition.wait()
+                round_id, due = min(self._due.items(), key=lambda item: item[1])
+                wait = due - time.monotonic()
+                if wait > 0:
+                    # Another result pushes the time back; look again when woken
+                    self._condition.wait(wait)
+                    continue
+                del self._due[round_id]
+            try:
+                self.render(round_id)
+            except Exception:
+                logger.exception('Rendering the documents of round %s failed', round_id)
+
+    def render(self, round_id):
+        with self.app.app_context():
+            round = db.session.get(Round, round_id)
+            if round is None:
+                discard(round_id)
+                return
+            if all(os.path.exists(path(round.id, round.version, name)) for name in DOCUMENTS):
+                return
+            version = store(round)
+        logger.info('Rendered the documents of round %s at version %s', round_id, version)
+
+def schedule(round_id):
+    """Render the round's documents soon; call after committing a change to the round"""
+    printer = current_app.extensions.get('printing')
+    if printer is not None:
+        printer.schedule(round_id)
+
+def init_app(app):
+    app.config.setdefault('PRINT_DIR', os.environ.get('PRINT_DIR', os.path.join(app.instance_path, 'print')))
+    app.config.setdefault('PRINT_DELAY', float(os.environ.get('PRINT_DELAY', 1.0)))
+    app.config.setdefault('PRINT_IN_BACKGROUND', os.environ.get('PRINT_IN_BACKGROUND', '1') == '1')
+    if app.config['PRINT_IN_BACKGROUND']:
+        # Started by the first schedule(), so CLI commands never run the thread
+        app.extensions['printing'] = Printer(app)
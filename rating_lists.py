@@ -0,0 +1,270 @@
+"""
+Published rating lists.
+
+A rating list freezes every player's current rating and deviation as the
+list of the day it is published, e.g. the federation's official list for a
+quarter.  Each list is one RatingList row whose data is a columnar blob:
+
+    header      b'RL1', flags, player count
+    body        zlib of three little-endian int32 columns:
+                player id gaps, ratings and deviations in hundredths
+
+Most players keep their rating from one list to the next, so a list is
+normally stored as a delta against the previous one: its rating and
+deviation columns hold the change from the base list for players who were
+on it, and the raw value for new players.  Runs of zero compress to almost
+nothing.  Every KEYFRAME_EVERY-th list is stored in full so that decoding
+never walks a long chain.
+
+Decoded lists are kept in a small LRU cache; a player's rating on a date is
+a bisect in the newest list published on or before it, and the changes
+between two lists are one merge walk over their sorted columns:
+
+    python rating_lists.py publish --title "October 2026"
+    python rating_lists.py list
+    python rating_lists.py diff 2026-07-01 2026-10-01
+"""
+import argparse
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import date
+from itertools import accumulate
+from app import db
+from models import Player, RatingList, full_name
+import activity
+
+MAGIC = b'RL1'
+HEADER = struct.Struct('<3sBI')
+DELTA = 0x01
+SCALE = 100
+KEYFRAME_EVERY = 12
+CACHE_SIZE = 16
+
+class RatingListError(Exception):
+    pass
+
+class PublishedList:
+    """Decoded columns of one list, sorted by player id; ratings and deviations in hundredths"""
+
+    def __init__(self, ids, ratings, deviations):
+        self.ids = ids
+        self.ratings = ratings
+        self.deviations = deviations
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, player_id):
+        """(rating, deviation) of a player, or None if they are not on the list"""
+        i = bisect_left(self.ids, player_id)
+        if i == len(self.ids) or self.ids[i] != player_id:
+            return None
+        return self.ratings[i] / SCALE, self.deviations[i] / SCALE
+
+    def ranked(self):
+        """Positions into the columns, best rating first"""
+        return sorted(range(len(self.ids)), key=lambda i: (-self.ratings[i], self.ids[i]))
+
+def _int32(values):
+    column = array('i', values)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column
+
+def encode(current, base=None):
+    """The blob for a PublishedList, delta-encoded against base if given"""
+    ids, ratings, deviations = current.ids, current.ratings, current.deviations
+    gaps = _int32(b - a for a, b in zip([0] + list(ids[:-1]), ids))
+    if base is not None:
+        ratings, deviations = list(ratings), list(deviations)
+        j = 0
+        for i, player_id in enumerate(ids):
+            while j < len(base.ids) and base.ids[j] < player_id:
+                j += 1
+            if j < len(base.ids) and base.ids[j] == player_id:
+                ratings[i] -= base.ratings[j]
+                deviations[i] -= base.deviations[j]
+    body = gaps.tobytes() + _int32(ratings).tobytes() + _int32(deviations).tobytes()
+    return HEADER.pack(MAGIC, DELTA if base is not None else 0, len(ids)) + zlib.compress(body, 9)
+
+def decode(data, base=None):
+    """PublishedList from a blob; base is the decoded base list of a delta"""
+    magic, flags, count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise RatingListError('Not a rating list blob')
+    columns = array('i')
+    columns.frombytes(zlib.decompress(data[HEADER.size:]))
+    if sys.byteorder == 'big':
+        columns.byteswap()
+    if len(columns) != 3 * count:
+        raise RatingListError('Rating list blob is truncated')
+    ids = array('i', accumulate(columns[:count]))
+    ratings, deviations = columns[count:2 * count], columns[2 * count:]
+    if flags & DELTA:
+        if base is None:
+            raise RatingListError('Delta list decoded without its base')
+        j = 0
+        for i, player_id in enumerate(ids):
+            while j < len(base.ids) and base.ids[j] < player_id:
+                j += 1
+            if j < len(base.ids) and base.ids[j] == player_id:
+                ratings[i] += base.ratings[j]
+                deviations[i] += base.deviations[j]
+    return PublishedList(ids, ratings, deviations)
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def load(list_id):
+    """Decoded list by id; lists never change once published, so they are cached by id"""
+    with _cache_lock:
+        if list_id in _cache:
+            _cache.move_to_end(list_id)
+            return _cache[list_id]
+    row = db.session.query(RatingList.base_id, RatingList.data).filter(RatingList.id == list_id).first()
+    if row is None:
+        raise RatingListError(f'No rating list {list_id}')
+    decoded = decode(row.data, load(row.base_id) if row.base_id is not None else None)
+    with _cache_lock:
+        _cache[list_id] = decoded
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return decoded
+
+def current_list():
+    """PublishedList of every player's rating right now"""
+    rows = db.session.query(Player.id, Player.rating, Player.rating_deviation).order_by(Player.id).all()
+    return PublishedList(
+        array('i', (row.id for row in rows)),
+        array('i', (round((row.rating or 0) * SCALE) for row in rows)),
+        array('i', (round((row.rating_deviation or 0) * SCALE) for row in rows)))
+
+def latest():
+    return RatingList.query.order_by(RatingList.published_on.desc()).first()
+
+def published(day):
+    return RatingList.query.filter_by(published_on=day).first()
+
+def as_of(day):
+    """The list in force on a day: the newest one published on or before it"""
+    return RatingList.query.filter(RatingList.published_on <= day) \
+        .order_by(RatingList.published_on.desc()).first()
+
+def not_after_latest(previous):
+    return RatingListError(f'Rating lists must be published after the latest one ({previous.published_on})')
+
+def publish(title=None):
+    """Freeze the current ratings as today's list; the caller commits"""
+    day = date.today()
+    previous = latest()
+    if previous is not None and day <= previous.published_on:
+        raise not_after_latest(previous)
+    current = current_list()
+    keyframe = previous is None or previous.depth + 1 >= KEYFRAME_EVERY
+    base = None if keyframe else load(previous.id)
+    row = RatingList(published_on=day,
+                     title=title or f'Rating list {day.isoformat()}',
+                     player_count=len(current),
+                     base_id=None if keyframe else previous.id,
+                     depth=0 if keyframe else previous.depth + 1,
+                     data=encode(current, base))
+    db.session.add(row)
+    activity.record('rating_list.published', row, f'Published {row.title} with {len(current)} players',
+                    published_on=day.isoformat(), size=len(row.data))
+    return row
+
+def rating_on(player_id, day):
+    """(list, rating, deviation) from the list in force on day, or None"""
+    row = as_of(day)
+    if row is None:
+        return None
+    found = load(row.id).get(player_id)
+    if found is None:
+        return None
+    return (row,) + found
+
+def changes(old, new):
+    """Differences from list old to list new as dicts, biggest gains first
+
+    Players on only one of the lists have None for the other rating and come last.
+    """
+    a, b = load(old.id), load(new.id)
+    entries = []
+    i = j = 0
+    while i < len(a) or j < len(b):
+        if j == len(b) or (i < len(a) and a.ids[i] < b.ids[j]):
+            entries.append((a.ids[i], a.ratings[i], None, a.deviations[i], None))
+            i += 1
+        elif i == len(a) or b.ids[j] < a.ids[i]:
+            entries.append((b.ids[j], None, b.ratings[j], None, b.deviations[j]))
+            j += 1
+        else:
+            if a.ratings[i] != b.ratings[j] or a.deviations[i] != b.deviations[j]:
+                entries.append((a.ids[i], a.ratings[i], b.ratings[j], a.deviations[i], b.deviations[j]))
+            i += 1
+            j += 1
+    entries.sort(key=lambda e: (e[1] is None or e[2] is None, -((e[2] or 0) - (e[1] or 0)), e[0]))
+    return [{
+        'player_id': player_id,
+        'old_rating': old_rating / SCALE if old_rating is not None else None,
+        'new_rating': new_rating / SCALE if new_rating is not None else None,
+        'change': (new_rating - old_rating) / SCALE
+            if old_rating is not None and new_rating is not None else None,
+        'old_deviation': old_deviation / SCALE if old_deviation is not None else None,
+        'new_deviation': new_deviation / SCALE if new_deviation is not None else None,
+    } for player_id, old_rating, new_rating, old_deviation, new_deviation in entries]
+
+def player_names(player_ids):
+    """{id: (player_id, name)} for players that still exist"""
+    rows = db.session.query(Player.id, Player.player_id, Player.first_name, Player.middle_name,
+                            Player.last_name).filter(Player.id.in_(list(player_ids))).all() if player_ids else []
+    return {row.id: (row.player_id, full_name(row.first_name, row.middle_name, row.last_name)) for row in rows}
+
+def _date(value):
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{value!r} is not a YYYY-MM-DD date')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Publish and compare official rating lists.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('publish')
+    command.add_argument('--title')
+    commands.add_parser('list')
+    command = commands.add_parser('diff')
+    command.add_argument('old', type=_date)
+    command.add_argument('new', type=_date)
+    args = parser.parse_args(argv)
+
+    from app import create_app
+    app = create_app()
+    with app.app_context():
+        try:
+            if args.command == 'publish':
+                row = publish(args.title)
+                db.session.commit()
+                print(f'Published {row.title}: {row.player_count} players, {len(row.data)} bytes')
+            elif args.command == 'list':
+                for row in RatingList.query.order_by(RatingList.published_on).all():
+                    kind = 'keyframe' if row.base_id is None else f'delta {row.depth}'
+                    print(f'{row.published_on}  {row.player_count:6} players  {len(row.data):8} bytes  '
+                          f'{kind:12}  {row.title}')
+            else:
+                old, new = published(args.old), published(args.new)
+                if old is None or new is None:
+                    raise RatingListError('Both dates must have a published list')
+                for entry in changes(old, new):
+                    print(entry['player_id'], entry['old_rating'], entry['new_rating'], entry['change'])
+        except RatingListError as exc:
+            print(exc, file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
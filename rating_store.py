@@ -0,0 +1,330 @@
+"""
+In-memory rank indexes of the rating list.
+
+The snapshot holds one small __slots__ record per player and a sorted rank
+index for the overall list and for every ranking view: each state, each age
+band and the players active in the last ACTIVE_DAYS.  Leaderboard pages,
+"#123 in Kerala" ranks and percentiles are binary searches over these
+indexes and never load Player objects.
+
+Each worker keeps its own snapshot.  Changes committed by this process are
+applied incrementally: only the changed players are moved, and only the
+indexes they belong to are copied, so readers keep using the previous
+snapshot without locks.  When the player table's version counter (see
+versioning.py) shows a commit from another process, or the date changes
+(ages and activity are relative to today), the snapshot is rebuilt.
+"""
+import threading
+from array import array
+from bisect import bisect_left, insort
+from datetime import date, timedelta
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from app import db
+from models import INDIAN_STATES, Player, full_name
+from versioning import table_versions
+
+ACTIVE_DAYS = 365
+# (key, label, upper age bound, exclusive); the last band has no bound
+AGE_BANDS = (
+    ('u12', 'Under 12', 12),
+    ('u16', 'Under 16', 16),
+    ('u20', 'Under 20', 20),
+    ('open', '20 to 49', 50),
+    ('senior', '50 and over', None),
+)
+AGE_BAND_LABELS = {key: label for key, label, _ in AGE_BANDS}
+
+def age_on(birth_date, today):
+    return today.year - birth_date.year - ((today.month, today.day) < (birth_date.month, birth_date.day))
+
+def age_band(birth_date, today):
+    if birth_date is None:
+        return None
+    age = age_on(birth_date, today)
+    for key, _, bound in AGE_BANDS:
+        if bound is None or age < bound:
+            return key
+
+class RatingEntry:
+    __slots__ = ('id', 'player_id', 'name', 'state', 'rating', 'rating_deviation', 'volatility',
+                 'last_active', 'birth_date', 'age_band', 'active')
+
+    def __init__(self, id, player_id, name, state, rating, rating_deviation, volatility, last_active,
+                 birth_date, today):
+        self.id = id
+        self.player_id = player_id
+        self.name = name
+        self.state = state
+        self.rating = rating if rating is not None else 0.0
+        self.rating_deviation = rating_deviation
+        self.volatility = volatility
+        self.last_active = last_active
+        self.birth_date = birth_date
+        self.age_band = age_band(birth_date, today)
+        self.active = last_active is not None and last_active.date() >= today - timedelta(days=ACTIVE_DAYS)
+
+    @property
+    def sort_key(self):
+        return (-self.rating, self.id)
+
+    def views(self):
+        """The ranking views (besides the overall list) this player appears in"""
+        views = []
+        if self.state:
+            views.append(('state', self.state))
+        if self.age_band:
+            views.append(('age', self.age_band))
+        if self.active:
+            views.append(('active', None))
+        return views
+
+class RankIndex:
+    """Entries of one ranking view kept sorted by (-rating, id)"""
+
+    __slots__ = ('keys', 'entries')
+
+    def __init__(self, keys=None, entries=None):
+        self.keys = keys if keys is not None else []
+        self.entries = entries if entries is not None else []
+
+    def copy(self):
+        return RankIndex(list(self.keys), list(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def rank(self, entry):
+        i = bisect_left(self.keys, entry.sort_key)
+        if i < len(self.entries) and self.entries[i].id == entry.id:
+            return i + 1
+        return None
+
+    def insert(self, entry):
+        i = bisect_left(self.keys, entry.sort_key)
+        self.keys.insert(i, entry.sort_key)
+        self.entries.insert(i, entry)
+
+    def remove(self, entry):
+        i = bisect_left(self.keys, entry.sort_key)
+        if i < len(self.entries) and self.entries[i].id == entry.id:
+            del self.keys[i]
+            del self.entries[i]
+
+    def page(self, offset=0, limit=None):
+        return self.entries[offset:None if limit is None else offset + limit]
+
+class RatingSnapshot:
+    """Rank indexes of the rating list at one player table version"""
+
+    def __init__(self, version, today, by_id, overall, views, ratings):
+        self.version = version
+        self.today = today
+        self._by_id = by_id
+        self.overall = overall
+        self._views = views
+        # Ascending ratings for percentile searches
+        self._ratings = ratings
+
+    @classmethod
+    def build(cls, version, today, entries):
+        entries = sorted(entries, key=lambda e: e.sort_key)
+        overall = RankIndex([e.sort_key for e in entries], entries)
+        views = {}
+        for entry in entries:
+            for view in entry.views():
+                index = views.get(view)
+                if index is None:
+                    index = views[view] = RankIndex()
+                index.keys.append(entry.sort_key)
+                index.entries.append(entry)
+        ratings = array('d', sorted(e.rating for e in entries))
+        return cls(version, today, {e.id: e for e in entries}, overall, views, ratings)
+
+    def with_changes(self, version, changed, deleted_ids):
+        """A new snapshot with some players replaced, added or removed
+
+        Indexes the changes do not touch are shared with this snapshot.
+        """
+        by_id = dict(self._by_id)
+        overall = self.overall.copy()
+        views = dict(self._views)
+        ratings = array('d', self._ratings)
+        copied = set()
+
+        def view_index(view):
+            if view not in copied:
+                views[view] = views[view].copy() if view in views else RankIndex()
+                copied.add(view)
+            return views[view]
+
+        for player_id in set(deleted_ids) | {e.id for e in changed}:
+            old = by_id.pop(player_id, None)
+            if old is None:
+                continue
+            overall.remove(old)
+            for view in old.views():
+                view_index(view).remove(old)
+            del ratings[bisect_left(ratings, old.rating)]
+        for entry in changed:
+            if entry.id in deleted_ids:
+                continue
+            by_id[entry.id] = entry
+            overall.insert(entry)
+            for view in entry.views():
+                view_index(view).insert(entry)
+            insort(ratings, entry.rating)
+        for view in copied:
+            if not views[view]:
+                del views[view]
+        return RatingSnapshot(version, self.today, by_id, overall, views, ratings)
+
+    @property
+    def entries(self):
+        return self.overall.entries
+
+    def __len__(self):
+        return len(self.overall)
+
+    def get(self, player_id):
+        return self._by_id.get(player_id)
+
+    def view(self, kind=None, value=None):
+        """The rank index of a view: overall, ('state', name), ('age', band) or ('active', None)"""
+        if kind is None:
+            return self.overall
+        return self._views.get((kind, value), RankIndex())
+
+    def top(self, n=10, state=None):
+        return self.view('state', state).page(0, n) if state else self.overall.page(0, n)
+
+    def count(self, state=None):
+        return len(self.view('state', state)) if state else len(self.overall)
+
+    def states(self):
+        return sorted(value for kind, value in self._views if kind == 'state')
+
+    def rank(self, player_id, state=None, kind=None, value=None):
+        """1-based position of the player in the overall list or a view, or None"""
+        entry = self._by_id.get(player_id)
+        if entry is None:
+            return None
+        if state is not None:
+            kind, value = 'state', state
+        return self.view(kind, value).rank(entry)
+
+    def percentile(self, rating):
+        """Percentage of players rated strictly below the given rating"""
+        if not self._ratings:
+            return None
+        return 100.0 * bisect_left(self._ratings, rating) / len(self._ratings)
+
+    def rating_at_percentile(self, percent):
+        if not self._ratings:
+            return None
+        i = min(len(self._ratings) - 1, max(0, int(len(self._ratings) * percent / 100.0)))
+        return self._ratings[i]
+
+def view_title(kind, value):
+    """Heading for a ranking view, or None if the view does not exist"""
+    if kind is None and value is None:
+        return 'All players'
+    if kind == 'state' and value in INDIAN_STATES:
+        return value
+    if kind == 'age' and value in AGE_BAND_LABELS:
+        return AGE_BAND_LABELS[value]
+    if kind == 'active' and value is None:
+        return f'Active in the last {ACTIVE_DAYS} days'
+    return None
+
+def entry_from(row, today):
+    return RatingEntry(row.id, row.player_id, full_name(row.first_name, row.middle_name, row.last_name), row.state,
+                       row.rating, row.rating_deviation, row.volatility, row.last_active, row.birth_date, today)
+
+def load_snapshot(version, today):
+    rows = db.session.query(Player.id, Player.player_id, Player.first_name, Player.middle_name, Player.last_name,
+                            Player.state, Player.rating, Player.rating_deviation, Player.volatility,
+                            Player.last_active, Player.birth_date).all()
+    return RatingSnapshot.build(version, today, [entry_from(row, today) for row in rows])
+
+class RatingStore:
+    def __init__(self):
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        """The current snapshot, rebuilt first if another process changed players or the day rolled over"""
+        version = table_versions('player')['player']
+        today = date.today()
+        current = self._snapshot
+        if current is not None and current.version == version and current.today == today:
+            return current
+        with self._lock:
+            current = self._snapshot
+            if current is None or current.version != version or current.today != today:
+                self._snapshot = current = load_snapshot(version, today)
+            return current
+
+    def apply(self, changed, deleted_ids):
+        """Apply a commit made by this process, which bumped the player table version by one"""
+        with self._lock:
+            current = self._snapshot
+            if current is None:
+                return
+            self._snapshot = current.with_changes(current.version + 1, changed, deleted_ids)
+
+store = RatingStore()
+
+# Session hooks that capture player changes for incremental updates ----------
+
+def _pending(session):
+    return session.info.setdefault('rating_store_changes', ({}, set()))
+
+def _after_flush(session, flush_context):
+    changed, deleted = _pending(session)
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Player) and (obj in session.new or session.is_modified(obj, include_collections=False)):
+            changed[obj.id] = obj
+    for obj in session.deleted:
+        if isinstance(obj, Player):
+            deleted.add(obj.id)
+            changed.pop(obj.id, None)
+
+def _do_orm_execute(orm_execute_state):
+    # Bulk statements bypass the flush, so the changed rows are unknown: rebuild instead
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = getattr(orm_execute_state.statement, 'table', None)
+        if table is not None and table.name == Player.__table__.name:
+            orm_execute_state.session.info['rating_store_bulk'] = True
+
+def _before_commit(session):
+    session.flush()
+    # Read the values now; the objects are expired once the commit finishes
+    changed, deleted = session.info.pop('rating_store_changes', ({}, set()))
+    if session.info.pop('rating_store_bulk', False) or not (changed or deleted):
+        return
+    today = date.today()
+    entries = [
+        RatingEntry(p.id, p.player_id, p.name, p.state, p.rating, p.rating_deviation, p.volatility,
+                    p.last_active, p.birth_date, today)
+        for p in changed.values()
+    ]
+    session.info['rating_store_commit'] = (entries, deleted)
+
+def _after_commit(session):
+    pending = session.info.pop('rating_store_commit', None)
+    if pending is not None:
+        store.apply(*pending)
+
+def _after_rollback(session):
+    for key in ('rating_store_changes', 'rating_store_bulk', 'rating_store_commit'):
+        session.info.pop(key, None)
+
+def init_app(app):
+    for name, listener in (('after_flush', _after_flush),
+                           ('do_orm_execute', _do_orm_execute),
+                           ('before_commit', _before_commit),
+                           ('after_commit', _after_commit),
+                           ('after_rollback', _after_rollback)):
+        if not event.contains(Session, name, listener):
+            event.listen(Session, name, listener)
@@ -0,0 +1,384 @@
+"""
+Public self-registration for tournaments.
+
+Sign-ups for a big open arrive in a rush, and committing each one on its
+own would have every request queue for SQLite's single write lock.  A
+sign-up is instead appended (and fsynced) to this process's journal,
+instance/registrations/registrations-<pid>-<random>.jsonl, and queued in
+memory; the registrant gets their reference and a provisional answer at
+once.  One
+writer thread per process waits REGISTRATION_BATCH_DELAY seconds for more
+sign-ups and commits up to REGISTRATION_BATCH_SIZE of them in a single
+transaction, so a burst costs one write lock per batch instead of one per
+sign-up.  The journal is emptied whenever everything in it is committed.
+
+Capacity is decided in that transaction: places taken are the tournament's
+entrants plus its confirmed registrations, read under the write lock, and
+each sign-up in arrival order is confirmed while places remain and
+waitlisted after that.  A second sign-up with the same email for the same
+tournament is marked duplicate, and one received after registration closed
+is marked closed.  The tournament records when registration stopped being
+open, so a sign-up received in time is not turned away because the batch
+was written after the director closed it.  Cancelling a registration or
+raising the capacity moves the waitlist up.
+
+A process holds an exclusive lock on its journal for as long as it runs.
+When it exits, it waits for its queue to be committed first.  One that dies
+with sign-ups still queued leaves its journal behind, no longer locked, and
+the writer thread picks it up when it starts: serve.py starts it in every
+worker, and elsewhere the first sign-up does.  The random part of the name
+keeps a new process that is given the same pid from writing to it.  Rows
+are keyed by the reference, so a sign-up that was committed before the crash
+is not written twice.
+Directors turn confirmed registrations into entrants with enter(), which
+links them to an existing player with the same email or phone (looked up in
+dedup.py's keys) or creates one.
+"""
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from datetime import date, datetime
+from flask import current_app
+from sqlalchemy import event, func, insert, inspect
+from sqlalchemy.orm import Session
+from app import db
+from models import Player, PlayerKey, Registration, Tournament, TournamentPlayer
+import activity
+import dedup
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_FILE = 'registrations-{}.jsonl'
+FIELDS = ('first_name', 'last_name', 'email', 'phone', 'state', 'birth_date')
+# Statuses that hold a place or a waitlist spot; another sign-up with the same email is a duplicate
+ACTIVE = ('confirmed', 'waitlisted', 'entered')
+RETRY_DELAY = 1.0
+# How long an exiting process waits for its queued sign-ups to be committed
+DRAIN_TIMEOUT = 20.0
+
+def is_open(tournament):
+    return tournament.registration_open and tournament.status == 'upcoming' and not tournament.archive_season
+
+def received_in_time(tournament, received_at):
+    """Whether a sign-up received at received_at came before registration closed"""
+    if is_open(tournament):
+        return True
+    return tournament.registration_closed_at is not None and received_at < tournament.registration_closed_at
+
+def _was_open(tournament):
+    """is_open() with the values the tournament had before this flush"""
+    state = inspect(tournament)
+    def previous(name):
+        history = state.attrs[name].history
+        return history.deleted[0] if history.deleted else getattr(tournament, name)
+    return previous('registration_open') and previous('status') == 'upcoming' and not previous('archive_season')
+
+def _before_flush(session, flush_context, instances):
+    # However registration stops being open (edited, started, completed), note when it did
+    for obj in session.dirty:
+        if not isinstance(obj, Tournament):
+            continue
+        if is_open(obj):
+            obj.registration_closed_at = None
+        elif _was_open(obj):
+            obj.registration_closed_at = datetime.utcnow()
+
+def places_taken(tournament_id):
+    """Entrants plus confirmed registrations not yet entered"""
+    entrants = db.session.query(func.count(TournamentPlayer.id)) \
+        .filter(TournamentPlayer.tournament_id == tournament_id).scalar()
+    confirmed = db.session.query(func.count(Registration.id)) \
+        .filter(Registration.tournament_id == tournament_id, Registration.status == 'confirmed').scalar()
+    return entrants + confirmed
+
+def _owner_alive(journal):
+    """Whether the process that wrote a journal still holds its lock"""
+    try:
+        fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    return False
+
+class RegistrationQueue(threading.Thread):
+    """This process's sign-ups that are not committed yet, and the thread that commits them"""
+
+    def __init__(self, app):
+        super().__init__(name='registration', daemon=True)
+        self.app = app
+        self.directory = app.config['REGISTRATION_DIR']
+        self.delay = app.config['REGISTRATION_BATCH_DELAY']
+        self.batch_size = app.config['REGISTRATION_BATCH_SIZE']
+        self._pending = []
+        self._in_flight = []
+        self._journal = None
+        self._journal_path = os.path.join(self.directory, JOURNAL_FILE.format(f'{os.getpid()}-{secrets.token_hex(4)}'))
+        # Taken before _condition whenever both are held
+        self._journal_lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._draining = False
+
+    def ensure_started(self):
+        """Start the writer thread unless it runs already; it first recovers dead processes' journals"""
+        with self._condition:
+            if not self.is_alive():
+                self.start()
+                atexit.register(self.drain)
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """Wait until everything queued is committed, then remove the journal; called at exit"""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self._draining = True
+            self._condition.notify_all()
+            while self._pending or self._in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning('Exiting with %d registrations queued; they stay in %s',
+                                   len(self._pending) + len(self._in_flight), self._journal_path)
+                    return
+                self._condition.wait(remaining)
+        with self._journal_lock:
+            if self._journal is not None:
+                os.remove(self._journal_path)
+                self._journal.close()
+                self._journal = None
+
+    def _append(self, entries):
+        """Write entries to the journal and queue them; call with _journal_lock held"""
+        if self._journal is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._journal = open(self._journal_path, 'a')
+            fcntl.flock(self._journal, fcntl.LOCK_EX)
+        self._journal.write(''.join(json.dumps(entry, separators=(',', ':')) + '\n' for entry in entries))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self.ensure_started()
+        with self._condition:
+            self._pending.extend(entries)
+            self._condition.notify()
+
+    def submit(self, entry):
+        """Durably queue a sign-up; returns once it would survive a crash"""
+        with self._journal_lock:
+            self._append([entry])
+
+    def pending(self, tournament_id):
+        with self._condition:
+            return sum(1 for entry in self._pending + self._in_flight if entry['tournament_id'] == tournament_id)
+
+    def _recover(self):
+        """Queue the sign-ups left in the journals of processes that died"""
+        for path in sorted(glob.glob(os.path.join(self.directory, JOURNAL_FILE.format('*')))):
+            if path == self._journal_path:
+                continue
+            try:
+                journal = open(path)
+            except FileNotFoundError:
+                continue  # recovered by another process meanwhile
+            with journal:
+                if _owner_alive(journal):
+                    continue
+                entries = [json.loads(line) for line in journal if line.strip()]
+                if entries:
+                    with self._journal_lock:
+                        self._append(entries)
+                    logger.info('Recovered %d queued registrations from %s', len(entries), os.path.basename(path))
+                os.remove(path)
+
+    def run(self):
+        try:
+            self._recover()
+        except Exception:
+            logger.exception('Recovering queued registrations failed')
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                # Let the rush fill the batch, unless the process is exiting
+                self._condition.wait_for(lambda: self._draining, self.delay)
+            with self._condition:
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+                self._in_flight = batch
+            try:
+                self.write(batch)
+            except Exception:
+                logger.exception('Writing %d registrations failed; retrying', len(batch))
+                with self._condition:
+                    self._pending[:0] = batch
+                    self._in_flight = []
+                time.sleep(RETRY_DELAY)
+                continue
+            with self._journal_lock:
+                with self._condition:
+                    self._in_flight = []
+                    if not self._pending and self._journal is not None:
+                        self._journal.truncate(0)
+                    self._condition.notify_all()
+
+    def write(self, batch):
+        serializer = self.app.extensions.get('write_serializer')
+        with self.app.app_context():
+            if serializer is not None:
+                serializer.acquire()
+            try:
+                write_batch(batch)
+            finally:
+                if serializer is not None:
+                    serializer.release()
+
+def write_batch(entries):
+    """Commit queued sign-ups, deciding confirmed, waitlisted, duplicate or closed in arrival order"""
+    # Inserting first takes the write lock, so the places read below cannot change before the commit.
+    # Rows already written before a crash are ignored by their token.
+    db.session.execute(insert(Registration).prefix_with('OR IGNORE'), [{
+        'token': entry['token'], 'tournament_id': entry['tournament_id'], 'status': 'pending',
+        'received_at': datetime.fromisoformat(entry['received_at']),
+        'first_name': entry['first_name'], 'last_name': entry['last_name'], 'email': entry['email'],
+        'phone': entry.get('phone'), 'state': entry.get('state'),
+        'birth_date': date.fromisoformat(entry['birth_date']) if entry.get('birth_date') else None,
+    } for entry in entries])
+    pending = Registration.query.filter(Registration.token.in_([entry['token'] for entry in entries]),
+                                        Registration.status == 'pending') \
+        .order_by(Registration.received_at, Registration.id).all()
+    by_tournament = {}
+    for registration in pending:
+        by_tournament.setdefault(registration.tournament_id, []).append(registration)
+    for tournament_id, signups in by_tournament.items():
+        tournament = db.session.get(Tournament, tournament_id)
+        if tournament is None:
+            for registration in signups:
+                db.session.delete(registration)
+            continue
+        taken = places_taken(tournament_id)
+        seen = {row[0] for row in db.session.query(Registration.email).filter(
+            Registration.tournament_id == tournament_id, Registration.status.in_(ACTIVE),
+            Registration.email.in_({registration.email for registration in signups}))}
+        counts = dict.fromkeys(('confirmed', 'waitlisted', 'duplicate', 'closed'), 0)
+        for registration in signups:
+            if not received_in_time(tournament, registration.received_at):
+                status = 'closed'
+            elif registration.email in seen:
+                status = 'duplicate'
+            elif tournament.capacity is None or taken < tournament.capacity:
+                status = 'confirmed'
+                taken += 1
+            else:
+                status = 'waitlisted'
+            seen.add(registration.email)
+            registration.status = status
+            counts[status] += 1
+        activity.record('registrations.received', tournament,
+                        f'{tournament.name}: {len(signups)} registrations', **counts)
+    db.session.commit()
+
+def _queue():
+    return current_app.extensions.get('registration')
+
+def start(app):
+    """Start the writer thread now rather than at the first sign-up, e.g. when a server worker starts"""
+    app.extensions['registration'].ensure_started()
+
+def submit(tournament, **fields):
+    """Queue a sign-up; returns (token, provisional status)
+
+    The provisional status is what the sign-up would get if every sign-up
+    queued before it in this process were written first.
+    """
+    entry = {field: fields.get(field) for field in FIELDS}
+    entry['email'] = entry['email'].strip().lower()
+    if entry['birth_date'] is not None:
+        entry['birth_date'] = entry['birth_date'].isoformat()
+    entry.update(token=secrets.token_hex(8), tournament_id=tournament.id, received_at=datetime.utcnow().isoformat())
+    queue = _queue()
+    ahead = queue.pending(tournament.id)
+    queue.submit(entry)
+    if tournament.capacity is None or places_taken(tournament.id) + ahead < tournament.capacity:
+        return entry['token'], 'confirmed'
+    return entry['token'], 'waitlisted'
+
+def waitlist_position(registration):
+    if registration.status != 'waitlisted':
+        return None
+    return db.session.query(func.count(Registration.id)).filter(
+        Registration.tournament_id == registration.tournament_id, Registration.status == 'waitlisted',
+        Registration.received_at <= registration.received_at).scalar()
+
+def promote(tournament):
+    """Confirm waitlisted registrations, oldest first, while places remain; the caller commits"""
+    if tournament.capacity is None:
+        free = None
+    else:
+        free = tournament.capacity - places_taken(tournament.id)
+        if free <= 0:
+            return []
+    query = Registration.query.filter_by(tournament_id=tournament.id, status='waitlisted') \
+        .order_by(Registration.received_at, Registration.id)
+    promoted = query.limit(free).all() if free is not None else query.all()
+    for registration in promoted:
+        registration.status = 'confirmed'
+    return promoted
+
+def cancel(registration):
+    """Cancel a registration and move the waitlist up; the caller commits"""
+    was = registration.status
+    registration.status = 'cancelled'
+    activity.record('registration.cancelled', registration, f'{registration.tournament.name}: {registration.name}',
+                    status=was)
+    db.session.flush()
+    return promote(registration.tournament) if was == 'confirmed' else []
+
+def _existing_player(registration):
+    """The one player with the registrant's email or phone, if exactly one has it"""
+    keys = [f'{kind}:{value}' for kind, value in (('email', dedup.normal_email(registration.email)),
+                                                  ('phone', dedup.normal_phone(registration.phone))) if value]
+    if not keys:
+        return None
+    ids = {row[0] for row in db.session.query(PlayerKey.player_id).filter(PlayerKey.key.in_(keys))}
+    return db.session.get(Player, ids.pop()) if len(ids) == 1 else None
+
+def enter(tournament):
+    """Make every confirmed registration an entrant; returns (entered, new players). The caller commits"""
+    entered = set(row[0] for row in db.session.query(TournamentPlayer.player_id)
+                  .filter(TournamentPlayer.tournament_id == tournament.id))
+    registrations = Registration.query.filter_by(tournament_id=tournament.id, status='confirmed') \
+        .order_by(Registration.received_at, Registration.id).all()
+    created = 0
+    for registration in registrations:
+        player = _existing_player(registration)
+        if player is None:
+            player = Player(first_name=registration.first_name, last_name=registration.last_name,
+                            state=registration.state, birth_date=registration.birth_date,
+                            email=registration.email, phone=registration.phone)
+            db.session.add(player)
+            db.session.flush()
+            created += 1
+        if player.id not in entered:
+            db.session.add(TournamentPlayer(tournament_id=tournament.id, player_id=player.id,
+                                            initial_rating=player.rating))
+            entered.add(player.id)
+        registration.status = 'entered'
+        registration.player_id = player.id
+    if registrations:
+        activity.record('registrations.entered', tournament, f'{tournament.name}: {len(registrations)} entrants',
+                        entered=len(registrations), new_players=created)
+    return len(registrations), created
+
+def forget_player(player_id):
+    Registration.query.filter_by(player_id=player_id).update({'player_id': None}, synchronize_session=False)
+
+def init_app(app):
+    app.config.setdefault('REGISTRATION_DIR', os.environ.get(
+        'REGISTRATION_DIR', os.path.join(app.instance_path, 'registrations')))
+    app.config.setdefault('REGISTRATION_BATCH_DELAY', float(os.environ.get('REGISTRATION_BATCH_DELAY', 0.05)))
+    app.config.setdefault('REGISTRATION_BATCH_SIZE', int(os.environ.get('REGISTRATION_BATCH_SIZE', 500)))
+    # Started by serve.py's workers or the first sign-up, so CLI commands never run the thread
+    app.extensions['registration'] = RegistrationQueue(app)
+    if not event.contains(Session, 'before_flush', _before_flush):
+        event.listen(Session, 'before_flush', _before_flush)
@@ -0,0 +1,456 @@
+"""
+Read-only follower instances fed by the primary's change log.
+
+On the primary (REPLICATION_ROLE=primary) SQLite triggers on every table
+append each inserted, updated or deleted row to change_log, in the same
+transaction as the change.  SQLite has a single writer and AUTOINCREMENT
+ids are only kept by committed transactions, so change_log ids are
+contiguous and in commit order; a follower's position is simply the last id
+it applied.  The primary serves:
+
+    GET /replication/snapshot          a consistent copy of the database
+    GET /replication/changes?after=N   the changes after id N, oldest first
+    GET /replication/status            role and position, for monitoring
+
+The first two need the X-Replication-Token header to match REPLICATION_TOKEN.
+
+A follower (REPLICATION_ROLE=follower, REPLICATION_PRIMARY_URL=...) keeps
+its own database file.  A background thread copies the snapshot into it
+when it is empty, behind (the primary pruned changes it still needed) or on
+a different schema, and otherwise polls for changes every
+REPLICATION_INTERVAL seconds and applies each batch in one transaction,
+copying the change_log rows too.  The follower serves the public pages and
+the API itself; every other request, and every write, is redirected to the
+primary, as are uploaded photos, which live outside the database.
+
+Two local processes are enough to try it:
+
+    REPLICATION_ROLE=primary REPLICATION_TOKEN=secret flask --app main run -p 5000
+    REPLICATION_ROLE=follower REPLICATION_TOKEN=secret \\
+        REPLICATION_PRIMARY_URL=http://127.0.0.1:5000 \\
+        SQLALCHEMY_DATABASE_URI=sqlite:////tmp/follower.db flask --app main run -p 5001
+
+The change log grows until pruned on the primary:
+
+    python replication.py prune [--keep 100000]
+
+Schema changes (flask init-db on the primary) make followers copy a new
+snapshot, since their fingerprint no longer matches.
+"""
+import argparse
+import fcntl
+import hashlib
+import hmac
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from flask import Blueprint, abort, current_app, jsonify, redirect, request, send_file
+from app import db
+from backup import copy_database, sqlite_path
+from database import BUSY_TIMEOUT_MS, SAFE_METHODS
+from models import ChangeLog
+
+logger = logging.getLogger(__name__)
+
+CHANGE_TABLE = ChangeLog.__table__.name
+TRIGGER_PREFIX = 'replicate_'
+PAGE_SIZE = 1000
+DEFAULT_KEEP = 100_000
+# Answered by a follower itself; all other requests go to the primary
+FOLLOWER_ENDPOINTS = frozenset([
+    'main.index', 'main.players', 'main.player_stats', 'main.tournaments', 'main.tournament_details',
+    'main.tournament_crosstable', 'main.tournament_forecast', 'main.rankings', 'main.rating_list_index',
+    'main.rating_list', 'main.rating_list_changes', 'main.games', 'main.game_record', 'replication.status', 'static',
+])
+
+replication_bp = Blueprint('replication', __name__, url_prefix='/replication')
+
+# Schema helpers, shared by both roles ----------------------------------------
+
+def _tables(conn):
+    return [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+
+def _columns(conn, table):
+    """Column names, primary key columns, REAL columns and BLOB columns of a table as it exists in the file"""
+    rows = conn.execute(f'PRAGMA table_info("{table}")').fetchall()
+    columns = [row[1] for row in rows]
+    key = [row[1] for row in sorted((r for r in rows if r[5]), key=lambda r: r[5])]
+    # SQLite's rules for REAL affinity
+    real = {row[1] for row in rows
+            if not any(t in row[2].upper() for t in ('INT', 'CHAR', 'CLOB', 'TEXT', 'BLOB'))
+            and any(t in row[2].upper() for t in ('REAL', 'FLOA', 'DOUB'))}
+    binary = {row[1] for row in rows if 'BLOB' in row[2].upper()}
+    return columns, key, real, binary
+
+def schema_fingerprint(conn):
+    """Hash of the table and index definitions; triggers are left out since followers drop them"""
+    rows = conn.execute(
+        "SELECT type, name, sql FROM sqlite_master WHERE type IN ('table', 'index') "
+        "AND name NOT LIKE 'sqlite_%' ORDER BY type, name").fetchall()
+    return hashlib.sha1(repr(rows).encode()).hexdigest()
+
+def _json_object(columns, alias, real=(), binary=()):
+    def value(column):
+        if column in real:
+            # json_object() keeps only 15 digits of a REAL; as text with 17 it round-trips,
+            # and the follower's column affinity turns it back into a REAL
+            return (f"CASE WHEN typeof({alias}.\"{column}\") = 'real' "
+                    f"THEN printf('%!.17g', {alias}.\"{column}\") ELSE {alias}.\"{column}\" END")
+        if column in binary:
+            # JSON cannot hold a BLOB; followers turn the hex back into bytes
+            return (f"CASE WHEN typeof({alias}.\"{column}\") = 'blob' "
+                    f"THEN hex({alias}.\"{column}\") ELSE {alias}.\"{column}\" END")
+        return f'{alias}."{column}"'
+    return 'json_object(' + ', '.join(f"'{column}', {value(column)}" for column in columns) + ')'
+
+def trigger_statements(table, columns, key, real=(), binary=()):
+    """CREATE TRIGGER statements that log the table's row changes, by trigger name"""
+    name = f'{TRIGGER_PREFIX}{table}'
+    new_key, old_key = _json_object(key, 'NEW'), _json_object(key, 'OLD')
+    log_upsert = (f"INSERT INTO {CHANGE_TABLE} (table_name, op, row_key, row_data) "
+                  f"VALUES ('{table}', 'upsert', {new_key}, {_json_object(columns, 'NEW', real, binary)});")
+    log_delete = (f"INSERT INTO {CHANGE_TABLE} (table_name, op, row_key) "
+                  f"VALUES ('{table}', 'delete', {old_key});")
+    # An update that changes the primary key removes the old row on the follower first
+    log_key_change = (f"INSERT INTO {CHANGE_TABLE} (table_name, op, row_key) "
+                      f"SELECT '{table}', 'delete', {old_key} WHERE {old_key} IS NOT {new_key};")
+    return {
+        f'{name}_insert': f'CREATE TRIGGER "{name}_insert" AFTER INSERT ON "{table}" BEGIN {log_upsert} END',
+        f'{name}_update': (f'CREATE TRIGGER "{name}_update" AFTER UPDATE ON "{table}" '
+                           f'BEGIN {log_key_change} {log_upsert} END'),
+        f'{name}_delete': f'CREATE TRIGGER "{name}_delete" AFTER DELETE ON "{table}" BEGIN {log_delete} END',
+    }
+
+def _replication_triggers(conn):
+    return dict(conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND substr(name, 1, ?) = ?",
+        (len(TRIGGER_PREFIX), TRIGGER_PREFIX)).fetchall())
+
+def install_triggers(path):
+    """Create or refresh the logging triggers on every table; returns the number changed"""
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000)
+    try:
+        with conn:
+            tables = _tables(conn)
+            if CHANGE_TABLE not in tables:
+                return 0  # flask init-db has not run yet
+            wanted = {}
+            for table in tables:
+                if table == CHANGE_TABLE:
+                    continue
+                columns, key, real, binary = _columns(conn, table)
+                if not key:
+                    logger.warning('Table %s has no primary key and is not replicated', table)
+                    continue
+                wanted.update(trigger_statements(table, columns, key, real, binary))
+            existing = _replication_triggers(conn)
+            changed = 0
+            for name in existing.keys() - wanted.keys():
+                conn.execute(f'DROP TRIGGER "{name}"')
+                changed += 1
+            for name, sql in wanted.items():
+                if existing.get(name) != sql:
+                    conn.execute(f'DROP TRIGGER IF EXISTS "{name}"')
+                    conn.execute(sql)
+                    changed += 1
+            return changed
+    finally:
+        conn.close()
+
+def drop_triggers(conn):
+    for name in _replication_triggers(conn):
+        conn.execute(f'DROP TRIGGER "{name}"')
+
+def last_change_id(conn):
+    if CHANGE_TABLE not in _tables(conn):
+        return None
+    return conn.execute(f'SELECT coalesce(max(id), 0) FROM {CHANGE_TABLE}').fetchone()[0]
+
+def prune(path, keep=DEFAULT_KEEP):
+    """Delete all but the newest `keep` changes; followers further behind copy a snapshot"""
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000)
+    try:
+        with conn:
+            return conn.execute(f'DELETE FROM {CHANGE_TABLE} WHERE id <= (SELECT max(id) FROM {CHANGE_TABLE}) - ?',
+                                (keep,)).rowcount
+    finally:
+        conn.close()
+
+def _open(path):
+    return sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=BUSY_TIMEOUT_MS / 1000)
+
+# Primary endpoints -------------------------------------------------------------
+
+def _require_primary():
+    if current_app.config['REPLICATION_ROLE'] != 'primary':
+        abort(404)
+    token = current_app.config['REPLICATION_TOKEN']
+    if not token or not hmac.compare_digest(request.headers.get('X-Replication-Token', ''), token):
+        abort(403)
+
+@replication_bp.route('/changes')
+def changes():
+    _require_primary()
+    after = request.args.get('after', 0, type=int)
+    limit = min(max(request.args.get('limit', PAGE_SIZE, type=int), 1), PAGE_SIZE)
+    conn = _open(sqlite_path(db.engine))
+    try:
+        # One read transaction, so the rows and the fingerprint belong together
+        conn.execute('BEGIN')
+        rows = conn.execute(f'SELECT id, table_name, op, row_key, row_data FROM {CHANGE_TABLE} '
+                            f'WHERE id > ? ORDER BY id LIMIT ?', (after, limit)).fetchall()
+        sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (CHANGE_TABLE,)).fetchone()
+        fingerprint = schema_fingerprint(conn)
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    # Ids are contiguous, so a gap after the cursor means the changes were pruned
+    if (rows and rows[0][0] != after + 1) or (not rows and sequence and sequence[0] > after):
+        abort(410)
+    return jsonify({
+        'changes': [
+            {'id': id, 'table': table, 'op': op, 'key': json.loads(key), 'row': json.loads(data) if data else None}
+            for id, table, op, key, data in rows
+        ],
+        'cursor': rows[-1][0] if rows else after,
+        'more': len(rows) == limit,
+        'schema': fingerprint,
+    })
+
+@replication_bp.route('/snapshot')
+def snapshot():
+    _require_primary()
+    fd, tmp_path = tempfile.mkstemp(suffix='.db', dir=current_app.instance_path)
+    os.close(fd)
+    try:
+        copy_database(sqlite_path(db.engine), tmp_path)
+        snapshot_file = open(tmp_path, 'rb')
+    finally:
+        # The open file keeps the data until the response is sent
+        os.unlink(tmp_path)
+    return send_file(snapshot_file, mimetype='application/vnd.sqlite3', as_attachment=True,
+                     download_name='snapshot.db')
+
+@replication_bp.route('/status')
+def status():
+    role = current_app.config['REPLICATION_ROLE']
+    conn = _open(sqlite_path(db.engine))
+    try:
+        cursor = last_change_id(conn)
+    finally:
+        conn.close()
+    payload = {'role': role, 'cursor': cursor}
+    if role == 'follower':
+        payload.update(primary=current_app.config['REPLICATION_PRIMARY_URL'], **follower_state)
+    return jsonify(payload)
+
+# Follower ----------------------------------------------------------------------
+
+# Progress of this process's follower thread, for /replication/status
+follower_state = {'last_sync': None, 'last_error': None, 'snapshots': 0}
+
+class Follower(threading.Thread):
+    """Keeps the local database in step with the primary; safe to start in every worker process"""
+
+    def __init__(self, app):
+        super().__init__(name='replication-follower', daemon=True)
+        self.primary = app.config['REPLICATION_PRIMARY_URL'].rstrip('/')
+        self.token = app.config['REPLICATION_TOKEN'] or ''
+        self.interval = app.config['REPLICATION_INTERVAL']
+        self.workdir = app.instance_path
+        with app.app_context():
+            self.path = sqlite_path(db.engine)
+            self.engine = db.engine
+        self._columns = {}
+
+    def run(self):
+        while True:
+            try:
+                self.sync()
+                follower_state['last_error'] = None
+            except Exception as e:
+                follower_state['last_error'] = str(e)
+                logger.exception('Replication from %s failed', self.primary)
+            time.sleep(self.interval)
+
+    def _get(self, path):
+        request = urllib.request.Request(self.primary + path, headers={'X-Replication-Token': self.token})
+        return urllib.request.urlopen(request, timeout=60)
+
+    def sync(self):
+        os.makedirs(self.workdir, exist_ok=True)
+        with open(os.path.join(self.workdir, 'replication.lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return  # another worker process is applying
+            self._sync()
+
+    def _sync(self):
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_MS / 1000)
+        try:
+            copied = False
+            if last_change_id(conn) is None:
+                self.copy_snapshot(conn)
+                copied = True
+            fingerprint = schema_fingerprint(conn)
+            while True:
+                cursor = last_change_id(conn)
+                try:
+                    with self._get(f'/replication/changes?after={cursor}&limit={PAGE_SIZE}') as response:
+                        data = json.load(response)
+                except urllib.error.HTTPError as e:
+                    if e.code != 410 or copied:
+                        raise
+                    data = None
+                if data is None or data['schema'] != fingerprint:
+                    if copied:
+                        raise RuntimeError('Schema still differs from the primary after copying a snapshot')
+                    self.copy_snapshot(conn)
+                    copied = True
+                    fingerprint = schema_fingerprint(conn)
+                    continue
+                self.apply(conn, data['changes'])
+                follower_state['last_sync'] = time.time()
+                if not data['more']:
+                    return
+        finally:
+            conn.close()
+
+    def copy_snapshot(self, conn):
+        """Replace the local database with the primary's current snapshot"""
+        fd, tmp_path = tempfile.mkstemp(suffix='.db', dir=self.workdir)
+        try:
+            with os.fdopen(fd, 'wb') as out, self._get('/replication/snapshot') as response:
+                while chunk := response.read(1 << 20):
+                    out.write(chunk)
+            source = sqlite3.connect(tmp_path)
+            try:
+                # The backup API swaps the pages in under a lock, so open connections stay valid
+                source.backup(conn)
+            finally:
+                source.close()
+        finally:
+            os.unlink(tmp_path)
+        with conn:
+            drop_triggers(conn)
+        self._columns.clear()
+        # Pooled connections may hold pages of the old file
+        self.engine.dispose()
+        follower_state['snapshots'] += 1
+        logger.info('Copied a snapshot from %s', self.primary)
+
+    def _table(self, conn, table):
+        if table not in self._columns:
+            columns, key, _, binary = _columns(conn, table)
+            if not columns:
+                raise RuntimeError(f'Unknown table {table!r} in the change stream')
+            self._columns[table] = (set(columns), key, binary)
+        return self._columns[table]
+
+    def apply(self, conn, changes):
+        """Apply a batch of changes, and log them locally, in one transaction"""
+        if not changes:
+            return
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            cursor = last_change_id(conn)
+            for change in changes:
+                if change['id'] <= cursor:
+                    continue
+                table = change['table']
+                columns, key, binary = self._table(conn, table)
+                if change['op'] == 'delete':
+                    where = ' AND '.join(f'"{column}" = ?' for column in key)
+                    conn.execute(f'DELETE FROM "{table}" WHERE {where}', [change['key'][column] for column in key])
+                    row_data = None
+                else:
+                    row = {column: value for column, value in change['row'].items() if column in columns}
+                    for column in binary:
+                        if isinstance(row.get(column), str):
+                            row[column] = bytes.fromhex(row[column])
+                    names = list(row)
+                    updates = [name for name in names if name not in key]
+                    conflict = ', '.join(f'"{column}"' for column in key)
+                    action = 'DO UPDATE SET ' + ', '.join(f'"{name}" = excluded."{name}"' for name in updates) \
+                        if updates else 'DO NOTHING'
+                    conn.execute(
+                        f'INSERT INTO "{table}" ({", ".join(f"{chr(34)}{name}{chr(34)}" for name in names)}) '
+                        f'VALUES ({", ".join("?" * len(names))}) ON CONFLICT ({conflict}) {action}',
+                        [row[name] for name in names])
+                    row_data = json.dumps(change['row'], separators=(',', ':'), ensure_ascii=False)
+                conn.execute(f'INSERT INTO {CHANGE_TABLE} (id, table_name, op, row_key, row_data) VALUES (?, ?, ?, ?, ?)',
+                             (change['id'], table, change['op'], json.dumps(change['key'], separators=(',', ':'), ensure_ascii=False),
+                              row_data))
+
+def _follower_routing():
+    """Serve public reads here and send everything else to the primary"""
+    primary = current_app.config['REPLICATION_PRIMARY_URL'].rstrip('/')
+    ready = follower_state['last_sync'] is not None or current_app.extensions.get('replication_ready')
+    if not ready:
+        conn = _open(sqlite_path(db.engine))
+        try:
+            ready = last_change_id(conn) is not None
+        except sqlite3.Error:
+            ready = False
+        finally:
+            conn.close()
+        current_app.extensions['replication_ready'] = ready
+    uploads = request.path.startswith('/static/uploads/')
+    if ready and request.method in SAFE_METHODS and not uploads and \
+            (request.endpoint in FOLLOWER_ENDPOINTS or (request.blueprint == 'api')):
+        return None
+    # 307 keeps the method and body of writes
+    code = 302 if request.method in SAFE_METHODS else 307
+    return redirect(primary + request.full_path.rstrip('?'), code=code)
+
+def init_app(app):
+    app.config.setdefault('REPLICATION_ROLE', os.environ.get('REPLICATION_ROLE') or None)
+    app.config.setdefault('REPLICATION_PRIMARY_URL', os.environ.get('REPLICATION_PRIMARY_URL'))
+    app.config.setdefault('REPLICATION_TOKEN', os.environ.get('REPLICATION_TOKEN'))
+    app.config.setdefault('REPLICATION_INTERVAL', float(os.environ.get('REPLICATION_INTERVAL', 1.0)))
+    app.register_blueprint(replication_bp)
+    role = app.config['REPLICATION_ROLE']
+    if role == 'primary':
+        with app.app_context():
+            path = sqlite_path(db.engine)
+        if path is None:
+            raise RuntimeError('Replication needs a SQLite database')
+        install_triggers(path)
+    elif role == 'follower':
+        if not app.config['REPLICATION_PRIMARY_URL']:
+            raise RuntimeError('REPLICATION_PRIMARY_URL must be set on a follower')
+        # Ahead of CSRF checks and login, which would reject writes meant for the primary
+        app.before_request_funcs.setdefault(None, []).insert(0, _follower_routing)
+        Follower(app).start()
+    elif role is not None:
+        raise RuntimeError(f'Unknown REPLICATION_ROLE {role!r}')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Maintain the replication change log.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    prune_parser = commands.add_parser('prune')
+    prune_parser.add_argument('--keep', type=int, default=DEFAULT_KEEP)
+    commands.add_parser('install-triggers')
+    args = parser.parse_args(argv)
+
+    from app import create_app
+    app = create_app()
+    with app.app_context():
+        path = sqlite_path(db.engine)
+    if args.command == 'prune':
+        print(f'Pruned {prune(path, args.keep)} changes')
+    else:
+        print(f'Created or updated {install_triggers(path)} triggers')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,241 @@
+"""
+Result entry and round completion that stay correct with several directors.
+
+Round and RoundPairing carry a version that is bumped on every change.  Pages
+and API responses include it, and writes send back the version they were
+based on.  A write is a conditional UPDATE ... WHERE version = :seen, so a
+write based on an outdated view changes nothing and raises ConflictError
+instead of silently overwriting someone else's entry.
+
+Entering a result bumps the round's version too (only while the round is not
+completed), and completing a round flips its status with one conditional
+UPDATE before anything else, in the same transaction that rates the games.
+So a round is rated exactly once, a late result cannot slip in after the
+ratings were computed, and completing from a page that has missed a result
+is refused.  Each write starts with its UPDATE, which on SQLite takes the
+write lock before anything is read inside the transaction.
+
+Submitting the same result again, or completing a completed round again, is
+a no-op rather than an error, so retries and double clicks are safe.
+"""
+from datetime import datetime
+from sqlalchemy import update
+from app import db
+from glicko import Glicko2
+from models import Match, Player, Round, RoundPairing, Tournament, TournamentPlayer
+import activity
+import archive
+import head_to_head
+
+VALID_RESULTS = ('B+R', 'W+R', 'B+T', 'W+T', 'Jigo')
+
+class ConflictError(Exception):
+    pass
+
+def game_scores(result):
+    """(white score, black score) for a stored result"""
+    outcome = head_to_head.winner(result)
+    if outcome == 'draw':
+        return 0.5, 0.5
+    if outcome == 'white':
+        return 1.0, 0.0
+    return 0.0, 1.0
+
+def scores(tournament_id):
+    """{player id: points} from the results recorded so far in an unarchived tournament"""
+    points = {}
+    rows = db.session.query(RoundPairing.white_player_id, RoundPairing.black_player_id, RoundPairing.result) \
+        .join(Round, Round.id == RoundPairing.round_id) \
+        .filter(Round.tournament_id == tournament_id, RoundPairing.result.isnot(None))
+    for white_id, black_id, result in rows:
+        white_score, black_score = game_scores(result)
+        points[white_id] = points.get(white_id, 0.0) + white_score
+        points[black_id] = points.get(black_id, 0.0) + black_score
+    return points
+
+def crosstable(tournament, through=None):
+    """(round numbers, rows) of the tournament's crosstable, best score first
+
+    Ties are broken by rating at the start of the tournament.  Each row has a
+    cell per round: (opponent's place, 'w' or 'b', '+', '-', '=' or '?' for no
+    result yet), or None when the player did not play that round.  through
+    leaves out the rounds after that round number.
+    """
+    rounds = sorted((r for r in archive.rounds(tournament) if through is None or r.number <= through),
+                    key=lambda r: r.number)
+    players = {tp.player_id: tp.player for tp in tournament.players}
+    initial = {tp.player_id: tp.initial_rating for tp in tournament.players}
+    games = {player_id: {} for player_id in players}
+    scores = dict.fromkeys(players, 0.0)
+    for round in rounds:
+        for pairing in round.pairings:
+            white_score, black_score = game_scores(pairing.result) if pairing.result else (None, None)
+            for player, opponent, colour, score in (
+                    (pairing.white_player, pairing.black_player, 'w', white_score),
+                    (pairing.black_player, pairing.white_player, 'b', black_score)):
+                players.setdefault(player.id, player)
+                scores[player.id] = scores.get(player.id, 0.0) + (score or 0.0)
+                mark = '?' if score is None else {1.0: '+', 0.0: '-'}.get(score, '=')
+                games.setdefault(player.id, {})[round.number] = (opponent.id, colour, mark)
+
+    order = sorted(players, key=lambda pid: (-scores[pid], -(initial.get(pid) or 0.0), players[pid].name))
+    place = {player_id: i + 1 for i, player_id in enumerate(order)}
+    rows = []
+    for player_id in order:
+        cells = []
+        for round in rounds:
+            game = games[player_id].get(round.number)
+            cells.append((place[game[0]], game[1], game[2]) if game else None)
+        rows.append({
+            'place': place[player_id],
+            'player': players[player_id],
+            'initial_rating': initial.get(player_id),
+            'score': scores[player_id],
+            'games': cells,
+        })
+    return [round.number for round in rounds], rows
+
+def touch_round(round_id):
+    """Bump the version of a round that is not completed; False if it is completed
+
+    Call first in a transaction that changes the round's pairings.
+    """
+    return db.session.execute(
+        update(Round)
+        .where(Round.id == round_id, Round.status != 'completed')
+        .values(version=Round.version + 1)
+        .execution_options(synchronize_session=False)
+    ).rowcount == 1
+
+def record_result(pairing, result, expected_version=None):
+    """Store the result of a pairing and its Match; returns False if it already had that result
+
+    expected_version is the pairing version the caller saw; None accepts the
+    version just loaded.  Raises ConflictError and rolls back if the round is
+    completed or the pairing changed in the meantime.
+    """
+    if result not in VALID_RESULTS:
+        raise ValueError(f'Invalid result {result!r}')
+    seen = db.session.query(RoundPairing.version, RoundPairing.result, Round.status) \
+        .join(Round, Round.id == RoundPairing.round_id).filter(RoundPairing.id == pairing.id).one()
+    if seen.result == result:
+        return False
+    if seen.status == 'completed':
+        raise ConflictError('The round is already completed')
+    if expected_version is not None and expected_version != seen.version:
+        raise ConflictError('Someone else changed this result; reload to see it')
+
+    if not touch_round(pairing.round_id):
+        db.session.rollback()
+        raise ConflictError('The round is already completed')
+    updated = db.session.execute(
+        update(RoundPairing)
+        .where(RoundPairing.id == pairing.id, RoundPairing.version == seen.version)
+        .values(result=result, version=RoundPairing.version + 1)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if updated != 1:
+        db.session.rollback()
+        raise ConflictError('Someone else changed this result; reload to see it')
+    db.session.refresh(pairing)
+    round = pairing.round
+
+    # One Match per pairing; correcting a result updates it
+    match = Match.query.filter_by(pairing_id=pairing.id).first()
+    if match is None and seen.result:
+        # Entered before matches were linked to pairings
+        match = Match.query.filter_by(
+            tournament_id=round.tournament_id,
+            round_number=round.number,
+            black_player_id=pairing.black_player_id,
+            white_player_id=pairing.white_player_id,
+            pairing_id=None,
+        ).order_by(Match.id.desc()).first()
+    if match is None:
+        match = Match(
+            tournament_id=round.tournament_id,
+            round_number=round.number,
+            round_start_time=round.datetime,
+            black_player_id=pairing.black_player_id,
+            white_player_id=pairing.white_player_id,
+            date=datetime.utcnow()
+        )
+        db.session.add(match)
+    else:
+        head_to_head.record_game(match.white_player_id, match.black_player_id, match.result, None, undo=True)
+    match.pairing_id = pairing.id
+    match.result = result
+    head_to_head.record_game(match.white_player_id, match.black_player_id, result, match.date)
+    activity.record('result.corrected' if seen.result else 'result.entered', pairing,
+                    f'{pairing.white_player.name} - {pairing.black_player.name}: {result}',
+                    tournament_id=round.tournament_id, round=round.number, result=result,
+                    previous_result=seen.result)
+    db.session.commit()
+    return True
+
+def complete_round(round, expected_version=None):
+    """Rate the round's games and mark it completed; returns False if it already was
+
+    expected_version is the round version the caller saw; if a result was
+    entered since, ConflictError is raised and nothing changes.
+    """
+    condition = [Round.id == round.id, Round.status != 'completed']
+    if expected_version is not None:
+        condition.append(Round.version == expected_version)
+    updated = db.session.execute(
+        update(Round).where(*condition)
+        .values(status='completed', version=Round.version + 1)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if updated != 1:
+        status = db.session.query(Round.status).filter(Round.id == round.id).scalar()
+        db.session.rollback()
+        if status == 'completed':
+            return False
+        raise ConflictError('Results were entered since this page was loaded; reload and try again')
+    db.session.refresh(round)
+
+    # Everything below reads inside the transaction that now owns the round
+    pairings = RoundPairing.query.filter(RoundPairing.round_id == round.id, RoundPairing.result.isnot(None)) \
+        .populate_existing().all()
+    player_ids = {p.white_player_id for p in pairings} | {p.black_player_id for p in pairings}
+    players = {p.id: p for p in Player.query.filter(Player.id.in_(player_ids)).populate_existing()} \
+        if player_ids else {}
+
+    # A rating period: every player is rated once from the pre-round ratings of their opponents
+    outcomes = {}
+    for pairing in pairings:
+        white, black = players[pairing.white_player_id], players[pairing.black_player_id]
+        white_score, black_score = game_scores(pairing.result)
+        outcomes.setdefault(white.id, []).append((black.rating, black.rating_deviation, white_score))
+        outcomes.setdefault(black.id, []).append((white.rating, white.rating_deviation, black_score))
+    glicko2 = Glicko2()
+    now = datetime.utcnow()
+    new_ratings = {
+        player_id: glicko2.rate(players[player_id].rating, players[player_id].rating_deviation,
+                                players[player_id].volatility, games)
+        for player_id, games in outcomes.items()
+    }
+    for player_id, (rating, rating_deviation, volatility) in new_ratings.items():
+        player = players[player_id]
+        activity.record('player.rated', player, f'{player.name}: {player.rating:.0f} to {rating:.0f}',
+                        tournament_id=round.tournament_id, round=round.number, old_rating=player.rating,
+                        new_rating=rating, old_deviation=player.rating_deviation,
+                        new_deviation=rating_deviation, games=len(outcomes[player_id]))
+        player.rating, player.rating_deviation, player.volatility = rating, rating_deviation, volatility
+        player.last_active = now
+
+    tournament_id = round.tournament_id
+    activity.record('round.completed', round, f'{round.tournament.name}: round {round.number}',
+                    tournament_id=tournament_id, results=len(pairings))
+    open_rounds = Round.query.filter(Round.tournament_id == tournament_id, Round.status != 'completed').count()
+    if open_rounds == 0:
+        db.session.execute(
+            update(Tournament).where(Tournament.id == tournament_id).values(status='completed')
+            .execution_options(synchronize_session=False)
+        )
+        for tp in TournamentPlayer.query.filter_by(tournament_id=tournament_id).populate_existing():
+            tp.final_rating = tp.player.rating
+        activity.record('tournament.completed', ('tournament', tournament_id), f'Tournament: {round.tournament.name}')
+    db.session.commit()
+    return True
@@ -1,14 +1,24 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+import hashlib
 import os
-import random
-from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, jsonify
+from flask import Blueprint, Response, render_template, request, redirect, url_for, flash, current_app, jsonify, abort, send_file
 from flask_login import login_required, current_user
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
 from werkzeug.utils import secure_filename
-import markdown2
 from app import db
-from models import Player, Tournament, Match, TournamentPlayer, Round, RoundPairing
-from forms import PlayerForm, TournamentForm  
-from glicko import Glicko2
+from models import Player, Tournament, Match, TournamentPlayer, Round, RoundPairing, RatingList, GameRecord, Registration, INDIAN_STATES
+from forms import PlayerForm, TournamentForm, RegistrationForm
+from system_stats import collector as stats_collector
+import activity
+import archive
+import dedup
+import head_to_head
+import prepairing
+import printing
+import registration
+import results
+from rating_store import store as rating_store, view_title, AGE_BAND_LABELS
 import logging
 
 main_bp = Blueprint('main', __name__)
@@ -29,7 +39,7 @@ def save_photo(photo, folder):
 
 @main_bp.route('/')
 def index():
-    top_players = Player.query.order_by(Player.rating.desc()).limit(10).all()
+    top_players = rating_store.snapshot().top(10)
     ongoing_tournaments = Tournament.query.filter_by(status='ongoing').all()
     upcoming_tournaments = Tournament.query.filter_by(status='upcoming').all()
     return render_template('home.html', 
@@ -39,7 +49,7 @@ def index():
 
 @main_bp.route('/players')
 def players():
-    players = Player.query.order_by(Player.rating.desc()).all()
+    players = rating_store.snapshot().entries
     return render_template('players.html', players=players)
 
 @main_bp.route('/add_player', methods=['GET', 'POST'])
@@ -52,6 +62,7 @@ def add_player():
             middle_name=form.middle_name.data,
             last_name=form.last_name.data,
             state=form.state.data,
+            birth_date=form.birth_date.data,
             email=form.email.data if current_user.is_admin else None,
             phone=form.phone.data if current_user.is_admin else None
         )
@@ -63,6 +74,7 @@ def add_player():
             player.id_card_photo = save_photo(form.id_card_photo.data, 'id_cards')
 
         db.session.add(player)
+        activity.record('player.created', player, f'Player: {player.name}')
         db.session.commit()
         flash('Player added successfully!')
         return redirect(url_for('main.players'))
@@ -72,9 +84,7 @@ def add_player():
 @main_bp.route('/player/<int:player_id>')
 def player_stats(player_id):
     player = Player.query.get_or_404(player_id)
-    recent_matches = Match.query.filter(
-        (Match.black_player_id == player_id) | (Match.white_player_id == player_id)
-    ).order_by(Match.date.desc()).limit(10).all()
+    recent_matches = archive.recent_matches(player_id, limit=10)
 
     # Calculate win stats
     wins = 0
@@ -126,14 +136,161 @@ def player_stats(player_id):
     # Sort rating history by date
     rating_history.sort(key=lambda x: x['date'])
 
-    print("Debug - win_stats:", win_stats)  # Debug print
-    print("Debug - rating_history:", rating_history)  # Debug print
+    logging.debug("player_stats %s: win_stats=%s rating_history=%s", player_id, win_stats, rating_history)
+
+    ratings = rating_store.snapshot()
+    standing = {
+        'rank': ratings.rank(player_id),
+        'total': len(ratings),
+        'state_rank': ratings.rank(player_id, state=player.state),
+        'state_total': ratings.count(state=player.state),
+        'percentile': ratings.percentile(player.rating),
+    }
 
     return render_template('player_stats.html', 
                          player=player, 
                          recent_matches=recent_matches,
                          win_stats=win_stats,
-                         rating_history=rating_history)
+                         rating_history=rating_history,
+                         standing=standing,
+                         opponents=head_to_head.opponents(player_id, limit=10))
+
+@main_bp.route('/rankings')
+@main_bp.route('/rankings/<kind>')
+@main_bp.route('/rankings/<kind>/<value>')
+def rankings(kind=None, value=None):
+    title = view_title(kind, value)
+    if title is None:
+        abort(404)
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = 100
+    index = rating_store.snapshot().view(kind, value)
+    return render_template('rankings.html',
+                         title=title,
+                         kind=kind,
+                         value=value,
+                         entries=index.page((page - 1) * per_page, per_page),
+                         offset=(page - 1) * per_page,
+                         page=page,
+                         pages=max((len(index) + per_page - 1) // per_page, 1),
+                         total=len(index),
+                         states=INDIAN_STATES,
+                         age_bands=AGE_BAND_LABELS)
+
+def published_list_or_404(published_on):
+    import rating_lists  # imported lazily, only the rating list pages use it
+    try:
+        day = date.fromisoformat(published_on)
+    except ValueError:
+        abort(404)
+    rating_list = rating_lists.published(day)
+    if rating_list is None:
+        abort(404)
+    return rating_list
+
+@main_bp.route('/rating-lists')
+def rating_list_index():
+    return render_template('rating_lists.html',
+                         lists=RatingList.query.order_by(RatingList.published_on.desc()).all())
+
+@main_bp.route('/rating-lists/<published_on>')
+def rating_list(published_on):
+    import rating_lists
+    rating_list = published_list_or_404(published_on)
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = 100
+    decoded = rating_lists.load(rating_list.id)
+    ranked = decoded.ranked()
+    positions = ranked[(page - 1) * per_page:page * per_page]
+    names = rating_lists.player_names([decoded.ids[i] for i in positions])
+    entries = [(decoded.ids[i], names.get(decoded.ids[i]), decoded.ratings[i] / rating_lists.SCALE,
+                decoded.deviations[i] / rating_lists.SCALE) for i in positions]
+    previous = RatingList.query.filter(RatingList.published_on < rating_list.published_on) \
+        .order_by(RatingList.published_on.desc()).first()
+    return render_template('rating_list.html',
+                         rating_list=rating_list,
+                         previous=previous,
+                         entries=entries,
+                         offset=(page - 1) * per_page,
+                         page=page,
+                         pages=max((len(ranked) + per_page - 1) // per_page, 1))
+
+@main_bp.route('/rating-lists/<published_on>/changes')
+def rating_list_changes(published_on):
+    import rating_lists
+    rating_list = published_list_or_404(published_on)
+    since = request.args.get('since')
+    if since:
+        previous = published_list_or_404(since)
+    else:
+        previous = RatingList.query.filter(RatingList.published_on < rating_list.published_on) \
+            .order_by(RatingList.published_on.desc()).first()
+        if previous is None:
+            flash('This is the first published rating list.')
+            return redirect(url_for('main.rating_list', published_on=published_on))
+    entries = rating_lists.changes(previous, rating_list)
+    names = rating_lists.player_names([entry['player_id'] for entry in entries])
+    return render_template('rating_list_changes.html',
+                         rating_list=rating_list,
+                         previous=previous,
+                         entries=entries,
+                         names=names)
+
+@main_bp.route('/rating-lists/publish', methods=['POST'])
+@login_required
+def publish_rating_list():
+    import rating_lists
+    if not current_user.is_admin:
+        flash('Access denied.')
+        return redirect(url_for('main.index'))
+
+    try:
+        rating_list = rating_lists.publish(request.form.get('title') or None)
+        db.session.commit()
+        flash(f'{rating_list.title} published with {rating_list.player_count} players.')
+    except rating_lists.RatingListError as e:
+        db.session.rollback()
+        flash(str(e), 'error')
+    except IntegrityError:
+        # Another admin published today's list between our check and commit
+        db.session.rollback()
+        flash(str(rating_lists.not_after_latest(rating_lists.latest())), 'error')
+    return redirect(url_for('main.rating_list_index'))
+
+@main_bp.route('/games')
+def games():
+    import game_records  # imported lazily, it loads the SGF parser and archive readers
+    import sgf
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = game_records.DEFAULT_LIMIT
+    filters = {
+        'player_id': request.args.get('player', type=int),
+        'opening': request.args.get('opening', '').strip() or None,
+        'board_size': request.args.get('size', sgf.DEFAULT_SIZE, type=int),
+        'min_moves': request.args.get('min_moves', type=int),
+        'max_moves': request.args.get('max_moves', type=int),
+    }
+    try:
+        query = game_records.search(**filters)
+        records = query.offset((page - 1) * per_page).limit(per_page + 1).all()
+    except sgf.SgfError as e:
+        flash(str(e), 'error')
+        records = []
+    player = db.session.get(Player, filters['player_id']) if filters['player_id'] else None
+    return render_template('games.html',
+                         records=records[:per_page],
+                         has_next=len(records) > per_page,
+                         page=page,
+                         filters=filters,
+                         search_args={key: value for key, value in request.args.items() if key != 'page'},
+                         player=player)
+
+@main_bp.route('/game/<int:record_id>.sgf')
+def game_record(record_id):
+    import game_records
+    record = GameRecord.query.get_or_404(record_id)
+    return Response(game_records.sgf_text(record), mimetype='application/x-go-sgf',
+                    headers={'Content-Disposition': f'attachment; filename=game-{record.id}.sgf'})
 
 @main_bp.route('/tournaments')
 def tournaments():
@@ -169,14 +326,15 @@ def add_tournament():
                 state=form.state.data,
                 info=form.info.data,
                 status='upcoming',
-                pairing_system=form.pairing_system.data
+                pairing_system=form.pairing_system.data,
+                registration_open=form.registration_open.data,
+                capacity=form.capacity.data
             )
 
             if form.cover_photo.data and form.cover_photo.data.filename:
                 tournament.cover_photo = save_photo(form.cover_photo.data, 'tournaments')
 
             db.session.add(tournament)
-            db.session.commit()
 
             # Add selected players to the tournament
             for player_id in (form.players.data or []):
@@ -189,6 +347,8 @@ def add_tournament():
                     )
                     db.session.add(tournament_player)
 
+            activity.record('tournament.created', tournament, f'Tournament: {tournament.name}',
+                            pairing_system=tournament.pairing_system, players=len(tournament.players))
             db.session.commit()
             flash('Tournament created successfully!')
             return redirect(url_for('main.tournament_details', tournament_id=tournament.id))
@@ -229,6 +389,8 @@ def edit_tournament(tournament_id):
         tournament.state = form.state.data
         tournament.info = form.info.data
         tournament.pairing_system = form.pairing_system.data
+        tournament.registration_open = form.registration_open.data
+        tournament.capacity = form.capacity.data
 
         # Only update cover photo if a new one is uploaded
         if form.cover_photo.data and hasattr(form.cover_photo.data, 'filename') and form.cover_photo.data.filename:
@@ -262,6 +424,13 @@ def edit_tournament(tournament_id):
                     )
                     db.session.add(tournament_player)
 
+        activity.record('tournament.updated', tournament, f'Tournament: {tournament.name}',
+                        fields=activity.changed_fields(tournament),
+                        players_added=sorted(new_players - current_players),
+                        players_removed=sorted(current_players - new_players))
+        # A higher capacity or fewer entrants frees places for the waitlist
+        db.session.flush()
+        registration.promote(tournament)
         try:
             db.session.commit()
             flash('Tournament updated successfully!')
@@ -280,6 +449,7 @@ def edit_tournament(tournament_id):
 @main_bp.route('/delete_tournament/<int:tournament_id>', methods=['POST'])
 @login_required
 def delete_tournament(tournament_id):
+    import game_records
     if not current_user.is_admin:
         flash('Access denied.')
         return redirect(url_for('main.index'))
@@ -291,7 +461,14 @@ def delete_tournament(tournament_id):
 
     # Delete associated records
     TournamentPlayer.query.filter_by(tournament_id=tournament.id).delete()
+    games = db.session.query(Match.white_player_id, Match.black_player_id, Match.result) \
+        .filter_by(tournament_id=tournament.id).all()
     Match.query.filter_by(tournament_id=tournament.id).delete()
+    head_to_head.forget_games(games)
+    game_records.detach_tournament(tournament.id)
+    Registration.query.filter_by(tournament_id=tournament.id).delete()
+    prepairing.discard(tournament.id)
+    round_ids = [r.id for r in tournament.rounds]
 
     # Delete cover photo if exists
     if tournament.cover_photo:
@@ -300,14 +477,89 @@ def delete_tournament(tournament_id):
         except OSError:
             pass  # Ignore file deletion errors
 
+    activity.record('tournament.deleted', ('tournament', tournament.id), f'Tournament: {tournament.name}',
+                    games=len(games))
     db.session.delete(tournament)
     db.session.commit()
+    for round_id in round_ids:
+        printing.discard(round_id)
     flash('Tournament deleted successfully!')
     return redirect(url_for('main.tournaments'))
 
+@main_bp.route('/tournament/<int:tournament_id>/register', methods=['GET', 'POST'])
+def register(tournament_id):
+    tournament = Tournament.query.get_or_404(tournament_id)
+    if not registration.is_open(tournament):
+        flash('Registration for this tournament is closed.')
+        return redirect(url_for('main.tournament_details', tournament_id=tournament.id))
+
+    form = RegistrationForm()
+    if form.validate_on_submit():
+        # Queued for the batch writer; nothing is written to the database here
+        token, provisional = registration.submit(tournament, **{field: getattr(form, field).data
+                                                                for field in registration.FIELDS})
+        return render_template('registration_received.html', tournament=tournament, token=token,
+                               provisional=provisional, email=form.email.data)
+    return render_template('register.html', form=form, tournament=tournament,
+                           places_left=None if tournament.capacity is None
+                           else max(tournament.capacity - registration.places_taken(tournament.id), 0))
+
+@main_bp.route('/registration/<token>')
+def registration_status(token):
+    entry = Registration.query.filter_by(token=token).first()
+    return render_template('registration_status.html', token=token, registration=entry,
+                           position=registration.waitlist_position(entry) if entry else None)
+
+@main_bp.route('/tournament/<int:tournament_id>/registrations')
+@login_required
+def tournament_registrations(tournament_id):
+    if not current_user.is_admin:
+        flash('Access denied.')
+        return redirect(url_for('main.index'))
+
+    tournament = Tournament.query.get_or_404(tournament_id)
+    entries = Registration.query.filter_by(tournament_id=tournament.id) \
+        .order_by(Registration.received_at, Registration.id).all()
+    return render_template('tournament_registrations.html', tournament=tournament, registrations=entries,
+                           places_taken=registration.places_taken(tournament.id))
+
+@main_bp.route('/tournament/<int:tournament_id>/registrations/enter', methods=['POST'])
+@login_required
+def enter_registrations(tournament_id):
+    if not current_user.is_admin:
+        flash('Access denied.')
+        return redirect(url_for('main.index'))
+
+    tournament = Tournament.query.get_or_404(tournament_id)
+    if tournament.status != 'upcoming':
+        flash('Registrations can only be entered before the tournament starts.')
+        return redirect(url_for('main.tournament_registrations', tournament_id=tournament.id))
+    entered, created = registration.enter(tournament)
+    db.session.commit()
+    flash(f'Entered {entered} registrants, {created} of them as new players.')
+    return redirect(url_for('main.tournament_registrations', tournament_id=tournament.id))
+
+@main_bp.route('/registration/<int:registration_id>/cancel', methods=['POST'])
+@login_required
+def cancel_registration(registration_id):
+    if not current_user.is_admin:
+        flash('Access denied.')
+        return redirect(url_for('main.index'))
+
+    entry = Registration.query.get_or_404(registration_id)
+    if entry.status not in ('confirmed', 'waitlisted'):
+        flash('Only confirmed or waitlisted registrations can be cancelled.')
+    else:
+        promoted = registration.cancel(entry)
+        db.session.commit()
+        flash(f'Registration of {entry.name} cancelled.'
+              + (f' {promoted[0].name} moved up from the waitlist.' if promoted else ''))
+    return redirect(url_for('main.tournament_registrations', tournament_id=entry.tournament_id))
+
 @main_bp.route('/delete_player/<int:player_id>', methods=['POST'])
 @login_required
 def delete_player(player_id):
+    import game_records
     if not current_user.is_admin:
         flash('Access denied.')
         return redirect(url_for('main.index'))
@@ -341,20 +593,92 @@ def delete_player(player_id):
     Match.query.filter(
         (Match.black_player_id == player.id) | (Match.white_player_id == player.id)
     ).delete()
+    archive.forget_player(player.id)
+    head_to_head.forget_player(player.id)
+    game_records.forget_player(player.id)
+    registration.forget_player(player.id)
 
+    activity.record('player.deleted', ('player', player.id), f'Player: {player.name}', player_id=player.player_id)
     db.session.delete(player)
     db.session.commit()
     flash('Player deleted successfully!')
     return redirect(url_for('main.players'))
 
+def _pairing_table_keys(tournament, rounds, games):
+    """{round id: digest of what its pairing table shows} for the completed rounds
+
+    With the round's version this keys the cached table, so a rating change
+    elsewhere keeps it while a renamed player or attached game replaces it.
+    """
+    completed = {r.id: r for r in rounds if r.status == 'completed'}
+    shown = {round_id: [] for round_id in completed}
+    if tournament.archive_season is None and completed:
+        white, black = aliased(Player), aliased(Player)
+        rows = db.session.query(RoundPairing.round_id, RoundPairing.id,
+                                white.id, white.first_name, white.middle_name, white.last_name,
+                                black.id, black.first_name, black.middle_name, black.last_name) \
+            .join(white, white.id == RoundPairing.white_player_id) \
+            .join(black, black.id == RoundPairing.black_player_id) \
+            .filter(RoundPairing.round_id.in_(completed)).order_by(RoundPairing.id)
+        for round_id, pairing_id, *players in rows:
+            shown[round_id].append((pairing_id, *players, games.get(pairing_id)))
+    else:
+        # Archived rounds come with their pairings and players loaded
+        for round_id, round in completed.items():
+            shown[round_id] = [(p.id, p.white_player_id, p.white_player.name, p.black_player_id,
+                                p.black_player.name, games.get(p.id)) for p in round.pairings]
+    return {round_id: hashlib.sha1(repr(rows).encode()).hexdigest() for round_id, rows in shown.items()}
+
 @main_bp.route('/tournament/<int:tournament_id>')
 def tournament_details(tournament_id):
+    import game_records
     tournament = Tournament.query.get_or_404(tournament_id)
-    markdown_html = markdown2.markdown(tournament.info) if tournament.info else ''
+    markdown_html = ''
+    if tournament.info:
+        import markdown2  # imported lazily, it is slow to load and only used here
+        markdown_html = markdown2.markdown(tournament.info)
 
+    rounds = archive.rounds(tournament)
+    games = game_records.for_tournament(tournament.id)
     return render_template('tournament_details.html', 
                          tournament=tournament, 
-                         tournament_info_html=markdown_html)
+                         rounds=rounds,
+                         games=games,
+                         tournament_info_html=markdown_html,
+                         pairing_table_keys=_pairing_table_keys(tournament, rounds, games),
+                         registration_open=registration.is_open(tournament),
+                         registration_count=Registration.query.filter_by(tournament_id=tournament.id).count()
+                         if current_user.is_authenticated and current_user.is_admin else 0,
+                         print_documents=printing.DOCUMENTS)
+
+@main_bp.route('/tournament/<int:tournament_id>/crosstable')
+def tournament_crosstable(tournament_id):
+    tournament = Tournament.query.get_or_404(tournament_id)
+    round_numbers, rows = results.crosstable(tournament)
+    return render_template('tournament_crosstable.html',
+                         tournament=tournament,
+                         round_numbers=round_numbers,
+                         rows=rows)
+
+@main_bp.route('/tournament/<int:tournament_id>/forecast')
+def tournament_forecast(tournament_id):
+    import prediction  # imported lazily, it loads NumPy
+    tournament = Tournament.query.get_or_404(tournament_id)
+    total_rounds = request.args.get('rounds', type=int)
+    runs = min(max(request.args.get('runs', prediction.DEFAULT_RUNS, type=int), 1),
+               prediction.max_runs(current_user))
+    extra_rounds = prediction.max_extra_rounds(current_user)
+    latest_round = Round.query.filter_by(tournament_id=tournament_id).order_by(Round.number.desc()).first()
+    forecast = prediction.round_forecast(latest_round.id) if latest_round else None
+    simulation = prediction.simulate_tournament(tournament_id, total_rounds=total_rounds, runs=runs,
+                                                extra_rounds=extra_rounds)
+    return render_template('tournament_forecast.html',
+                         tournament=tournament,
+                         latest_round=latest_round,
+                         forecast=forecast,
+                         simulation=simulation,
+                         total_rounds=total_rounds,
+                         max_extra_rounds=extra_rounds)
 
 @main_bp.route('/admin/dashboard')
 @login_required
@@ -363,48 +687,18 @@ def admin_dashboard():
         flash('Access denied.')
         return redirect(url_for('main.index'))
 
-    player_stats = {
-        'total': Player.query.count(),
-        'active': Player.query.filter(Player.last_active >= (datetime.utcnow() - timedelta(days=90))).count(),
-        'avg_rating': db.session.query(db.func.avg(Player.rating)).scalar() or 0
-    }
-
-    tournament_stats = {
-        'ongoing': Tournament.query.filter_by(status='ongoing').count(),
-        'upcoming': Tournament.query.filter_by(status='upcoming').count(),
-        'completed': Tournament.query.filter_by(status='completed').count()
-    }
+    # Counters come from one cached snapshot instead of a query per card
+    stats = stats_collector.snapshot(current_app)
+    player_stats = stats['players']
+    tournament_stats = stats['tournaments']
 
     # Add system statistics
-    system_stats = {
-        'db_size': 'N/A',  # This would require additional setup to track
-        'last_backup': datetime.utcnow().strftime('%Y-%m-%d'),
-        'version': '1.0.0'
-    }
-
-    # Get recent activity
-    recent_activity = []
-    # Get last 5 tournaments
-    recent_tournaments = Tournament.query.order_by(Tournament.start_date.desc()).limit(5).all()
-    for tournament in recent_tournaments:
-        recent_activity.append({
-            'date': tournament.start_date,
-            'event_type': 'Tournament Created',
-            'details': f'Tournament: {tournament.name}'
-        })
-
-    # Get last 5 player registrations
-    recent_players = Player.query.order_by(Player.last_active.desc()).limit(5).all()
-    for player in recent_players:
-        recent_activity.append({
-            'date': player.last_active,
-            'event_type': 'Player Registration',
-            'details': f'Player: {player.name}'
-        })
+    system_stats = dict(stats['system'],
+                        request_rates=stats['request_rates'],
+                        refreshed_at=stats['refreshed_at'],
+                        version='1.0.0')
 
-    # Sort combined activity by date
-    recent_activity.sort(key=lambda x: x['date'], reverse=True)
-    recent_activity = recent_activity[:5]  # Keep only the 5 most recent activities
+    recent_activity, _ = activity.page(limit=5)
 
     return render_template('admin/dashboard.html', 
                          player_stats=player_stats,
@@ -412,6 +706,49 @@ def admin_dashboard():
                          system_stats=system_stats,
                          recent_activity=recent_activity)
 
+@main_bp.route('/admin/activity')
+@login_required
+def activity_log():
+    if not current_user.is_admin:
+        flash('Access denied.')
+        return redirect(url_for('main.index'))
+
+    entity_type = request.args.get('entity_type')
+    entity_id = request.args.get('entity_id', type=int)
+    entity = (entity_type, entity_id) if entity_type and entity_id is not None else None
+    events, next_cursor = activity.page(before=request.args.get('before', type=int),
+                                        limit=request.args.get('limit', type=int), entity=entity)
+    return render_template('admin/activity.html', events=events, next_cursor=next_cursor, entity=entity)
+
+@main_bp.route('/admin/duplicates')
+@login_required
+def duplicate_players():
+    if not current_user.is_admin:
+        flash('Access denied.')
+        return redirect(url_for('main.index'))
+
+    limit = 200
+    return render_template('admin/duplicates.html', candidates=dedup.candidates(limit=limit), limit=limit)
+
+@main_bp.route('/admin/duplicates/merge', methods=['POST'])
+@login_required
+def merge_players():
+    if not current_user.is_admin:
+        flash('Access denied.')
+        return redirect(url_for('main.index'))
+
+    keep = Player.query.get_or_404(request.form.get('keep_id', type=int))
+    remove = Player.query.get_or_404(request.form.get('remove_id', type=int))
+    name = remove.name
+    try:
+        moved = dedup.merge(keep, remove)
+    except dedup.MergeError as exc:
+        flash(str(exc))
+        return redirect(url_for('main.duplicate_players'))
+    flash(f"Merged {name} into {keep.name}: {moved['entries']} tournament entries and {moved['matches']} games "
+          f"moved, rating {moved['old_rating']:.0f} to {moved['new_rating']:.0f}.")
+    return redirect(url_for('main.player_stats', player_id=keep.id))
+
 @main_bp.route('/tournament/<int:tournament_id>/complete', methods=['POST'])
 @login_required
 def complete_tournament(tournament_id):
@@ -425,6 +762,7 @@ def complete_tournament(tournament_id):
         return redirect(url_for('main.tournament_details', tournament_id=tournament.id))
 
     # Initialize Glicko2 calculator
+    from glicko import Glicko2
     glicko2 = Glicko2()
 
     # Get all tournament players and their matches
@@ -456,6 +794,10 @@ def complete_tournament(tournament_id):
                                                       player.volatility,
                                                       matches)
 
+            activity.record('player.rated', player, f'{player.name}: {player.rating:.0f} to {new_rating:.0f}',
+                            tournament_id=tournament.id, old_rating=player.rating, new_rating=new_rating,
+                            games=len(matches))
+
             # Update player's rating
             player.rating = new_rating
             player.rating_deviation = new_rd
@@ -467,6 +809,7 @@ def complete_tournament(tournament_id):
 
     # Mark tournament as completed
     tournament.status = 'completed'
+    activity.record('tournament.completed', tournament, f'Tournament: {tournament.name}')
     db.session.commit()
 
     flash('Tournament marked as completed and player ratings have been updated.')
@@ -493,6 +836,7 @@ def edit_player(player_id):
             player.middle_name = form.middle_name.data
             player.last_name = form.last_name.data
             player.state = form.state.data
+            player.birth_date = form.birth_date.data
             if current_user.is_admin:
                 player.email = form.email.data
                 player.phone = form.phone.data
@@ -517,6 +861,8 @@ def edit_player(player_id):
                     except OSError:
                         pass
 
+            activity.record('player.updated', player, f'Player: {player.name}',
+                            fields=activity.changed_fields(player))
             db.session.commit()
             flash('Player updated successfully!')
             return redirect(url_for('main.players'))
@@ -565,6 +911,14 @@ def create_round(tournament_id):
             flash('Invalid date format. Please use YYYY-MM-DDTHH:MM format.', 'error')
             return redirect(url_for('main.tournament_details', tournament_id=tournament_id))
 
+        # Usually paired in the background as the last results came in (see prepairing.py)
+        pairs, entrants, precomputed = prepairing.next_pairs(tournament)
+
+        # Check if we have enough players
+        if len(entrants) < 2:
+            flash('At least 2 players are required to create pairings.', 'error')
+            return redirect(url_for('main.tournament_details', tournament_id=tournament_id))
+
         new_round = Round(
             tournament=tournament,
             number=round_number,
@@ -572,43 +926,29 @@ def create_round(tournament_id):
             status='pending'
         )
         db.session.add(new_round)
-        db.session.commit()
-
-        # Get players and their current ratings
-        tournament_players = [tp.player for tp in tournament.players]
-
-        # Check if we have enough players
-        if len(tournament_players) < 2:
-            flash('At least 2 players are required to create pairings.', 'error')
-            db.session.delete(new_round)
-            db.session.commit()
-            return redirect(url_for('main.tournament_details', tournament_id=tournament_id))
-
-        # Generate pairings based on tournament system
-        if tournament.pairing_system == 'round_robin':
-            pairs = round_robin_pairing(tournament_players)
-        elif tournament.pairing_system == 'macmahon':
-            pairs = macmahon_pairing(tournament_players)
-        else:  # default to Swiss
-            pairs = swiss_pairing(tournament_players)
 
         # Create pairings
-        for white, black in pairs:
-            if black is not None:  # Skip byes
+        for white_id, black_id in pairs:
+            if black_id is not None:  # Skip byes
                 pairing = RoundPairing(
                     round=new_round,
-                    white_player=white,
-                    black_player=black
+                    white_player_id=white_id,
+                    black_player_id=black_id
                 )
                 db.session.add(pairing)
 
+        activity.record('round.created', new_round, f'{tournament.name}: round {round_number}',
+                        tournament_id=tournament.id, pairing_system=tournament.pairing_system,
+                        pairings=len(new_round.pairings), precomputed=precomputed)
         db.session.commit()
+        prepairing.schedule(tournament.id)
+        printing.schedule(new_round.id)
         flash(f'Round {round_number} created successfully!')
 
     except Exception as e:
         db.session.rollback()
         flash(f'Error creating round: {str(e)}', 'error')
-        print(f"Error creating round: {str(e)}")  # Debug log
+        logging.error(f"Error in create_round: {str(e)}")
 
     return redirect(url_for('main.tournament_details', tournament_id=tournament_id))
 
@@ -665,7 +1005,10 @@ def manual_pairing(tournament_id):
         if tournament.status == 'upcoming':
             tournament.status = 'ongoing'
 
+        activity.record('round.created', new_round, f'{tournament.name}: round {round_number}',
+                        tournament_id=tournament.id, pairing_system='manual', pairings=len(new_round.pairings))
         db.session.commit()
+        printing.schedule(new_round.id)
         flash('Manual pairings created successfully.')
     except Exception as e:
         db.session.rollback()
@@ -683,31 +1026,32 @@ def repair_round(round_id):
     round = Round.query.get_or_404(round_id)
 
     try:
+        if not results.touch_round(round_id):
+            return jsonify({'success': False, 'error': 'The round is already completed'}), 409
+        if RoundPairing.query.filter(RoundPairing.round_id == round_id, RoundPairing.result.isnot(None)).count():
+            db.session.rollback()
+            return jsonify({'success': False, 'error': 'Results have been entered for this round'}), 409
+
         # Clear existing pairings
         RoundPairing.query.filter_by(round_id=round_id).delete()
 
-        # Get players and their current ratings
-        tournament_players = [tp.player for tp in round.tournament.players]
-
-        # Generate new pairings based on tournament system
-        if round.tournament.pairing_system == 'round_robin':
-            pairs = round_robin_pairing(tournament_players)
-        elif round.tournament.pairing_system == 'macmahon':
-            pairs = macmahon_pairing(tournament_players)
-        else:  # default to Swiss
-            pairs = swiss_pairing(tournament_players)
+        # Generate new pairings based on tournament system; a fresh draw, not the provisional one
+        pairs = prepairing.pair(round.tournament.pairing_system, prepairing.entrants(round.tournament_id))
 
         # Create new pairings
-        for white, black in pairs:
-            if black is not None:  # Skip byes
+        for white_id, black_id in pairs:
+            if black_id is not None:  # Skip byes
                 pairing = RoundPairing(
                     round=round,
-                    white_player=white,
-                    black_player=black
+                    white_player_id=white_id,
+                    black_player_id=black_id
                 )
                 db.session.add(pairing)
 
+        activity.record('round.repaired', round, f'{round.tournament.name}: round {round.number}',
+                        tournament_id=round.tournament_id, pairings=len(round.pairings))
         db.session.commit()
+        printing.schedule(round_id)
         return jsonify({'success': True})
     except Exception as e:
         db.session.rollback()
@@ -720,186 +1064,84 @@ def update_pairing_result(pairing_id):
         return jsonify({'success': False, 'error': 'Access denied'})
 
     pairing = RoundPairing.query.get_or_404(pairing_id)
+    tournament_id = pairing.round.tournament_id
     result = request.form.get('result')
 
     # Validate result format
-    valid_results = ['B+R', 'W+R', 'B+T', 'W+T', 'Jigo']
-    if result not in valid_results:
+    if result not in results.VALID_RESULTS:
         flash('Invalid result format')
-        return redirect(url_for('main.tournament_details', tournament_id=pairing.round.tournament_id))
-
-    # Update pairing result
-    pairing.result = result
-
-    # Create a match record
-    match = Match(
-        tournament_id=pairing.round.tournament_id,
-        round_number=pairing.round.number,
-        round_start_time=pairing.round.datetime,
-        black_player_id=pairing.black_player_id,
-        white_player_id=pairing.white_player_id,
-        result=result,
-        date=datetime.utcnow()
-    )
+        return redirect(url_for('main.tournament_details', tournament_id=tournament_id))
 
     try:
-        db.session.add(match)
-        db.session.commit()
-        flash('Match result updated successfully')
+        if results.record_result(pairing, result, request.form.get('version', type=int)):
+            prepairing.schedule(tournament_id)
+            printing.schedule(pairing.round_id)
+            flash('Match result updated successfully')
+        else:
+            flash('Result was already recorded')
+    except results.ConflictError as e:
+        flash(str(e))
     except Exception as e:
         db.session.rollback()
         flash(f'Error updating match result: {str(e)}')
 
-    return redirect(url_for('main.tournament_details', tournament_id=pairing.round.tournament_id))
+    return redirect(url_for('main.tournament_details', tournament_id=tournament_id))
 
-@main_bp.route('/tournament/round/<int:round_id>/complete', methods=['POST'])
+@main_bp.route('/tournament/round/<int:round_id>/print/<document>')
 @login_required
-def complete_round(round_id):
+def print_round(round_id, document):
     if not current_user.is_admin:
-        return jsonify({'success': False, 'error': 'Access denied'})
+        flash('Access denied.')
+        return redirect(url_for('main.index'))
+    if document not in printing.DOCUMENTS:
+        abort(404)
 
     round = Round.query.get_or_404(round_id)
+    # Usually rendered in the background when the round last changed (see printing.py)
+    target, rendered_now = printing.document(round, document)
+    if rendered_now:
+        logging.info(f"Rendered the documents of round {round.id} on request")
+    return send_file(target, mimetype='text/html', max_age=0)
 
-    # Update player ratings based on results
-    glicko2 = Glicko2()
+@main_bp.route('/tournament/pairing/<int:pairing_id>/game', methods=['POST'])
+@login_required
+def attach_game_record(pairing_id):
+    import game_records
+    import sgf
+    if not current_user.is_admin:
+        flash('Access denied.')
+        return redirect(url_for('main.index'))
 
-    for pairing in round.pairings:
-        if pairing.result:
-            # Calculate score (1 for win, 0.5 for draw, 0 for loss)
-            if pairing.result == 'Jigo':
-                white_score = black_score = 0.5
-            elif pairing.result.startswith('W+'):
-                white_score, black_score = 1.0, 0.0
-            else:  # B+
-                white_score, black_score = 0.0, 1.0
-
-            # Update white player rating
-            white_matches = [(pairing.black_player.rating, 
-                            pairing.black_player.rating_deviation, 
-                            white_score)]
-            new_white_rating, new_white_rd, new_white_vol = glicko2.rate(
-                pairing.white_player.rating,
-                pairing.white_player.rating_deviation,
-                pairing.white_player.volatility,
-                white_matches
-            )
+    pairing = RoundPairing.query.get_or_404(pairing_id)
+    tournament_id = pairing.round.tournament_id
+    upload = request.files.get('sgf')
+    if not upload or not upload.filename:
+        flash('Please choose an SGF file.', 'error')
+        return redirect(url_for('main.tournament_details', tournament_id=tournament_id))
 
-            # Update black player rating
-            black_matches = [(pairing.white_player.rating, 
-                            pairing.white_player.rating_deviation, 
-                            black_score)]
-            new_black_rating, new_black_rd, new_black_vol = glicko2.rate(
-                pairing.black_player.rating,
-                pairing.black_player.rating_deviation,
-                pairing.black_player.volatility,
-                black_matches
-                        )
-
-            # Save new ratings
-            pairing.white_player.rating = new_white_rating
-            pairing.white_player.rating_deviation = new_white_rd
-            pairing.white_player.volatility = new_white_vol
-            pairing.white_player.last_active = datetime.utcnow()
-
-            pairing.black_player.rating = new_black_rating
-            pairing.black_player.rating_deviation = new_black_rd
-            pairing.black_player.volatility = new_black_vol
-            pairing.black_player.last_active = datetime.utcnow()
-
-    # Mark round as completed
-    round.status = 'completed'
-
-    # Check if this was the last round
-    tournament = round.tournament
-    if all(r.status == 'completed' for r in tournament.rounds):
-        tournament.status = 'completed'
-
-        # Update final ratings for all tournament players
-        for tp in tournament.players:
-            tp.final_rating = tp.player.rating
+    try:
+        record = game_records.attach(upload.read(game_records.MAX_UPLOAD_BYTES + 1), pairing)
+        db.session.commit()
+        flash(f'Game record attached ({record.move_count} moves).')
+    except sgf.SgfError as e:
+        db.session.rollback()
+        flash(f'Could not read the SGF file: {e}', 'error')
+    return redirect(url_for('main.tournament_details', tournament_id=tournament_id))
 
-    db.session.commit()
-    return jsonify({'success': True})
+@main_bp.route('/tournament/round/<int:round_id>/complete', methods=['POST'])
+@login_required
+def complete_round(round_id):
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'error': 'Access denied'})
 
-def swiss_pairing(players):
-    """
-    Implementation of Swiss pairing system
-    """
-    # Sort players by rating
-    sorted_players = sorted(players, key=lambda x: x.rating, reverse=True)
-    pairs = []
-
-    # Simple pairing: match players with closest ratings
-    for i in range(0, len(sorted_players), 2):
-        if i + 1 < len(sorted_players):
-            # Randomly assign colors
-            if random.random() > 0.5:
-                pairs.append((sorted_players[i], sorted_players[i+1]))
-            else:
-                pairs.append((sorted_players[i+1], sorted_players[i]))
-
-    # If odd number of players, last player gets a bye
-    if len(sorted_players) % 2 == 1:
-        pairs.append((sorted_players[-1], None))
-
-    return pairs
-
-def macmahon_pairing(players):
-    """
-    Implementation of MacMahon pairing system
-    """
-    # Group players by score/rating
-    player_groups = {}
-    for player in players:
-        score = player.current_score
-        if score not in player_groups:
-            player_groups[score] = []
-        player_groups[score].append(player)
-
-    pairs = []
-    unpaired = []
-
-    # Pair within same score groups first
-    for score in sorted(player_groups.keys(), reverse=True):
-        group = player_groups[score]
-        group_pairs = swiss_pairing(group)
-        pairs.extend([p for p in group_pairs if p[1] is not None])
-        if any(p[1] is None for p in group_pairs):
-            unpaired.extend([p[0] for p in group_pairs if p[1] is None])
-
-    # Pair remaining players across groups
-    if unpaired:
-        cross_pairs = swiss_pairing(unpaired)
-        pairs.extend(cross_pairs)
-
-    return pairs
-
-def round_robin_pairing(players):
-    """
-    Implementation of Round Robin pairing system.
-    Creates a schedule where each player plays against every other player once.
-    """
-    if len(players) % 2 != 0:
-        # Add a "bye" player for odd number of players
-        players = players + [None]
-
-    n = len(players)
-    pairings = []
-    for round in range(n - 1):
-        # Generate pairings for this round
-        round_pairings = []
-        for i in range(n // 2):
-            player1 = players[i]
-            player2 = players[n - 1 - i]
-            if player1 and player2:  # Only create pairing if neither player is the "bye"
-                # Alternate colors based on position
-                if i % 2 == 0:
-                    round_pairings.append((player1, player2))
-                else:
-                    round_pairings.append((player2, player1))
-
-        # Rotate players for next round (keep first player fixed)
-        players = [players[0]] + [players[-1]] + players[1:-1]
-        pairings.extend(round_pairings)
-
-    return pairings
\ No newline at end of file
+    round = Round.query.get_or_404(round_id)
+    data = request.get_json(silent=True) or {}
+    try:
+        completed = results.complete_round(round, data.get('version'))
+    except results.ConflictError as e:
+        return jsonify({'success': False, 'error': str(e)}), 409
+    if completed:
+        # Completion rates the games, and Swiss and MacMahon pair on the new ratings
+        prepairing.schedule(round.tournament_id)
+        printing.schedule(round.id)
+    return jsonify({'success': True, 'already_completed': not completed})
@@ -0,0 +1,110 @@
+"""
+Production server: the app under gunicorn with several worker processes.
+
+    python serve.py [--bind 0.0.0.0:5000] [--workers N] [--threads N]
+    python serve.py reload      # graceful reload: new workers start, old ones finish their requests
+    python serve.py stop        # graceful shutdown
+
+Worker processes default to 2 * CPU cores + 1 (WEB_WORKERS overrides) and each
+runs WEB_THREADS threads (default 4).  Workers are forked before the app is
+created so no SQLite connection is shared between processes, and write
+requests are serialized across workers (see database.py).  Before the workers
+start, the master brings the database schema up to date like init-db does, so
+a deployment never serves from a database missing newer tables or columns.
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import sys
+
+DEFAULT_BIND = '0.0.0.0:5000'
+DEFAULT_THREADS = 4
+PIDFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'gunicorn.pid')
+
+def default_workers():
+    return int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+
+def server_options(bind, workers, threads, pidfile):
+    return {
+        'bind': bind,
+        'workers': workers,
+        'worker_class': 'gthread',
+        'threads': threads,
+        # Create the app in each worker after the fork
+        'preload_app': False,
+        'pidfile': pidfile,
+        'timeout': 60,
+        'graceful_timeout': 30,
+        'keepalive': 5,
+        # Recycle workers now and then so slow leaks cannot build up during an event
+        'max_requests': 2000,
+        'max_requests_jitter': 200,
+        'accesslog': os.environ.get('ACCESS_LOG', '-') or None,
+        'errorlog': '-',
+        'loglevel': os.environ.get('LOG_LEVEL', 'info').lower(),
+    }
+
+def prepare_database():
+    """Create missing tables and columns once, before any worker starts"""
+    if os.environ.get('REPLICATION_ROLE') == 'follower':
+        return  # A follower takes the primary's schema with its snapshot
+    from app import create_app, db, init_db
+    app = create_app({'BACKUP_INTERVAL_HOURS': 0})
+    with app.app_context():
+        init_db(echo=print)
+        # The workers are forked from this process; they must not share its connections
+        db.engine.dispose()
+
+def run(bind, workers, threads, pidfile=PIDFILE):
+    from gunicorn.app.base import BaseApplication
+
+    class ProductionServer(BaseApplication):
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from app import create_app
+            import registration
+            app = create_app({'SERIALIZE_WRITES': True})
+            # Picks up sign-ups left queued by dead workers without waiting for a new one
+            registration.start(app)
+            return app
+
+    os.makedirs(os.path.dirname(pidfile), exist_ok=True)
+    ProductionServer(server_options(bind, workers, threads, pidfile)).run()
+
+def signal_master(sig, pidfile=PIDFILE):
+    try:
+        with open(pidfile) as f:
+            pid = int(f.read().strip())
+    except (OSError, ValueError):
+        print(f'No running server found ({pidfile})', file=sys.stderr)
+        return 1
+    os.kill(pid, sig)
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the app under a multi-worker WSGI server.')
+    parser.add_argument('command', nargs='?', default='start', choices=['start', 'reload', 'stop'])
+    parser.add_argument('--bind', default=os.environ.get('BIND', DEFAULT_BIND))
+    parser.add_argument('--workers', type=int, default=default_workers())
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('WEB_THREADS', DEFAULT_THREADS)))
+    parser.add_argument('--pidfile', default=PIDFILE)
+    args = parser.parse_args(argv)
+
+    if args.command == 'reload':
+        return signal_master(signal.SIGHUP, args.pidfile)
+    if args.command == 'stop':
+        return signal_master(signal.SIGTERM, args.pidfile)
+    prepare_database()
+    run(args.bind, args.workers, args.threads, args.pidfile)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,247 @@
+"""
+Streaming SGF reader.
+
+games() reads a binary stream in chunks and yields one (raw, Game) pair per
+game tree, so an archive of thousands of games is never held in memory at
+once and the tree of a game is never built.  Only the root node's
+properties and the moves of the main line (the first variation at every
+branch) are looked at:
+
+    with open('season.sgf', 'rb') as f:
+        for raw, game in games(f):
+            print(game.black, game.white, game.result, game.move_count)
+
+raw is the game's own bytes, exactly as they were in the file.  The file
+is read as latin-1, which maps every byte to one character, so raw
+round-trips byte for byte; text properties are decoded with the game's CA
+charset (UTF-8 if it has none).
+
+The opening is the first OPENING_MOVES moves turned to the orientation
+that sorts first among the board's 8 symmetries, so the same opening
+played in another corner gets the same key, and the key of a shorter
+sequence is a prefix of the key of any game starting with it.
+"""
+import io
+import re
+from datetime import date
+
+CHUNK_SIZE = 1 << 16
+# A single property value longer than this means the input is not SGF
+MAX_TOKEN = 1 << 20
+OPENING_MOVES = 8
+DEFAULT_SIZE = 19
+COORDINATES = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+PASS = '--'
+
+TOKEN = re.compile(r'\s*(?:([();])|([A-Za-z]+)\s*((?:\[(?:[^\]\\]|\\.)*\]\s*)+))', re.S)
+# After a property: more of its values may still be in the next chunk
+MORE_VALUES = re.compile(r'\s*(?:\[|$)')
+VALUE = re.compile(r'\[((?:[^\]\\]|\\.)*)\]', re.S)
+SOFT_BREAK = re.compile(r'\\(?:\r\n|\n\r|\n|\r)')
+ESCAPE = re.compile(r'\\(.)', re.S)
+DATE = re.compile(r'(\d{4})-(\d{2})-(\d{2})')
+
+# Root properties kept as text; everything else in the root is ignored
+ROOT_PROPERTIES = ('GM', 'SZ', 'KM', 'HA', 'RE', 'DT', 'PB', 'PW', 'EV', 'CA')
+
+class SgfError(ValueError):
+    pass
+
+def unescape(value):
+    return ESCAPE.sub(r'\1', SOFT_BREAK.sub('', value))
+
+class Game:
+    """Metadata of one game, filled in while its tree is read"""
+
+    def __init__(self):
+        self.root = {}
+        self.setup_stones = 0
+        self.move_count = 0
+        self.moves = []
+
+    def add(self, node, ident, values):
+        if node == 0:
+            if ident in ROOT_PROPERTIES and ident not in self.root:
+                self.root[ident] = unescape(values[0]).strip()
+            elif ident == 'AB':
+                self.setup_stones += len(values)
+        if ident in ('B', 'W'):
+            self.move_count += 1
+            if len(self.moves) < OPENING_MOVES:
+                self.moves.append(values[0].strip())
+
+    def _text(self, ident, limit):
+        value = self.root.get(ident)
+        if not value:
+            return None
+        charset = self.root.get('CA') or 'utf-8'
+        try:
+            text = value.encode('latin-1').decode(charset, 'replace')
+        except (LookupError, UnicodeEncodeError):
+            text = value
+        return ' '.join(text.split())[:limit] or None
+
+    def _number(self, ident, kind):
+        try:
+            return kind(self.root[ident].split(':')[0])
+        except (KeyError, ValueError):
+            return None
+
+    @property
+    def black(self):
+        return self._text('PB', 100)
+
+    @property
+    def white(self):
+        return self._text('PW', 100)
+
+    @property
+    def event(self):
+        return self._text('EV', 100)
+
+    @property
+    def result(self):
+        return self._text('RE', 20)
+
+    @property
+    def komi(self):
+        return self._number('KM', float)
+
+    @property
+    def board_size(self):
+        return self._number('SZ', int) or DEFAULT_SIZE
+
+    @property
+    def handicap(self):
+        handicap = self._number('HA', int)
+        return handicap if handicap is not None else (self.setup_stones if self.setup_stones > 1 else 0)
+
+    @property
+    def played_on(self):
+        match = DATE.search(self.root.get('DT', ''))
+        if match is None:
+            return None
+        try:
+            return date(*map(int, match.groups()))
+        except ValueError:
+            return None
+
+    @property
+    def opening(self):
+        return canonical_opening(self.moves, self.board_size)
+
+def _transforms(size):
+    last = size - 1
+    return (
+        lambda x, y: (x, y), lambda x, y: (last - x, y), lambda x, y: (x, last - y),
+        lambda x, y: (last - x, last - y), lambda x, y: (y, x), lambda x, y: (last - y, x),
+        lambda x, y: (y, last - x), lambda x, y: (last - y, last - x),
+    )
+
+def _point(move, size):
+    """(x, y) of a move, None for a pass"""
+    if len(move) != 2 or (move == 'tt' and size <= 19):
+        return None
+    x, y = COORDINATES.find(move[0]), COORDINATES.find(move[1])
+    if not (0 <= x < size and 0 <= y < size):
+        return None
+    return x, y
+
+def canonical_opening(moves, size=DEFAULT_SIZE):
+    """Comma separated moves in the orientation that sorts first, e.g. 'dd,pp,dp'"""
+    points = [_point(move, size) for move in moves]
+    candidates = []
+    for transform in _transforms(size):
+        candidates.append(','.join(
+            PASS if point is None else ''.join(COORDINATES[c] for c in transform(*point)) for point in points))
+    return min(candidates) if candidates else ''
+
+def opening_key(text, size=DEFAULT_SIZE):
+    """Canonical key of a sequence typed as 'pd dp' or 'pd,dp', for prefix searches"""
+    moves = [move for move in re.split(r'[\s,;]+', text.strip()) if move][:OPENING_MOVES]
+    for move in moves:
+        if move != PASS and _point(move, size) is None:
+            raise SgfError(f'{move!r} is not a point on a {size}x{size} board')
+    return canonical_opening(moves, size)
+
+def games(stream, chunk_size=CHUNK_SIZE):
+    """Yield (raw bytes, Game) for every game tree in a binary stream"""
+    buf = ''
+    pos = 0
+    eof = False
+    depth = 0
+    start = None        # offset in buf where the current game began
+    raw_parts = []      # text of the current game already dropped from buf
+    while True:
+        match = TOKEN.match(buf, pos)
+        if match is None or (not eof and (match.end() == len(buf) or
+                                          (match.group(2) and MORE_VALUES.match(buf, match.end())))):
+            if eof:
+                if depth:
+                    raise SgfError('Unexpected end of SGF data')
+                return
+            if match is None and depth == 0:
+                # Text between games, e.g. a mail header: skip to the next tree
+                next_tree = buf.find('(', pos)
+                pos = next_tree if next_tree >= 0 else len(buf)
+                if next_tree >= 0:
+                    continue
+            elif len(buf) - pos > MAX_TOKEN:
+                raise SgfError('Malformed SGF data')
+            chunk = stream.read(chunk_size)
+            eof = not chunk
+            if start is not None:
+                raw_parts.append(buf[start:pos])
+                start = 0
+            buf = buf[pos:] + chunk.decode('latin-1')
+            pos = 0
+            continue
+        pos = match.end()
+        token = match.group(1)
+        if depth == 0:
+            if token != '(':
+                continue
+            start = match.start(1)
+            raw_parts = []
+            game = Game()
+            node = -1
+            levels = [False]
+            skipping = 0
+            depth = 1
+        elif token == '(':
+            depth += 1
+            if skipping:
+                skipping += 1
+            elif levels[-1]:
+                # Only the first variation is the main line
+                skipping = 1
+            else:
+                levels[-1] = True
+                levels.append(False)
+        elif token == ')':
+            depth -= 1
+            if skipping:
+                skipping -= 1
+            else:
+                levels.pop()
+            if depth == 0:
+                raw = ''.join(raw_parts) + buf[start:match.end(1)]
+                start = None
+                raw_parts = []
+                yield raw.encode('latin-1'), game
+        elif skipping:
+            continue
+        elif token == ';':
+            node += 1
+        elif node >= 0:
+            ident = ''.join(c for c in match.group(2) if c.isupper())
+            game.add(node, ident, VALUE.findall(match.group(3)))
+
+def parse(data):
+    """The single game in an SGF file's bytes"""
+    found = list(games(io.BytesIO(data)))
+    if not found:
+        raise SgfError('No game found in the SGF data')
+    if len(found) > 1:
+        raise SgfError('The SGF data holds more than one game')
+    return found[0]
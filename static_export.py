@@ -0,0 +1,384 @@
+"""
+Static export of the pages that are the bulk of read traffic.
+
+Completed tournaments can no longer be edited or deleted, so their pages and
+crosstables, the player profiles and the rating lists can be served as plain
+files.  The export renders them through the app's own views (as an anonymous
+visitor) into a directory laid out like the URLs:
+
+    tournament/12/index.html               /tournament/12
+    tournament/12/crosstable/index.html    /tournament/12/crosstable
+    player/34/index.html                   /player/34
+    players/index.html, rankings/index.html, rankings/state/Kerala/index.html, ...
+    rating-lists/2026-10-01/index.html     a published list, and .../changes/index.html
+    static/...                             the assets these pages reference
+
+Rankings and published lists are exported as their first page; ?page=N
+stays with the app.
+
+Every page has a digest of the rows it is rendered from, the templates and
+the static files.  manifest.json keeps the digest each file was written for,
+so a run only renders pages whose digest changed and deletes pages that no
+longer exist.  Rendering is split into batches across a process pool; each
+worker builds its own app with its own database connections.  Files are
+replaced atomically, so a file server never sees half a page.
+
+    python static_export.py [--output static_export] [--workers N] [--force]
+
+Run it from cron or after completing a tournament.  Pages are rendered for
+anonymous visitors, so a logged-in admin must always reach the app (the
+exported pages lack the admin controls and contact details).  Completed
+tournaments and published lists never change, so serve those from the
+files; player profiles and rankings change with every rated round and are
+only as current as the last run, so leave them to the app unless stale
+pages are acceptable.  In front of the app, e.g. nginx:
+
+    location /static/ { root /srv/go_stats/static_export; try_files $uri @app; }
+    location ~ ^/(tournament|rating-lists)/ {
+        root /srv/go_stats/static_export;
+        error_page 418 = @app;
+        if ($args) { return 418; }
+        # Anyone who may be logged in: the session and Flask-Login's remember cookie
+        if ($cookie_session) { return 418; }
+        if ($cookie_remember_token) { return 418; }
+        try_files $uri/index.html @app;
+    }
+    location / { try_files /nonexistent @app; }
+"""
+import argparse
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from urllib.parse import unquote
+
+logger = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUTPUT = os.path.join(ROOT, 'static_export')
+MANIFEST = 'manifest.json'
+BATCH_SIZE = 50
+# The export only reads; keep workers from starting the follower or backup threads
+APP_CONFIG = {'REPLICATION_ROLE': None, 'BACKUP_INTERVAL_HOURS': 0, 'PREPAIRING': False, 'PRINT_IN_BACKGROUND': False}
+STATIC_URL = re.compile(r'''/static/([^"'?#\s)]+)''')
+# Never published, even if a page were to link them
+PRIVATE_STATIC = ('uploads/id_cards/',)
+
+def _digest(*parts):
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+def site_digest():
+    """Digest of the templates and static files every page depends on"""
+    digest = hashlib.sha256()
+    for folder in ('templates', 'static'):
+        base = os.path.join(ROOT, folder)
+        for dirpath, dirnames, filenames in os.walk(base):
+            dirnames[:] = sorted(d for d in dirnames if os.path.join(dirpath, d) != os.path.join(base, 'uploads'))
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                digest.update(os.path.relpath(path, ROOT).encode())
+                with open(path, 'rb') as f:
+                    digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+def page_path(output, url):
+    """File that serves url"""
+    return os.path.join(output, unquote(url).strip('/'), 'index.html')
+
+# Page inputs -------------------------------------------------------------
+
+def tournament_pages(site):
+    """{url: digest} for the pages and crosstables of completed tournaments"""
+    from flask import url_for
+    from app import db
+    from archive import pairing_history, round_history
+    from models import GameRecord, Player, Tournament, TournamentPlayer
+
+    tournaments = {t.id: t for t in db.session.query(*Tournament.__table__.c).filter(Tournament.status == 'completed')}
+    if not tournaments:
+        return {}
+    rounds, pairings, entrants = {}, {}, {}
+    for row in db.session.query(round_history.c.id, round_history.c.tournament_id, round_history.c.number,
+                                round_history.c.datetime, round_history.c.status, round_history.c.version) \
+            .filter(round_history.c.tournament_id.in_(tournaments)).order_by(round_history.c.id):
+        rounds.setdefault(row.tournament_id, []).append(tuple(row))
+    for row in db.session.query(round_history.c.tournament_id, pairing_history.c.id,
+                                pairing_history.c.white_player_id, pairing_history.c.black_player_id,
+                                pairing_history.c.result, pairing_history.c.version) \
+            .join(round_history, round_history.c.id == pairing_history.c.round_id) \
+            .filter(round_history.c.tournament_id.in_(tournaments)).order_by(pairing_history.c.id):
+        pairings.setdefault(row.tournament_id, []).append(tuple(row))
+    for row in db.session.query(TournamentPlayer.tournament_id, TournamentPlayer.player_id,
+                                TournamentPlayer.initial_rating, TournamentPlayer.final_rating) \
+            .filter(TournamentPlayer.tournament_id.in_(tournaments)).order_by(TournamentPlayer.id):
+        entrants.setdefault(row.tournament_id, []).append(tuple(row))
+    games = {}
+    for row in db.session.query(GameRecord.tournament_id, GameRecord.pairing_id, GameRecord.id) \
+            .filter(GameRecord.tournament_id.in_(tournaments), GameRecord.pairing_id.isnot(None)) \
+            .order_by(GameRecord.pairing_id):
+        games.setdefault(row.tournament_id, []).append(tuple(row))
+
+    player_ids = {p[2] for rows in pairings.values() for p in rows} | {p[3] for rows in pairings.values() for p in rows} \
+        | {e[1] for rows in entrants.values() for e in rows}
+    players = {}
+    if player_ids:
+        players = {row.id: tuple(row) for row in db.session.query(
+            Player.id, Player.player_id, Player.first_name, Player.middle_name, Player.last_name, Player.rating)
+            .filter(Player.id.in_(player_ids))}
+
+    pages = {}
+    for tournament_id, tournament in tournaments.items():
+        ids = {e[1] for e in entrants.get(tournament_id, ())} | \
+            {pid for p in pairings.get(tournament_id, ()) for pid in (p[2], p[3])}
+        people = [players.get(pid) for pid in sorted(ids)]
+        # The crosstable shows names but not current ratings
+        names = [person[:5] if person else None for person in people]
+        inputs = (site, tuple(tournament), rounds.get(tournament_id), pairings.get(tournament_id),
+                  entrants.get(tournament_id))
+        pages[url_for('main.tournament_details', tournament_id=tournament_id)] = _digest(
+            *inputs, people, games.get(tournament_id))
+        if rounds.get(tournament_id):
+            pages[url_for('main.tournament_crosstable', tournament_id=tournament_id)] = _digest(*inputs, names)
+    return pages
+
+def player_pages(site, ratings):
+    """{url: digest} for every player profile"""
+    from flask import url_for
+    from app import db
+    from archive import match_history
+    from models import HeadToHead, Player, Tournament, TournamentPlayer, full_name
+
+    names = {row.id: full_name(row.first_name, row.middle_name, row.last_name) for row in
+             db.session.query(Player.id, Player.first_name, Player.middle_name, Player.last_name)}
+    tournaments = {row.id: tuple(row) for row in
+                   db.session.query(Tournament.id, Tournament.name, Tournament.start_date, Tournament.end_date)}
+    matches, history, records = {}, {}, {}
+    for row in db.session.query(match_history.c.id, match_history.c.date, match_history.c.tournament_id,
+                                match_history.c.white_player_id, match_history.c.black_player_id,
+                                match_history.c.result).order_by(match_history.c.id):
+        game = (tuple(row), names.get(row.white_player_id), names.get(row.black_player_id),
+                tournaments.get(row.tournament_id))
+        matches.setdefault(row.white_player_id, []).append(game)
+        matches.setdefault(row.black_player_id, []).append(game)
+    for row in db.session.query(TournamentPlayer.player_id, TournamentPlayer.tournament_id,
+                                TournamentPlayer.initial_rating, TournamentPlayer.final_rating) \
+            .order_by(TournamentPlayer.id):
+        history.setdefault(row.player_id, []).append((tuple(row), tournaments.get(row.tournament_id)))
+    for row in db.session.query(*HeadToHead.__table__.c):
+        record = (tuple(row), names.get(row.low_player_id), names.get(row.high_player_id))
+        records.setdefault(row.low_player_id, []).append(record)
+        records.setdefault(row.high_player_id, []).append(record)
+
+    today = date.today()
+    pages = {}
+    for row in db.session.query(Player.id, Player.player_id, Player.first_name, Player.middle_name,
+                                Player.last_name, Player.state, Player.rating, Player.rating_deviation,
+                                Player.volatility, Player.last_active, Player.player_photo):
+        standing = (ratings.rank(row.id), len(ratings), ratings.rank(row.id, state=row.state),
+                    ratings.count(state=row.state), ratings.percentile(row.rating))
+        # The rating history ends with today's date unless the last tournament left the current rating
+        finals = [tp[0][3] for tp in history.get(row.id, ()) if tp[0][3]]
+        dated = today if not finals or finals[-1] != row.rating else None
+        pages[url_for('main.player_stats', player_id=row.id)] = _digest(
+            site, tuple(row), standing, dated, matches.get(row.id), history.get(row.id), records.get(row.id))
+    return pages
+
+def rating_list_pages(site, ratings):
+    """{url: digest} for the player list and the first page of every ranking view"""
+    from flask import url_for
+    from models import INDIAN_STATES
+    from rating_store import AGE_BAND_LABELS
+
+    def fields(entries):
+        return tuple((e.id, e.player_id, e.name, e.state, e.rating, e.rating_deviation, e.last_active)
+                     for e in entries)
+
+    pages = {url_for('main.players'): _digest(site, fields(ratings.entries))}
+    views = [(None, None), ('active', None)] + [('state', state) for state in INDIAN_STATES] + \
+        [('age', band) for band in AGE_BAND_LABELS]
+    for kind, value in views:
+        index = ratings.view(kind, value)
+        pages[url_for('main.rankings', kind=kind, value=value)] = _digest(
+            site, len(index), fields(index.page(0, 100)))
+    return pages
+
+def published_list_pages(site, ratings):
+    """{url: digest} for the published rating lists and their changes since the previous list"""
+    from flask import url_for
+    from models import RatingList
+    import rating_lists
+
+    names = {entry.id: (entry.player_id, entry.name) for entry in ratings.entries}
+    lists = RatingList.query.order_by(RatingList.published_on).all()
+    pages = {url_for('main.rating_list_index'): _digest(
+        site, [(row.id, row.published_on, row.title, row.player_count) for row in lists])}
+    previous = None
+    for row in lists:
+        decoded = rating_lists.load(row.id)
+        top = [decoded.ids[i] for i in decoded.ranked()[:100]]
+        published_on = row.published_on.isoformat()
+        pages[url_for('main.rating_list', published_on=published_on)] = _digest(
+            site, row.id, previous and previous.id, [names.get(player_id) for player_id in top])
+        if previous is not None:
+            changed = [entry['player_id'] for entry in rating_lists.changes(previous, row)]
+            pages[url_for('main.rating_list_changes', published_on=published_on)] = _digest(
+                site, row.id, previous.id, [names.get(player_id) for player_id in changed])
+        previous = row
+    return pages
+
+def collect_pages():
+    """{url: digest} of every exported page; needs an app context"""
+    from flask import current_app
+    from rating_store import store as rating_store
+
+    site = site_digest()
+    ratings = rating_store.snapshot()
+    with current_app.test_request_context():
+        pages = tournament_pages(site)
+        pages.update(player_pages(site, ratings))
+        pages.update(rating_list_pages(site, ratings))
+        pages.update(published_list_pages(site, ratings))
+    return pages
+
+# Rendering ---------------------------------------------------------------
+
+_client = None
+
+def _init_worker():
+    global _client
+    from app import create_app
+    _client = create_app(APP_CONFIG).test_client()
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def render_batch(urls, output):
+    """Render urls to their files; returns [(url, status, [static files referenced])]"""
+    rendered = []
+    for url in urls:
+        response = _client.get(url)
+        if response.status_code != 200:
+            rendered.append((url, response.status_code, []))
+            continue
+        body = response.get_data()
+        _write_atomic(page_path(output, url), body)
+        assets = sorted({unquote(name) for name in STATIC_URL.findall(body.decode('utf-8', 'replace'))
+                         if not name.startswith(PRIVATE_STATIC)})
+        rendered.append((url, 200, assets))
+    return rendered
+
+def _remove_file(output, path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return
+    # Drop directories left empty, up to the output directory
+    directory = os.path.dirname(path)
+    while os.path.abspath(directory) != os.path.abspath(output) and not os.listdir(directory):
+        os.rmdir(directory)
+        directory = os.path.dirname(directory)
+
+def sync_assets(output, static_folder, names, previous):
+    """Copy referenced static files that changed and delete unreferenced ones; returns (index, copied)"""
+    index, copied = {}, 0
+    for name in sorted(names):
+        source = os.path.join(static_folder, name)
+        if not os.path.isfile(source):
+            continue
+        stat = os.stat(source)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        target = os.path.join(output, 'static', name)
+        if previous.get(name) != signature or not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            tmp_path = f'{target}.tmp'
+            shutil.copy2(source, tmp_path)
+            os.replace(tmp_path, target)
+            copied += 1
+        index[name] = signature
+    for name in set(previous) - set(index):
+        _remove_file(output, os.path.join(output, 'static', name))
+    return index, copied
+
+def export(app, output=DEFAULT_OUTPUT, workers=None, force=False, batch_size=BATCH_SIZE):
+    """Bring the export directory up to date; returns counts of what was done"""
+    os.makedirs(output, exist_ok=True)
+    lock = open(os.path.join(output, '.lock'), 'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        manifest_path = os.path.join(output, MANIFEST)
+        manifest = {'pages': {}, 'assets': {}}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        exported = manifest['pages']
+
+        with app.app_context():
+            pages = collect_pages()
+        stale = [url for url, digest in pages.items()
+                 if force or exported.get(url, {}).get('digest') != digest
+                 or not os.path.exists(page_path(output, url))]
+
+        failed = 0
+        if stale:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+                futures = [pool.submit(render_batch, stale[i:i + batch_size], output)
+                           for i in range(0, len(stale), batch_size)]
+                for future in futures:
+                    for url, status, assets in future.result():
+                        if status == 200:
+                            exported[url] = {'digest': pages[url], 'assets': assets}
+                        else:
+                            logger.warning('Not exported: %s returned %s', url, status)
+                            exported.pop(url, None)
+                            pages.pop(url)
+                            _remove_file(output, page_path(output, url))
+                            failed += 1
+
+        removed = [url for url in exported if url not in pages]
+        for url in removed:
+            del exported[url]
+            _remove_file(output, page_path(output, url))
+
+        referenced = {name for page in exported.values() for name in page['assets']}
+        manifest['assets'], copied = sync_assets(output, app.static_folder, referenced, manifest['assets'])
+
+        tmp_path = manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, manifest_path)
+    finally:
+        lock.close()
+    return {
+        'pages': len(pages),
+        'rendered': len(stale) - failed,
+        'failed': failed,
+        'removed': len(removed),
+        'assets_copied': copied,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export completed tournaments, player profiles and rating lists '
+                                                 'as static files.')
+    parser.add_argument('--output', default=os.environ.get('STATIC_EXPORT_DIR', DEFAULT_OUTPUT))
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--force', action='store_true', help='render every page even if its inputs are unchanged')
+    args = parser.parse_args(argv)
+
+    from app import create_app
+    counts = export(create_app(APP_CONFIG), args.output, workers=args.workers, force=args.force)
+    print(f"{counts['pages']} pages: {counts['rendered']} rendered, {counts['failed']} failed, "
+          f"{counts['removed']} removed; {counts['assets_copied']} static files copied")
+    return 1 if counts['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
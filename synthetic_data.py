@@ -0,0 +1,192 @@
+import random
+from datetime import datetime, timedelta
+from app import db
+import dedup
+import head_to_head
+from models import User, Player, Tournament, Round, RoundPairing, TournamentPlayer, Match, INDIAN_STATES
+
+# Dataset sizes keyed by the name passed on the command line
+SCALES = {
+    '1k': {'players': 1_000, 'tournaments': 25, 'field_size': 40, 'rounds': 5},
+    '10k': {'players': 10_000, 'tournaments': 250, 'field_size': 40, 'rounds': 5},
+    '100k': {'players': 100_000, 'tournaments': 2_500, 'field_size': 40, 'rounds': 5},
+}
+
+FIRST_NAMES = [
+    'Aarav', 'Vivaan', 'Aditya', 'Vihaan', 'Arjun', 'Sai', 'Reyansh', 'Krishna',
+    'Ishaan', 'Ananya', 'Diya', 'Saanvi', 'Aadhya', 'Kiara', 'Meera', 'Priya',
+    'Rohan', 'Kavya', 'Nikhil', 'Lakshmi', 'Farhan', 'Zoya', 'Harpreet', 'Tenzin',
+]
+LAST_NAMES = [
+    'Sharma', 'Verma', 'Iyer', 'Nair', 'Reddy', 'Patel', 'Singh', 'Das',
+    'Menon', 'Gupta', 'Khan', 'Bose', 'Pillai', 'Rao', 'Joshi', 'Kulkarni',
+    'Chatterjee', 'Mehta', 'Naidu', 'Bhat', 'Sen', 'Gill', 'Lepcha', 'Sangma',
+]
+
+BASE_DATE = datetime(2024, 1, 6, 10, 0)
+CHUNK_SIZE = 5_000
+
+def _code(rng, length):
+    chars = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+    return ''.join(rng.choice(chars) for _ in range(length))
+
+def _insert(model, rows):
+    for start in range(0, len(rows), CHUNK_SIZE):
+        db.session.execute(db.insert(model.__table__), rows[start:start + CHUNK_SIZE])
+
+def _result(rng, white_rating, black_rating):
+    # Stronger player wins more often, roughly following the Elo curve
+    white_expected = 1 / (1 + 10 ** ((black_rating - white_rating) / 400))
+    if rng.random() < 0.01:
+        return 'Jigo'
+    if rng.random() < white_expected:
+        return rng.choice(['W+R', 'W+T'])
+    return rng.choice(['B+R', 'B+T'])
+
+def generate(scale='1k', seed=42):
+    """
+    Fill the current database with a deterministic synthetic dataset.
+    Returns a summary dict with the ids the benchmark needs.
+    Must be called inside an application context against an empty database.
+    """
+    spec = SCALES[scale]
+    rng = random.Random(seed)
+    # Separate stream so the rest of the dataset stays identical to earlier versions
+    birth_rng = random.Random(seed + 1)
+
+    admin = User(username='bench-admin', email='bench-admin@example.com', is_admin=True)
+    admin.set_password('bench-admin')
+    db.session.add(admin)
+    db.session.flush()
+
+    # Players
+    player_rows = []
+    ratings = {}
+    used_codes = set()
+    for player_pk in range(1, spec['players'] + 1):
+        code = _code(rng, 10)
+        while code in used_codes:
+            code = _code(rng, 10)
+        used_codes.add(code)
+        rating = min(max(rng.gauss(1500, 300), 100), 2900)
+        ratings[player_pk] = rating
+        player_rows.append({
+            'id': player_pk,
+            'player_id': code,
+            'first_name': rng.choice(FIRST_NAMES),
+            'middle_name': None,
+            'last_name': rng.choice(LAST_NAMES),
+            'state': rng.choice(INDIAN_STATES),
+            'email': f'player{player_pk}@example.com',
+            'phone': f'9{rng.randrange(10**9):09d}',
+            'rating': rating,
+            'rating_deviation': rng.uniform(50, 350),
+            'volatility': 0.06,
+            'last_active': BASE_DATE + timedelta(days=rng.randrange(365)),
+            'birth_date': (BASE_DATE - timedelta(days=birth_rng.randrange(7 * 365, 70 * 365))).date(),
+        })
+    _insert(Player, player_rows)
+
+    # Tournaments with their fields, rounds, pairings and match records
+    tournament_rows = []
+    entry_rows = []
+    round_rows = []
+    pairing_rows = []
+    match_rows = []
+    used_codes = set()
+    round_pk = 0
+    ongoing = []
+    completed = []
+    for tournament_pk in range(1, spec['tournaments'] + 1):
+        code = _code(rng, 5)
+        while code in used_codes:
+            code = _code(rng, 5)
+        used_codes.add(code)
+
+        roll = rng.random()
+        if roll < 0.7:
+            status = 'completed'
+        elif roll < 0.85:
+            status = 'ongoing'
+        else:
+            status = 'upcoming'
+        start = BASE_DATE + timedelta(days=7 * (tournament_pk % 52), hours=tournament_pk % 24)
+        tournament_rows.append({
+            'id': tournament_pk,
+            'tournament_id': code,
+            'name': f'Synthetic Open {tournament_pk}',
+            'start_date': start,
+            'end_date': start + timedelta(days=2),
+            'state': rng.choice(INDIAN_STATES),
+            'info': f'## Synthetic Open {tournament_pk}\n\n* {spec["rounds"]} rounds\n* Time control 40m + 3x30s byo-yomi',
+            'cover_photo': None,
+            'status': status,
+            'pairing_system': rng.choice(['swiss', 'macmahon', 'round_robin']),
+        })
+
+        field = rng.sample(range(1, spec['players'] + 1), spec['field_size'])
+        for player_pk in field:
+            entry_rows.append({
+                'tournament_id': tournament_pk,
+                'player_id': player_pk,
+                'initial_rating': ratings[player_pk],
+                'final_rating': ratings[player_pk] + rng.uniform(-40, 40) if status == 'completed' else None,
+                'current_score': 0,
+            })
+
+        if status == 'upcoming':
+            continue
+        (completed if status == 'completed' else ongoing).append(tournament_pk)
+
+        played_rounds = spec['rounds'] if status == 'completed' else spec['rounds'] - 1
+        for number in range(1, played_rounds + 1):
+            round_pk += 1
+            round_time = start + timedelta(hours=3 * number)
+            round_rows.append({
+                'id': round_pk,
+                'tournament_id': tournament_pk,
+                'number': number,
+                'datetime': round_time,
+                'status': 'completed',
+            })
+            rng.shuffle(field)
+            for i in range(0, len(field) - 1, 2):
+                white, black = field[i], field[i + 1]
+                result = _result(rng, ratings[white], ratings[black])
+                pairing_rows.append({
+                    'round_id': round_pk,
+                    'white_player_id': white,
+                    'black_player_id': black,
+                    'result': result,
+                })
+                match_rows.append({
+                    'tournament_id': tournament_pk,
+                    'round_number': number,
+                    'round_start_time': round_time,
+                    'black_player_id': black,
+                    'white_player_id': white,
+                    'result': result,
+                    'date': round_time + timedelta(hours=2),
+                })
+
+    _insert(Tournament, tournament_rows)
+    _insert(TournamentPlayer, entry_rows)
+    _insert(Round, round_rows)
+    _insert(RoundPairing, pairing_rows)
+    _insert(Match, match_rows)
+    db.session.commit()
+    head_to_head.rebuild()
+    dedup.rebuild_keys()
+
+    return {
+        'scale': scale,
+        'seed': seed,
+        'admin_id': admin.id,
+        'players': len(player_rows),
+        'tournaments': len(tournament_rows),
+        'rounds': len(round_rows),
+        'pairings': len(pairing_rows),
+        'matches': len(match_rows),
+        'ongoing_tournaments': ongoing,
+        'completed_tournaments': completed,
+    }
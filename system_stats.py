@@ -0,0 +1,152 @@
+"""
+Cached system statistics for the admin dashboard.
+
+StatsCollector keeps one snapshot of the dashboard counters.  Database
+counters are recomputed when a flush touched players or tournaments or when
+the snapshot is older than STATS_REFRESH_SECONDS; file sizes (database, WAL,
+uploads) and the last backup time are only refreshed on the timer since
+walking the upload directory is the expensive part.  Request rates are counted in memory per minute.
+"""
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import case, event, func
+from sqlalchemy.orm import Session
+from app import db
+from backup import BackupStore, sqlite_path
+from models import Player, Tournament
+
+ACTIVE_DAYS = 90
+RATE_WINDOWS = (1, 5, 15)  # minutes
+
+def directory_size(path):
+    total = 0
+    files = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+                files += 1
+            except OSError:
+                pass
+    return total, files
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+class StatsCollector:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._db_refreshed = 0.0
+        self._files_refreshed = 0.0
+        self.stale = True
+        self._minute_counts = {}
+
+    def count_request(self):
+        minute = int(time.time() // 60)
+        with self._lock:
+            self._minute_counts[minute] = self._minute_counts.get(minute, 0) + 1
+            if len(self._minute_counts) > RATE_WINDOWS[-1] + 1:
+                for old in [m for m in self._minute_counts if m < minute - RATE_WINDOWS[-1]]:
+                    del self._minute_counts[old]
+
+    def request_rates(self):
+        now = time.time()
+        minute = int(now // 60)
+        with self._lock:
+            counts = dict(self._minute_counts)
+        rates = {}
+        for window in RATE_WINDOWS:
+            # The current minute is only partly over, so divide by the elapsed time
+            total = sum(counts.get(m, 0) for m in range(minute - window + 1, minute + 1))
+            elapsed = (window - 1) * 60 + (now % 60)
+            rates[f'{window}m'] = round(total / max(elapsed, 1) * 60, 2)
+        return rates
+
+    def _database_counters(self):
+        cutoff = datetime.utcnow() - timedelta(days=ACTIVE_DAYS)
+        total, active, avg_rating = db.session.query(
+            func.count(Player.id),
+            func.sum(case((Player.last_active >= cutoff, 1), else_=0)),
+            func.avg(Player.rating),
+        ).one()
+        by_status = dict(db.session.query(Tournament.status, func.count(Tournament.id)).group_by(Tournament.status).all())
+        return {
+            'players': {'total': total, 'active': active or 0, 'avg_rating': avg_rating or 0},
+            'tournaments': {
+                'ongoing': by_status.get('ongoing', 0),
+                'upcoming': by_status.get('upcoming', 0),
+                'completed': by_status.get('completed', 0),
+            },
+        }
+
+    def _file_counters(self, app):
+        path = sqlite_path(db.engine)
+        uploads_size, uploads_files = directory_size(os.path.join(app.root_path, 'static', 'uploads'))
+        return {
+            'db_size': file_size(path) if path else None,
+            'wal_size': file_size(path + '-wal') if path else None,
+            'uploads_size': uploads_size,
+            'uploads_files': uploads_files,
+            'last_backup': BackupStore(app.config['BACKUP_DIR'], path, None).latest_time(),
+        }
+
+    def snapshot(self, app):
+        """Return the cached snapshot, refreshing whichever parts are out of date"""
+        refresh_seconds = app.config['STATS_REFRESH_SECONDS']
+        now = time.monotonic()
+        with self._lock:
+            snapshot = dict(self._snapshot or {})
+            refresh_db = self.stale or now - self._db_refreshed >= refresh_seconds
+            refresh_files = now - self._files_refreshed >= refresh_seconds
+            self.stale = False
+
+        if refresh_db:
+            snapshot.update(self._database_counters())
+            snapshot['refreshed_at'] = datetime.utcnow()
+        if refresh_files:
+            snapshot['system'] = self._file_counters(app)
+
+        with self._lock:
+            if refresh_db:
+                self._db_refreshed = now
+            if refresh_files:
+                self._files_refreshed = now
+            self._snapshot = snapshot
+        snapshot = dict(snapshot)
+        snapshot['request_rates'] = self.request_rates()
+        return snapshot
+
+collector = StatsCollector()
+
+def _note_change(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, (Player, Tournament)):
+            session.info['stats_changed'] = True
+            return
+
+def _mark_stale(session):
+    # Only once committed; a refresh between flush and commit would read the old rows
+    if session.info.pop('stats_changed', False):
+        collector.stale = True
+
+def _forget_change(session):
+    session.info.pop('stats_changed', None)
+
+def _count_request(response):
+    collector.count_request()
+    return response
+
+def init_app(app):
+    app.config.setdefault('STATS_REFRESH_SECONDS', int(os.environ.get('STATS_REFRESH_SECONDS', 60)))
+    for name, listener in (('after_flush', _note_change),
+                           ('after_commit', _mark_stale),
+                           ('after_rollback', _forget_change)):
+        if not event.contains(Session, name, listener):
+            event.listen(Session, name, listener)
+    app.after_request(_count_request)
@@ -0,0 +1,69 @@
+"""
+Per-table change counters.
+
+Every commit that inserts, updates or deletes rows of a table increments that
+table's row in TableVersion, inside the same transaction.  Readers can
+compare one small row instead of the data itself to know whether anything
+changed, across all worker processes: the API derives its ETags from these
+counters and in-memory caches use them to decide when to reload.
+"""
+from sqlalchemy import event, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from app import db
+from models import TableVersion
+
+VERSION_TABLE = TableVersion.__table__.name
+
+def _changed_tables(session):
+    return session.info.setdefault('changed_tables', set())
+
+def _after_flush(session, flush_context):
+    tables = _changed_tables(session)
+    for obj in session.new | session.deleted:
+        tables.add(obj.__table__.name)
+    for obj in session.dirty:
+        if session.is_modified(obj, include_collections=False):
+            tables.add(obj.__table__.name)
+    tables.discard(VERSION_TABLE)
+
+def _do_orm_execute(orm_execute_state):
+    # Bulk statements such as Query.delete() bypass the flush, so pick them up here
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = getattr(orm_execute_state.statement, 'table', None)
+        if table is not None and table.name != VERSION_TABLE:
+            _changed_tables(orm_execute_state.session).add(table.name)
+
+def _before_commit(session):
+    session.flush()
+    tables = session.info.pop('changed_tables', None)
+    if not tables:
+        return
+    # One upsert per table: two processes creating a table's row at once both succeed
+    for table in sorted(tables):
+        statement = insert(TableVersion).values(table_name=table, version=1)
+        session.execute(statement.on_conflict_do_update(
+            index_elements=[TableVersion.table_name],
+            set_={'version': TableVersion.version + 1},
+        ))
+    session.info.pop('changed_tables', None)
+
+def _after_rollback(session):
+    session.info.pop('changed_tables', None)
+
+def table_versions(*tables):
+    """Current version of each named table, 0 for tables never written"""
+    rows = db.session.execute(
+        select(TableVersion.table_name, TableVersion.version).where(TableVersion.table_name.in_(tables))
+    ).all()
+    versions = dict.fromkeys(tables, 0)
+    versions.update(rows)
+    return versions
+
+def init_app(app):
+    for name, listener in (('after_flush', _after_flush),
+                           ('do_orm_execute', _do_orm_execute),
+                           ('before_commit', _before_commit),
+                           ('after_rollback', _after_rollback)):
+        if not event.contains(Session, name, listener):
+            event.listen(Session, name, listener)